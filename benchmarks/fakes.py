@@ -0,0 +1,653 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# In-memory fakes of everything the agent manages apart from the Neutron database, so
+# that it can be benchmarked without root privileges, a real kernel, FRR or OVS:
+#
+# - The kernel is the agent's own simulated dataplane (see evpn_agent.simkernel). It
+#   is either used as the dataplane backend directly, or by the iproute2 backend, in
+#   which case the commands fed to 'ip -batch' and 'bridge -batch' are parsed into
+#   operations on it (see Iproute2), and it stands in for rtnetlink.
+# - Frr holds the running config of the FRR daemons, and executes 'vtysh -f'. The
+#   stand-in for frr-reload.py in frr_reload.py reads the running config from it.
+# - OvsdbServer is a minimal ovsdb-server holding the OVS bridges and their ports.
+# - VtyDaemon is a minimal FRR daemon serving its VTY socket, for testing the VTY
+#   client (see evpn_agent.vty).
+#
+# install() hooks them into the agent's modules.
+
+from collections import Counter
+import json
+import os
+import shlex
+import socket
+import subprocess
+import threading
+import uuid
+
+from evpn_agent import dataplane, iproute2, utils
+from evpn_agent.dataplane import Error
+from evpn_agent.routemanager import Route
+
+# The simulated FRR daemons, for use by frr_reload.py, see install()
+frr_daemons = None
+
+
+class Iproute2(iproute2.Iproute2):
+    """The iproute2 backend, with the simulated kernel standing in for rtnetlink"""
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+
+    def monitor(self):
+        return self.kernel.monitor()
+
+    def dump_links(self):
+        return self.kernel.dump_links()
+
+    def dump_addresses(self):
+        return self.kernel.dump_addresses()
+
+    def dump_neighs(self, *, proto):
+        return self.kernel.dump_neighs(proto=proto)
+
+    def dump_routes(self, *, proto):
+        return self.kernel.dump_routes(proto=proto)
+
+    def dump_fdb(self, *, dev, master):
+        return self.kernel.dump_fdb(dev=dev, master=master)
+
+    def dump_bridge_ports(self):
+        return self.kernel.dump_bridge_ports()
+
+
+# 'ip link' attributes by keyword, with the Link field they set and a function
+# converting their values
+LINK_ATTRS = {
+    "address": ("address", str),
+    "addrgenmode": ("inet6_addr_gen_mode", str),
+    "alias": ("ifalias", str),
+    "master": ("master", str),
+    "mtu": ("mtu", int),
+}
+
+
+def _link_attrs(args, i):
+    """Parses the link attributes in args from index i up to the link type, if any,
+    returning them along with the index at which they end"""
+    attrs = {}
+    while i < len(args) and args[i] != "type":
+        if args[i] in ("up", "down"):
+            attrs["up"] = args[i] == "up"
+            i += 1
+        elif args[i] == "nomaster":
+            attrs["master"] = None
+            i += 1
+        elif args[i] in LINK_ATTRS and i + 1 < len(args):
+            attr, convert = LINK_ATTRS[args[i]]
+            attrs[attr] = convert(args[i + 1])
+            i += 2
+        else:
+            raise Error(f'Error: either "dev" is duplicate, or "{args[i]}" is garbage.')
+    return attrs, i
+
+
+def _type_attrs(args, i):
+    attrs = {}
+    while i < len(args) and args[i] != "peer":
+        if args[i] in ("learning", "nolearning") and (
+            i + 1 == len(args) or args[i + 1] not in ("on", "off")
+        ):
+            attrs["learning"] = args[i] == "learning"
+            i += 1
+            continue
+        if i + 1 == len(args):
+            raise Error(f'Error: argument "{args[i]}" is wrong')
+        key, value = args[i], args[i + 1]
+        if value in ("on", "off"):
+            value = value == "on"
+        elif value.isdigit():
+            value = int(value)
+        attrs["port" if key == "dstport" else key] = value
+        i += 2
+    return attrs, i
+
+
+def _link(op, args):
+    if op == "add":
+        if args[0] != "name":
+            raise Error('Not enough information: "dev" argument is required.')
+        link = None
+        i = 2
+        if args[i : i + 1] == ["link"]:
+            link = args[i + 1]
+            i += 2
+        attrs, i = _link_attrs(args, i)
+        if i + 1 >= len(args):
+            raise Error("Not enough information: link type is required")
+        type = args[i + 1]
+        type_attrs, i = _type_attrs(args, i + 2)
+        if args[i : i + 2] == ["peer", "name"]:
+            link = args[i + 2]
+        return "add_link", dict(
+            name=args[1], type=type, link=link, attrs=attrs, type_attrs=type_attrs
+        )
+    if op == "set":
+        if args[0] == "dev":
+            args = args[1:]
+        attrs, i = _link_attrs(args, 1)
+        type, type_attrs = None, {}
+        if i < len(args):
+            type = args[i + 1]
+            type_attrs, _ = _type_attrs(args, i + 2)
+        return "set_link", dict(
+            name=args[0], attrs=attrs, type=type, type_attrs=type_attrs
+        )
+    if op == "del":
+        return "del_link", dict(name=args[-1])
+    raise Error(f'Command "{op}" is unknown, try "ip link help".')
+
+
+def _address(op, args):
+    if op not in ("add", "del") or args[0] != "dev":
+        raise Error(f'Command "{op}" is unknown, try "ip address help".')
+    return f"{op}_address", dict(dev=args[1], address=args[2])
+
+
+def _neigh(op, args):
+    opts = dict(zip(args[1::2], args[2::2]))
+    if op == "replace" and opts.get("nud") == "permanent":
+        return "replace_neigh", dict(
+            dst=args[0], dev=opts["dev"], lladdr=opts["lladdr"], proto=opts["proto"]
+        )
+    if op == "del":
+        return "del_neigh", dict(
+            dst=args[0], dev=opts["dev"], lladdr=opts["lladdr"], proto=opts["proto"]
+        )
+    raise Error(f'Command "{op}" is unknown, try "ip neigh help".')
+
+
+def _route(op, args):
+    type = None
+    if args[0] in ("unicast", "blackhole", "unreachable", "prohibit", "local"):
+        type, args = args[0], args[1:]
+    opts = dict(zip(args[1::2], args[2::2]))
+    if op == "add":
+        route = Route(
+            dst=args[0],
+            gateway=opts.get("via"),
+            dev=opts.get("dev"),
+            type=type,
+            metric=int(opts["metric"]) if "metric" in opts else None,
+            table=opts.get("table", "main"),
+        )
+        return "add_route", dict(route=route, proto=opts.get("proto", "boot"))
+    if op == "del":
+        return "del_route", dict(
+            dst=args[0], table=opts.get("table", "main"), proto=opts["proto"]
+        )
+    raise Error(f'Command "{op}" is unknown, try "ip route help".')
+
+
+def _vlan(op, args):
+    opts = dict(zip(args[::2], args[1::2]))
+    if op not in ("add", "del"):
+        raise Error(f'Command "{op}" is unknown, try "bridge vlan help".')
+    kwargs = dict(dev=opts["dev"], vid=int(opts["vid"]), bridge="self" in args)
+    if op == "add":
+        kwargs["tagged"] = "untagged" not in args
+    return f"{op}_vlan", kwargs
+
+
+def _fdb(op, args):
+    opts = dict(zip(args[1::2], args[2::2]))
+    vid = int(args[args.index("vlan") + 1])
+    if op == "replace" and "static" in args and "sticky" in args:
+        return "replace_fdb", dict(mac=args[0], dev=opts["dev"], vid=vid)
+    if op == "del":
+        return "del_fdb", dict(mac=args[0], dev=opts["dev"], vid=vid)
+    raise Error(f'Command "{op}" is unknown, try "bridge fdb help".')
+
+
+# The parsers of the commands, which return the operation and its arguments
+PARSERS = {
+    ("ip", "link"): _link,
+    ("ip", "address"): _address,
+    ("ip", "neigh"): _neigh,
+    ("ip", "route"): _route,
+    ("bridge", "vlan"): _vlan,
+    ("bridge", "fdb"): _fdb,
+}
+
+
+def batch(kernel, tool, script):
+    """Executes a script fed to 'ip -force -batch -' or 'bridge -force -batch -' on the
+    simulated kernel, returning the exit status and the error messages"""
+    stderr = []
+    for n, line in enumerate(script.splitlines(), 1):
+        args = shlex.split(line) if '"' in line or "'" in line else line.split()
+        try:
+            if (tool, args[0]) not in PARSERS:
+                raise Error(f'Object "{args[0]}" is unknown, try "{tool} help".')
+            operation, kwargs = PARSERS[(tool, args[0])](args[1], args[2:])
+        except Error as e:
+            kernel.failures.append(f"{tool} {line}: {e}")
+            stderr.append(f"{e}\nCommand failed -:{n}")
+            continue
+        kind = (operation.split("_", 1)[1], operation.startswith("del_"))
+        for _, _, error in kernel.execute(kind, [(operation, kwargs, line)]):
+            stderr.append(f"{error}\nCommand failed -:{n}")
+    return (1 if stderr else 0), "".join(line + "\n" for line in stderr)
+
+
+class Frr:
+    """The running config of the FRR daemons, as a dict of contexts in the format
+    produced by frr-reload.py: the lines of each context keyed by a tuple of the
+    lines that enter it, e.g., ("router bgp 65000", "address-family ipv4 unicast")."""
+
+    # Top level commands that enter a context, as opposed to single line commands
+    CONTEXTS = ("router ", "route-map ", "interface ", "vrf ", "line ", "key chain ")
+    TOP_LEVEL = CONTEXTS + (
+        "frr ",
+        "hostname ",
+        "log ",
+        "service ",
+        "password ",
+        "ip prefix-list ",
+        "ipv6 prefix-list ",
+        "ip route ",
+        "ipv6 route ",
+    )
+    SUB_CONTEXTS = ("address-family ",)
+    EXITS = ("exit", "end", "exit-vrf", "exit-address-family")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contexts = {}
+        self.counts = Counter()
+
+    @classmethod
+    def is_context(cls, line):
+        return line.startswith(cls.CONTEXTS)
+
+    def show_running_config(self):
+        with self.lock:
+            subs = {}
+            for keys in self.contexts:
+                if len(keys) > 1:
+                    subs.setdefault(keys[0], []).append(keys)
+            out = []
+            for keys, lines in self.contexts.items():
+                if len(keys) > 1:
+                    continue
+                out.append(keys[0])
+                out.extend(" " + line for line in lines)
+                for sub in subs.get(keys[0], []):
+                    out.append(" " + sub[1])
+                    out.extend("  " + line for line in self.contexts[sub])
+                    out.append(" exit-address-family")
+                if self.is_context(keys[0]):
+                    out.append("exit")
+            return "".join(line + "\n" for line in out)
+
+    def configure(self, text):
+        """Applies config the way 'vtysh -f' does, returning the (line number, error
+        message) of every line that failed"""
+        self.counts["vtysh -f"] += 1
+        errors = []
+        context = ()
+        with self.lock:
+            for n, line in enumerate(text.splitlines(), 1):
+                line = " ".join(line.split())
+                if not line or line.startswith("!"):
+                    continue
+                self.counts["vtysh line"] += 1
+                negate = line.startswith("no ")
+                command = line[3:] if negate else line
+                if line in self.EXITS:
+                    context = context[:1] if line == "exit-address-family" else ()
+                elif command.startswith(self.TOP_LEVEL):
+                    keys = (command,)
+                    if negate:
+                        for k in [k for k in self.contexts if k[0] == command]:
+                            del self.contexts[k]
+                        context = ()
+                    else:
+                        self.contexts.setdefault(keys, [])
+                        context = keys if self.is_context(command) else ()
+                elif command.startswith(self.SUB_CONTEXTS) and context:
+                    keys = context[:1] + (command,)
+                    if negate:
+                        self.contexts.pop(keys, None)
+                        context = context[:1]
+                    else:
+                        self.contexts.setdefault(keys, [])
+                        context = keys
+                elif not context:
+                    errors.append((n, f"% Unknown command: {line}"))
+                else:
+                    lines = self.contexts[context]
+                    if negate and command in lines:
+                        lines.remove(command)
+                    elif not negate and "no " + command in lines:
+                        lines.remove("no " + command)
+                    elif line not in lines:
+                        lines.append(line)
+        return errors
+
+
+class OvsdbServer:
+    """A minimal ovsdb-server holding the OVS bridges and their ports, which supports
+    the monitor and transact methods (the latter only with insert and mutate
+    operations) on a Unix socket"""
+
+    def __init__(self, path, bridges):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conns = []
+        self.clients = []
+        self.counts = Counter()
+        self.tables = {"Bridge": {}, "Port": {}, "Interface": {}}
+        for name in bridges:
+            self.tables["Bridge"][str(uuid.uuid4())] = {
+                "name": name,
+                "ports": ["set", []],
+            }
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.bind(path)
+        self.sock.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        """Stops the server, closing the connections of all clients, like ovsdb-server
+        does when it exits (e.g., to be restarted)"""
+        # Shutting the socket down wakes up the thread blocked accepting connections on
+        # it, which would otherwise keep it open
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+        os.unlink(self.path)
+        with self.lock:
+            for conn in self.conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    # Already closed by the client
+                    pass
+            self.conns = []
+            self.clients = []
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.conns.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        buf = ""
+        decoder = json.JSONDecoder()
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                conn.close()
+                return
+            buf += data.decode()
+            while buf.strip():
+                buf = buf.lstrip()
+                try:
+                    msg, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                if "method" not in msg:
+                    continue
+                self.counts[msg["method"]] += 1
+                with self.lock:
+                    if msg["method"] == "monitor":
+                        self.clients.append((conn, msg["params"][1], msg["params"][2]))
+                        result = self._rows(msg["params"][2], self.tables)
+                    elif msg["method"] == "transact":
+                        result = self._transact(msg["params"][1:])
+                    elif msg["method"] == "echo":
+                        result = msg["params"]
+                    else:
+                        self._send(
+                            conn,
+                            {
+                                "result": None,
+                                "error": "unknown method",
+                                "id": msg["id"],
+                            },
+                        )
+                        continue
+                    self._send(conn, {"result": result, "error": None, "id": msg["id"]})
+
+    def _send(self, conn, msg):
+        try:
+            conn.sendall(json.dumps(msg).encode())
+        except OSError:
+            pass
+
+    def _rows(self, monitor, tables, old=None):
+        return {
+            table: {
+                uuid: {
+                    **({"old": old[table][uuid]} if old and uuid in old[table] else {}),
+                    "new": {c: row[c] for c in monitor[table]["columns"]},
+                }
+                for uuid, row in tables[table].items()
+            }
+            for table in monitor
+            if tables.get(table)
+        }
+
+    def _transact(self, operations):
+        named = {}
+        results = []
+        changed = {table: {} for table in self.tables}
+        old = {table: {} for table in self.tables}
+        for op in operations:
+            table = self.tables[op["table"]]
+            if op["op"] == "insert":
+                row = {
+                    k: (
+                        named[v[1]]
+                        if isinstance(v, list) and v[0] == "named-uuid"
+                        else v
+                    )
+                    for k, v in op["row"].items()
+                }
+                row_uuid = str(uuid.uuid4())
+                named[op.get("uuid-name")] = ["uuid", row_uuid]
+                table[row_uuid] = row
+                changed[op["table"]][row_uuid] = row
+                results.append({"uuid": ["uuid", row_uuid]})
+            elif op["op"] == "mutate":
+                count = 0
+                for row_uuid, row in table.items():
+                    if all(row.get(c) == v for c, _, v in op["where"]):
+                        count += 1
+                        old[op["table"]][row_uuid] = dict(row)
+                        for column, mutator, value in op["mutations"]:
+                            if value[0] == "named-uuid":
+                                value = named[value[1]]
+                            members = (
+                                row[column][1]
+                                if row[column][0] == "set"
+                                else [row[column]]
+                            )
+                            if mutator == "insert":
+                                members = members + [value]
+                            row[column] = ["set", members]
+                        changed[op["table"]][row_uuid] = row
+                results.append({"count": count})
+            else:
+                raise ValueError(f"Unsupported operation {op['op']}")
+        for conn, monitor_id, monitor in self.clients:
+            self._send(
+                conn,
+                {
+                    "method": "update",
+                    "params": [monitor_id, self._rows(monitor, changed, old)],
+                    "id": None,
+                },
+            )
+        return results
+
+    def port_names(self, bridge):
+        with self.lock:
+            for row in self.tables["Bridge"].values():
+                if row["name"] == bridge:
+                    return [self.tables["Port"][u]["name"] for _, u in row["ports"][1]]
+
+
+class VtyDaemon:
+    """A minimal FRR daemon serving the VTY socket NAME.vty in sockdir. It accepts the
+    configuration commands that start with any of the accepts prefixes, fails those
+    that start with any of the fails prefixes, and does not know any others. Every
+    command received is recorded in commands, along with the node it was received in
+    (view, enable or config)."""
+
+    # Command return codes, cf. lib/command.h in FRR
+    CMD_SUCCESS = 0
+    CMD_WARNING = 1
+    CMD_ERR_NO_MATCH = 2
+
+    def __init__(self, sockdir, name, *, accepts=(), fails=(), config=""):
+        self.path = os.path.join(sockdir, name + ".vty")
+        self.accepts = tuple(accepts)
+        self.fails = tuple(fails)
+        self.config = config
+        self.lock = threading.Lock()
+        self.conns = []
+        self.commands = []
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.bind(self.path)
+        self.sock.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        """Stops the daemon, closing the connections of all clients. Like a daemon that
+        has been killed, it leaves its (now stale) socket behind."""
+        # Shutting the socket down wakes up the thread blocked accepting connections on
+        # it, which would otherwise keep it open
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+        with self.lock:
+            for conn in self.conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    # Already closed by the client
+                    pass
+            self.conns = []
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.conns.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        node = "view"
+        buf = b""
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                conn.close()
+                return
+            buf += data
+            while b"\0" in buf:
+                command, buf = buf.split(b"\0", 1)
+                command = command.decode()
+                with self.lock:
+                    self.commands.append((node, command))
+                node, status, output = self._execute(node, command)
+                try:
+                    conn.sendall(output.encode() + b"\0\0\0" + bytes([status]))
+                except OSError:
+                    return
+
+    def _execute(self, node, command):
+        """Returns the node after executing a command, along with its return code and
+        output"""
+        # Like in FRR, commands of the enable node can be run from the config node
+        if command.startswith("do ") and node != "view":
+            return (node,) + self._execute("enable", command[3:])[1:]
+        if node == "view" and command == "enable":
+            return "enable", self.CMD_SUCCESS, ""
+        if node == "enable" and command == "configure terminal":
+            return "config", self.CMD_SUCCESS, ""
+        if node == "enable" and command == "write terminal":
+            return node, self.CMD_SUCCESS, self.config
+        if node == "config" and command == "end":
+            return "enable", self.CMD_SUCCESS, ""
+        if node == "config" and command.startswith(self.fails):
+            return node, self.CMD_WARNING, f"% Failed: {command}\n"
+        if node == "config" and command.startswith(self.accepts):
+            return node, self.CMD_SUCCESS, ""
+        return node, self.CMD_ERR_NO_MATCH, f"% Unknown command: {command}\n"
+
+
+class Subprocess:
+    """Stands in for the subprocess module as used by evpn_agent.utils and
+    evpn_agent.iproute2, dispatching the commands to the fakes"""
+
+    CalledProcessError = subprocess.CalledProcessError
+
+    def __init__(self, kernel, frr):
+        self.kernel = kernel
+        self.frr = frr
+
+    def run(self, args, *, check=False, capture_output=False, text=False, input=None):
+        tool = os.path.basename(args[0])
+        if tool in ("ip", "bridge") and list(args[1:]) == ["-force", "-batch", "-"]:
+            if not text:
+                input = input.decode()
+            returncode, stderr = batch(self.kernel, tool, input)
+        elif tool == "vtysh" and args[1:2] == ["-f"]:
+            with open(args[2]) as f:
+                errors = self.frr.configure(f.read())
+            returncode = 1 if errors else 0
+            stderr = "".join(f"line {n}: {message}\n" for n, message in errors)
+        else:
+            raise FileNotFoundError(f"No such file or directory: {args[0]!r}")
+        proc = subprocess.CompletedProcess(
+            args, returncode, "" if text else b"", stderr if text else stderr.encode()
+        )
+        if check:
+            proc.check_returncode()
+        return proc
+
+
+def install(*, kernel, frr, backend="iproute2"):
+    """Hooks the fakes into the agent's modules, using the given dataplane backend"""
+    global frr_daemons
+    dataplane.backend = kernel if backend == "simulated" else Iproute2(kernel)
+    utils.subprocess = iproute2.subprocess = Subprocess(kernel, frr)
+    frr_daemons = frr
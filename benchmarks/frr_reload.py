@@ -0,0 +1,131 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A stand-in for FRR's frr-reload.py, implementing only the parts of it used by the
+# agent (see FrrManager), which the benchmarks point the frr_reload option at. The
+# running config is read from the simulated FRR daemons installed by fakes.install().
+# Configs are parsed into contexts the same way as by the real thing, albeit only for
+# the kinds of config the agent generates.
+
+from collections import OrderedDict
+
+import fakes
+from fakes import Frr
+
+
+class VtyshException(Exception):
+    pass
+
+
+class Vtysh:
+    common_args = ["vtysh"]
+
+    def __call__(self, command, stdouts=None):
+        if command != "show running-config":
+            raise VtyshException(f"Unsupported command: {command}")
+        return fakes.frr_daemons.show_running_config()
+
+    def mark_file(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def mark_show_run(self, daemon=None):
+        return fakes.frr_daemons.show_running_config()
+
+
+class Context:
+    def __init__(self, keys, lines):
+        self.keys = keys
+        self.lines = lines
+
+
+class Config:
+    def __init__(self, vtysh):
+        self.vtysh = vtysh
+        self.lines = []
+        self.contexts = OrderedDict()
+
+    def load_from_file(self, filename):
+        self._load(self.vtysh.mark_file(filename))
+
+    def load_from_show_running(self, daemon):
+        self._load(self.vtysh.mark_show_run(daemon))
+
+    def _load(self, text):
+        for line in text.splitlines():
+            line = " ".join(line.split())
+            if ":" in line:
+                line = get_normalized_ipv6_line(line)
+            self.lines.append(line)
+        self.load_contexts()
+
+    def load_contexts(self):
+        self.contexts = OrderedDict()
+        keys = ()
+        for line in self.lines:
+            if not line or line.startswith("!"):
+                continue
+            if line in Frr.EXITS:
+                keys = keys[:1] if line == "exit-address-family" else ()
+            elif line.startswith(Frr.TOP_LEVEL) or not keys:
+                keys = (line,)
+                self.contexts.setdefault(keys, Context(keys, []))
+                if not Frr.is_context(line):
+                    keys = ()
+            elif line.startswith(Frr.SUB_CONTEXTS):
+                keys = keys[:1] + (line,)
+                self.contexts.setdefault(keys, Context(keys, []))
+            else:
+                self.contexts[keys].lines.append(line)
+
+
+def get_normalized_ipv6_line(line):
+    return line
+
+
+def compare_context_objects(newconf, running):
+    add = []
+    delete = []
+    for keys, context in running.contexts.items():
+        if keys not in newconf.contexts:
+            # Sub-contexts go away along with their parent
+            if len(keys) == 1 or keys[:1] in newconf.contexts:
+                delete.append((keys, None))
+            continue
+        for line in context.lines:
+            if line not in newconf.contexts[keys].lines:
+                delete.append((keys, line))
+    for keys, context in newconf.contexts.items():
+        if keys not in running.contexts:
+            add.append((keys, None))
+            add.extend((keys, line) for line in context.lines)
+            continue
+        for line in context.lines:
+            if line not in running.contexts[keys].lines:
+                add.append((keys, line))
+    return add, delete
+
+
+def lines_to_config(ctx_keys, line, delete):
+    if line is None:
+        lines = list(ctx_keys)
+        if delete:
+            lines[-1] = "no " + lines[-1]
+        return lines
+    if delete:
+        line = line[3:] if line.startswith("no ") else "no " + line
+    return list(ctx_keys) + [line]
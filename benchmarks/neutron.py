@@ -0,0 +1,554 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A synthetic Neutron database for the benchmarks. This consists of the subset of the
+# Neutron schema queried by the agent's inventory module, a generator that fills it
+# with a deterministic data set of a given scale, and a stand-in for pymysql that
+# runs the agent's queries against an SQLite database, so that no MySQL/MariaDB
+# server is needed. A real server may be used instead, see run.py.
+
+from datetime import datetime, timezone
+import ipaddress
+import math
+import re
+import sqlite3
+import types
+import zlib
+
+SCHEMA = """
+CREATE TABLE standardattributes (
+    id BIGINT NOT NULL PRIMARY KEY,
+    resource_type VARCHAR(255) NOT NULL,
+    revision_number BIGINT NOT NULL DEFAULT 0,
+    created_at DATETIME NOT NULL,
+    updated_at DATETIME
+);
+CREATE TABLE networks (
+    id VARCHAR(36) NOT NULL PRIMARY KEY,
+    name VARCHAR(255),
+    mtu INTEGER NOT NULL,
+    standard_attr_id BIGINT NOT NULL
+);
+CREATE TABLE networksegments (
+    id VARCHAR(36) NOT NULL PRIMARY KEY,
+    network_id VARCHAR(36) NOT NULL,
+    network_type VARCHAR(32) NOT NULL,
+    physical_network VARCHAR(64),
+    segmentation_id INTEGER,
+    standard_attr_id BIGINT NOT NULL
+);
+CREATE INDEX networksegments_network_id ON networksegments (network_id);
+CREATE TABLE evpnnetworks (
+    id VARCHAR(36) NOT NULL PRIMARY KEY,
+    l2vni INTEGER,
+    l3vni INTEGER,
+    advertise_connected BOOLEAN
+);
+CREATE TABLE address_scopes (
+    id VARCHAR(36) NOT NULL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    ip_version INTEGER NOT NULL,
+    standard_attr_id BIGINT NOT NULL
+);
+CREATE TABLE subnetpools (
+    id VARCHAR(36) NOT NULL PRIMARY KEY,
+    name VARCHAR(255),
+    ip_version INTEGER NOT NULL,
+    address_scope_id VARCHAR(36),
+    standard_attr_id BIGINT NOT NULL
+);
+CREATE TABLE subnets (
+    id VARCHAR(36) NOT NULL PRIMARY KEY,
+    network_id VARCHAR(36) NOT NULL,
+    ip_version INTEGER NOT NULL,
+    cidr VARCHAR(64) NOT NULL,
+    gateway_ip VARCHAR(64),
+    enable_dhcp BOOLEAN,
+    ipv6_ra_mode VARCHAR(16),
+    ipv6_address_mode VARCHAR(16),
+    subnetpool_id VARCHAR(36),
+    standard_attr_id BIGINT NOT NULL
+);
+CREATE INDEX subnets_network_id ON subnets (network_id);
+CREATE TABLE subnetroutes (
+    destination VARCHAR(64) NOT NULL,
+    nexthop VARCHAR(64) NOT NULL,
+    subnet_id VARCHAR(36) NOT NULL,
+    PRIMARY KEY (destination, nexthop, subnet_id)
+);
+CREATE INDEX subnetroutes_subnet_id ON subnetroutes (subnet_id);
+CREATE TABLE ports (
+    id VARCHAR(36) NOT NULL PRIMARY KEY,
+    network_id VARCHAR(36) NOT NULL,
+    mac_address VARCHAR(32) NOT NULL,
+    device_id VARCHAR(255) NOT NULL,
+    device_owner VARCHAR(255) NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    standard_attr_id BIGINT NOT NULL
+);
+CREATE INDEX ports_network_id ON ports (network_id);
+CREATE INDEX ports_device_id ON ports (device_id);
+CREATE TABLE ipallocations (
+    port_id VARCHAR(36),
+    ip_address VARCHAR(64) NOT NULL,
+    subnet_id VARCHAR(36) NOT NULL,
+    network_id VARCHAR(36) NOT NULL,
+    PRIMARY KEY (ip_address, subnet_id, network_id)
+);
+CREATE INDEX ipallocations_port_id ON ipallocations (port_id);
+CREATE TABLE ml2_port_bindings (
+    port_id VARCHAR(36) NOT NULL,
+    host VARCHAR(255) NOT NULL,
+    vif_type VARCHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    PRIMARY KEY (port_id, host)
+);
+CREATE INDEX ml2_port_bindings_host ON ml2_port_bindings (host);
+CREATE TABLE floatingips (
+    id VARCHAR(36) NOT NULL PRIMARY KEY,
+    floating_ip_address VARCHAR(64) NOT NULL,
+    floating_network_id VARCHAR(36) NOT NULL,
+    floating_port_id VARCHAR(36) NOT NULL,
+    fixed_port_id VARCHAR(36),
+    fixed_ip_address VARCHAR(64),
+    router_id VARCHAR(36),
+    standard_attr_id BIGINT NOT NULL
+);
+CREATE INDEX floatingips_fixed_port_id ON floatingips (fixed_port_id);
+"""
+
+TABLES = re.findall(r"CREATE TABLE (\w+)", SCHEMA)
+
+# The first VLAN ID, L2VNI and L3VNI handed out
+FIRST_VLAN = 100
+FIRST_L2VNI = 10000
+FIRST_L3VNI = 50000
+
+# The time all the synthetic resources were last updated
+EPOCH = datetime(2025, 1, 1)
+
+
+class Generator:
+    """Generates a Neutron data set with the given number of networks and ports bound
+    to the given host, as rows to be inserted per table. The ports are spread evenly
+    across the networks, and each port has an IPv4 and an IPv6 address. Every network
+    is dual stack, has a subnet route, and is attached to a VRF shared by up to
+    networks_per_vrf networks (every tenth network leaks its routes to the underlay
+    instead). Each VRF has a router with a tenant network behind it in the same
+    address scope as the provider network. Ports bound to other hosts and inactive
+    ports are generated as well, the latter so that they can be activated later."""
+
+    def __init__(
+        self,
+        *,
+        host,
+        networks,
+        ports,
+        floatingips=0,
+        inactive_ports=0,
+        remote_ports=0,
+        networks_per_vrf=10,
+        physnet="physnet1",
+    ):
+        if not 1 <= networks <= 4094 - FIRST_VLAN:
+            raise ValueError(f"Unsupported number of networks: {networks}")
+        self.host = host
+        self.physnet = physnet
+        self.networks_per_vrf = networks_per_vrf
+        self.rows = {table: [] for table in TABLES}
+        self.next_attr = 0
+        self.next_mac = 0
+
+        # Size the IPv4 subnets so that they fit all the addresses handed out
+        per_network = math.ceil(
+            (ports + floatingips + inactive_ports + remote_ports) / networks
+        )
+        prefixlen = min(32 - math.ceil(math.log2(per_network + 16)), 24)
+        v4 = ipaddress.ip_network("10.0.0.0/8").subnets(new_prefix=prefixlen)
+
+        self.scope = self._add(
+            "address_scopes", "addressscope", id="scope-1", name="scope", ip_version=4
+        )
+        self.pool = self._add(
+            "subnetpools",
+            "subnetpool",
+            id="pool-1",
+            name="pool",
+            ip_version=4,
+            address_scope_id="scope-1",
+        )
+
+        self.nets = []
+        for i in range(networks):
+            self.nets.append(self._network(i, next(v4)))
+
+        self._ports(ports, host=host, status="ACTIVE")
+        self._ports(remote_ports, host="remote-" + host, status="ACTIVE")
+        self.inactive = self._ports(inactive_ports, host=host, status="DOWN")
+        self._floatingips(floatingips)
+
+    def _add(self, table, resource_type=None, **row):
+        if resource_type:
+            self.next_attr += 1
+            self.rows["standardattributes"].append(
+                {
+                    "id": self.next_attr,
+                    "resource_type": resource_type,
+                    "revision_number": 1,
+                    "created_at": EPOCH,
+                    "updated_at": EPOCH,
+                }
+            )
+            row["standard_attr_id"] = self.next_attr
+        self.rows[table].append(row)
+        return row
+
+    def _mac(self):
+        self.next_mac += 1
+        return "fa:16:3e:" + ":".join(
+            f"{(self.next_mac >> shift) & 0xFF:02x}" for shift in (16, 8, 0)
+        )
+
+    def _network(self, i, v4):
+        vid = FIRST_VLAN + i
+        net_id = f"net-{i}"
+        self._add("networks", "networks", id=net_id, name=net_id, mtu=1500)
+        self._add(
+            "networksegments",
+            "networksegments",
+            id=f"seg-{i}",
+            network_id=net_id,
+            network_type="vlan",
+            physical_network=self.physnet,
+            segmentation_id=vid,
+        )
+        vrf = i // self.networks_per_vrf
+        self._add(
+            "evpnnetworks",
+            id=net_id,
+            l2vni=FIRST_L2VNI + vid,
+            l3vni=0 if i % 10 == 9 else FIRST_L3VNI + vrf,
+            advertise_connected=i % 2,
+        )
+
+        v6 = ipaddress.ip_network(f"2001:db8:{i:x}::/64")
+        hosts = {4: v4.hosts(), 6: v6.hosts()}
+        gateways = {4: next(hosts[4]), 6: next(hosts[6])}
+        for version, cidr in ((4, v4), (6, v6)):
+            self._add(
+                "subnets",
+                "subnets",
+                id=f"subnet-{i}-v{version}",
+                network_id=net_id,
+                ip_version=version,
+                cidr=str(cidr),
+                gateway_ip=str(gateways[version]),
+                enable_dhcp=1,
+                ipv6_ra_mode="slaac" if version == 6 else None,
+                ipv6_address_mode="slaac" if version == 6 else None,
+                subnetpool_id="pool-1" if version == 4 else None,
+            )
+
+        net = {"id": net_id, "index": i, "hosts": hosts, "ports": []}
+
+        # The first network of each VRF has a router, with a tenant network in the
+        # same address scope behind it
+        if i % self.networks_per_vrf == 0:
+            router = f"router-{vrf}"
+            self._port(net, device_id=router, device_owner="network:router_gateway")
+            tenant = f"tenant-{vrf}"
+            self._add("networks", "networks", id=tenant, name=tenant, mtu=1450)
+            self._add(
+                "networksegments",
+                "networksegments",
+                id=f"seg-{tenant}",
+                network_id=tenant,
+                network_type="vxlan",
+                physical_network=None,
+                segmentation_id=vrf + 1,
+            )
+            cidr = ipaddress.ip_network(f"172.{16 + vrf // 256}.{vrf % 256}.0/24")
+            self._add(
+                "subnets",
+                "subnets",
+                id=f"subnet-{tenant}",
+                network_id=tenant,
+                ip_version=4,
+                cidr=str(cidr),
+                gateway_ip=str(cidr[1]),
+                enable_dhcp=1,
+                ipv6_ra_mode=None,
+                ipv6_address_mode=None,
+                subnetpool_id="pool-1",
+            )
+            port = self._add(
+                "ports",
+                "ports",
+                id=f"port-{tenant}",
+                network_id=tenant,
+                mac_address=self._mac(),
+                device_id=router,
+                device_owner="network:router_interface",
+                status="ACTIVE",
+            )
+            self._add(
+                "ipallocations",
+                port_id=port["id"],
+                ip_address=str(cidr[1]),
+                subnet_id=f"subnet-{tenant}",
+                network_id=tenant,
+            )
+
+        # A static route via the first port on the network, and every fifth network
+        # has a dynamic BGP listener as well
+        self._add(
+            "subnetroutes",
+            destination=f"192.168.{i % 256}.{i // 256 * 16}/28",
+            nexthop=str(v4[3]),
+            subnet_id=f"subnet-{i}-v4",
+        )
+        if i % 5 == 0:
+            self._add(
+                "subnetroutes",
+                destination=f"198.18.{i % 256}.{i // 256 * 16}/28",
+                nexthop="0.179.28.32",
+                subnet_id=f"subnet-{i}-v4",
+            )
+        return net
+
+    def _port(self, net, *, device_id, device_owner, host=None, status="ACTIVE"):
+        port = self._add(
+            "ports",
+            "ports",
+            id=f"port-{self.next_mac + 1}",
+            network_id=net["id"],
+            mac_address=self._mac(),
+            device_id=device_id,
+            device_owner=device_owner,
+            status=status,
+        )
+        for version in (4, 6):
+            self._add(
+                "ipallocations",
+                port_id=port["id"],
+                ip_address=str(next(net["hosts"][version])),
+                subnet_id=f"subnet-{net['index']}-v{version}",
+                network_id=net["id"],
+            )
+        self._add(
+            "ml2_port_bindings",
+            port_id=port["id"],
+            host=host or self.host,
+            vif_type="ovs",
+            status=status,
+        )
+        return port
+
+    def _ports(self, count, *, host, status):
+        return [
+            self._port(
+                self.nets[n % len(self.nets)],
+                device_id=f"vm-{self.next_mac + 1}",
+                device_owner="compute:nova",
+                host=host,
+                status=status,
+            )
+            for n in range(count)
+        ]
+
+    def _floatingips(self, count):
+        fixed = [
+            port
+            for port in self.rows["ports"]
+            if port["device_owner"] == "compute:nova" and port["status"] == "ACTIVE"
+        ]
+        for n in range(min(count, len(fixed))):
+            net = self.nets[n % len(self.nets)]
+            floating = self._add(
+                "ports",
+                "ports",
+                id=f"port-fip-{n}",
+                network_id=net["id"],
+                mac_address=self._mac(),
+                device_id=f"fip-{n}",
+                device_owner="network:floatingip",
+                status="N/A",
+            )
+            self._add(
+                "floatingips",
+                "floatingips",
+                id=f"fip-{n}",
+                floating_ip_address=str(next(net["hosts"][4])),
+                floating_network_id=net["id"],
+                floating_port_id=floating["id"],
+                fixed_port_id=fixed[n]["id"],
+                fixed_ip_address=None,
+                router_id=None,
+            )
+
+
+def create(conn, generator, placeholder):
+    """Creates the schema and loads a generated data set into a DB-API connection,
+    replacing any existing tables. The placeholder is the connection's parameter
+    marker (e.g., "?" for sqlite3, "%s" for pymysql)."""
+    cur = conn.cursor()
+    for table in reversed(TABLES):
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+    for statement in SCHEMA.split(";"):
+        if statement.strip():
+            cur.execute(statement)
+    for table, rows in generator.rows.items():
+        if not rows:
+            continue
+        columns = list(rows[0])
+        cur.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join([placeholder] * len(columns))})",
+            [tuple(row[column] for column in columns) for row in rows],
+        )
+    conn.commit()
+
+
+def activate(conn, ports, placeholder, *, status="ACTIVE"):
+    """Changes the status of the given ports the way Neutron does when they are
+    activated (or deactivated), bumping their revision numbers and update times"""
+    # Neutron stores timestamps in UTC, with one second resolution
+    updated_at = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    cur = conn.cursor()
+    for port in ports:
+        cur.execute(
+            f"UPDATE ports SET status = {placeholder} WHERE id = {placeholder}",
+            (status, port["id"]),
+        )
+        cur.execute(
+            f"UPDATE ml2_port_bindings SET status = {placeholder} "
+            f"WHERE port_id = {placeholder}",
+            (status, port["id"]),
+        )
+        cur.execute(
+            "UPDATE standardattributes "
+            "SET revision_number = revision_number + 1, "
+            f"updated_at = {placeholder} WHERE id = {placeholder}",
+            (updated_at, port["standard_attr_id"]),
+        )
+    conn.commit()
+
+
+# The SQLite stand-in for pymysql, which is installed as sys.modules["pymysql"] by
+# run.py, and only implements what the inventory module uses. The MySQL specific
+# functions used in the queries are provided as user defined functions, the pyformat
+# parameters are translated into named ones, with tuples expanded for use with IN,
+# and datetime values are returned as datetime objects like pymysql would.
+class BitXor:
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= value
+
+    def finalize(self):
+        return self.value
+
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+
+
+def _concat_ws(separator, *values):
+    return separator.join(str(v) for v in values if v is not None)
+
+
+def _crc32(value):
+    return None if value is None else zlib.crc32(str(value).encode())
+
+
+class DictCursor:
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+        self.rows = []
+
+    def execute(self, sql, param=None):
+        params = {}
+
+        def substitute(match):
+            name = match.group(1)
+            value = param[name]
+            if isinstance(value, (tuple, list, set, frozenset)):
+                names = []
+                for n, item in enumerate(value):
+                    params[f"{name}_{n}"] = item
+                    names.append(f":{name}_{n}")
+                return "(" + ", ".join(names) + ")"
+            params[name] = value
+            return ":" + name
+
+        sql = re.sub(r"%\((\w+)\)s", substitute, sql)
+        self.cursor.execute(sql, params)
+        columns = [column[0] for column in self.cursor.description or ()]
+        self.rows = [
+            {
+                column: (
+                    datetime.fromisoformat(value)
+                    if column.endswith("_at") and isinstance(value, str)
+                    else value
+                )
+                for column, value in zip(columns, row)
+            }
+            for row in self.cursor.fetchall()
+        ]
+        return len(self.rows)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Connection:
+    def __init__(self, database):
+        self.conn = sqlite3.connect(database, check_same_thread=False)
+        self.conn.create_function("CONCAT_WS", -1, _concat_ws)
+        self.conn.create_function("CRC32", 1, _crc32)
+        self.conn.create_aggregate("BIT_XOR", 1, BitXor)
+
+    def cursor(self, cursorclass=DictCursor):
+        return DictCursor(self.conn)
+
+    def commit(self):
+        self.conn.commit()
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+def sqlite_pymysql(path):
+    """Returns a module that may pose as pymysql, connecting to the given SQLite
+    database regardless of the connection parameters"""
+    module = types.ModuleType("pymysql")
+    module.connect = lambda **kwargs: Connection(path)
+    module.cursors = types.SimpleNamespace(DictCursor=DictCursor)
+    return module
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Benchmarks the agent at a given scale, against a synthetic Neutron database (see
+# neutron.py), the simulated kernel and in-memory fakes of FRR and OVS (see fakes.py),
+# reporting the results as JSON. See README.md.
+
+from datetime import datetime, timezone
+import json
+import logging
+import optparse
+import os
+import resource
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "src"))
+
+import neutron  # noqa: E402
+
+SCALES = {
+    "small": {"networks": 10, "ports": 1000},
+    "medium": {"networks": 100, "ports": 10000},
+    "large": {"networks": 1000, "ports": 50000},
+}
+
+# The static FRR config, which the simulated FRR daemons start out with as well
+FRR_CONF = """\
+frr defaults datacenter
+hostname evpn-benchmark
+router bgp 65000
+ bgp router-id 192.0.2.1
+ neighbor fabric peer-group
+ neighbor fabric remote-as external
+ address-family l2vpn evpn
+  neighbor fabric activate
+  advertise-all-vni
+ exit-address-family
+exit
+"""
+
+parser = optparse.OptionParser(
+    usage="%prog [options]",
+    description="Benchmarks the agent against a synthetic Neutron database and an "
+    "in-memory fake dataplane, writing the results as a JSON list with one object "
+    "per scale.",
+)
+parser.add_option(
+    "-s",
+    "--scale",
+    dest="scale",
+    default="small",
+    help="Comma separated list of scales to run, out of "
+    + ", ".join(f"{k} ({v['networks']}/{v['ports']})" for k, v in SCALES.items())
+    + " networks/ports [default: %default]",
+)
+parser.add_option(
+    "--networks", dest="networks", type="int", help="Run a custom scale instead"
+)
+parser.add_option(
+    "--ports", dest="ports", type="int", help="Run a custom scale instead"
+)
+parser.add_option(
+    "--floatingips",
+    dest="floatingips",
+    type="int",
+    help="Number of floating IPs [default: 10% of the ports]",
+)
+parser.add_option(
+    "--remote-ports",
+    dest="remote_ports",
+    type="int",
+    default=0,
+    help="Number of ports bound to another host [default: %default]",
+)
+parser.add_option(
+    "--churn",
+    dest="churn",
+    type="int",
+    help="Number of ports activated and deactivated again [default: 1% of the ports]",
+)
+parser.add_option(
+    "-n",
+    "--iterations",
+    dest="iterations",
+    type="int",
+    default=20,
+    help="Number of idle iterations to time [default: %default]",
+)
+parser.add_option(
+    "--dataplane",
+    dest="dataplane",
+    type="choice",
+    choices=["iproute2", "simulated"],
+    default="iproute2",
+    help="The dataplane backend of the agent, either iproute2 (executing the "
+    "commands it generates on the simulated kernel) or simulated (using the "
+    "simulated kernel directly) [default: %default]",
+)
+parser.add_option(
+    "--mysql",
+    dest="mysql",
+    metavar="HOST",
+    help="Use a MySQL/MariaDB server instead of SQLite. The database is dropped and "
+    "recreated!",
+)
+parser.add_option("--db-user", dest="db_user", default="root")
+parser.add_option("--db-password", dest="db_password", default="")
+parser.add_option("--db-name", dest="db_name", default="evpn_agent_benchmark")
+parser.add_option(
+    "--trace-memory",
+    dest="trace_memory",
+    default=False,
+    action="store_true",
+    help="Report the peak memory allocated by Python as well (slow)",
+)
+parser.add_option(
+    "--loglevel",
+    dest="loglevel",
+    default="ERROR",
+    help="Log level of the agent [default: %default]",
+)
+parser.add_option(
+    "-o",
+    "--output",
+    dest="output",
+    default="-",
+    help="File to write the results to [default: standard output]",
+)
+
+
+def scales(opts):
+    """Returns the (name, networks, ports) of the scales to run"""
+    if opts.networks or opts.ports:
+        return [("custom", opts.networks or 10, opts.ports or 1000)]
+    try:
+        return [
+            (name, SCALES[name]["networks"], SCALES[name]["ports"])
+            for name in opts.scale.split(",")
+        ]
+    except KeyError as e:
+        parser.error(f"Unknown scale {e}")
+
+
+class Probe:
+    """Takes snapshots of everything counted by the simulated kernel, the fakes and the
+    agent's metrics, so that the operations executed, commands run and queries made by
+    each step can be reported"""
+
+    def __init__(self, kernel, frr, ovsdb):
+        self.kernel = kernel
+        self.frr = frr
+        self.ovsdb = ovsdb
+
+    def snapshot(self):
+        from evpn_agent import metrics
+
+        return {
+            "commands": {
+                **self.kernel.counts,
+                **self.frr.counts,
+                **{f"ovsdb {k}": v for k, v in self.ovsdb.counts.items()},
+            },
+            "processes": {k[0]: v for k, v in metrics.commands.values.items()},
+            "db_queries": sum(metrics.db_queries.values.values()),
+            "failures": len(self.kernel.failures),
+        }
+
+    def measure(self, func):
+        """Calls func, returning its result along with its duration and the commands
+        executed and queries made meanwhile"""
+        before = self.snapshot()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        after = self.snapshot()
+        step = {"seconds": round(elapsed, 6)}
+        for key in ("commands", "processes"):
+            step[key] = {
+                k: v - before[key].get(k, 0)
+                for k, v in sorted(after[key].items())
+                if v != before[key].get(k, 0)
+            }
+        step["db_queries"] = after["db_queries"] - before["db_queries"]
+        step["failures"] = after["failures"] - before["failures"]
+        return result, step
+
+
+def mutations(step):
+    """Returns the number of changes made to the kernel, FRR and OVS by a step"""
+    return sum(
+        v
+        for k, v in step["commands"].items()
+        if k not in ("vtysh -f", "ovsdb monitor", "ovsdb echo")
+    )
+
+
+def benchmark(opts, name, networks, ports):
+    """Runs the benchmark at a single scale, in this process"""
+    workdir = tempfile.TemporaryDirectory(prefix="evpn_agent_benchmark.")
+    result = {
+        "scale": {
+            "name": name,
+            "networks": networks,
+            "ports": ports,
+            "floatingips": (
+                ports // 10 if opts.floatingips is None else opts.floatingips
+            ),
+            "remote_ports": opts.remote_ports,
+            "churn": max(ports // 100, 1) if opts.churn is None else opts.churn,
+        },
+        "database": "mysql" if opts.mysql else "sqlite",
+        "dataplane": opts.dataplane,
+        "python": sys.version.split()[0],
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": revision(),
+    }
+
+    # Generate the data set and load it into the database
+    start = time.perf_counter()
+    generator = neutron.Generator(
+        host=socket.getfqdn(),
+        networks=networks,
+        ports=ports,
+        floatingips=result["scale"]["floatingips"],
+        inactive_ports=result["scale"]["churn"],
+        remote_ports=opts.remote_ports,
+    )
+    if opts.mysql:
+        import pymysql
+
+        conn = pymysql.connect(
+            host=opts.mysql, user=opts.db_user, password=opts.db_password
+        )
+        with conn.cursor() as cur:
+            cur.execute(f"DROP DATABASE IF EXISTS {opts.db_name}")
+            cur.execute(f"CREATE DATABASE {opts.db_name}")
+        conn.select_db(opts.db_name)
+        placeholder = "%s"
+    else:
+        path = os.path.join(workdir.name, "neutron.sqlite")
+        conn = sqlite3.connect(path)
+        placeholder = "?"
+        sys.modules["pymysql"] = neutron.sqlite_pymysql(path)
+        sys.modules["pymysql.cursors"] = sys.modules["pymysql"].cursors
+    neutron.create(conn, generator, placeholder)
+    result["setup_seconds"] = round(time.perf_counter() - start, 6)
+    result["rows"] = {t: len(rows) for t, rows in generator.rows.items()}
+
+    # Set up the agent and the fakes
+    import fakes
+    from evpn_agent import agent
+    from evpn_agent.simkernel import SimulatedKernel
+    from evpn_agent.config import conf
+
+    conf["agent"]["loglevel"] = opts.loglevel
+    conf["agent"]["frr_config"] = os.path.join(workdir.name, "frr.conf")
+    conf["agent"]["frr_reload"] = os.path.join(HERE, "frr_reload.py")
+    conf["ovs"]["db_socket"] = os.path.join(workdir.name, "db.sock")
+    if opts.mysql:
+        conf["db"].update(
+            host=opts.mysql,
+            user=opts.db_user,
+            password=opts.db_password,
+            database=opts.db_name,
+        )
+    logging.basicConfig(
+        format=agent.logfmt, level=opts.loglevel.upper(), stream=sys.stderr
+    )
+    with open(conf["agent"]["frr_config"], "w") as f:
+        f.write(FRR_CONF)
+    kernel = SimulatedKernel()
+    frr = fakes.Frr()
+    frr.configure(FRR_CONF)
+    frr.counts.clear()
+    ovsdb = fakes.OvsdbServer(conf["ovs"]["db_socket"], [conf["ovs"]["name"], "br-int"])
+    fakes.install(kernel=kernel, frr=frr, backend=opts.dataplane)
+    probe = Probe(kernel, frr, ovsdb)
+
+    if opts.trace_memory:
+        tracemalloc.start()
+    max_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Cold start on an empty host, i.e., the start-up of the agent followed by the
+    # first iteration of the main loop, which provisions everything
+    _, init = probe.measure(agent.init)
+    _, first = probe.measure(agent.iterate)
+    result["cold_start"] = {
+        "seconds": round(init["seconds"] + first["seconds"], 6),
+        "init": init,
+        "first_iteration": first,
+    }
+
+    # A full iteration (a periodic resync) once everything is in place, which should
+    # not change anything
+    agent.next_resync = 0
+    _, resync = probe.measure(agent.iterate)
+    result["resync"] = resync
+    result["converged"] = mutations(resync) == 0
+
+    # Idle iterations, which should be skipped as nothing changes
+    samples = []
+    for _ in range(opts.iterations):
+        changed, step = probe.measure(agent.iterate)
+        if changed:
+            result["converged"] = False
+        samples.append(step["seconds"])
+    if samples:
+        result["idle"] = {
+            "iterations": len(samples),
+            "min_seconds": min(samples),
+            "median_seconds": statistics.median(samples),
+            "max_seconds": max(samples),
+        }
+
+    # Churn: a batch of ports is activated, and deactivated again
+    ports = generator.inactive
+    neutron.activate(conn, ports, placeholder)
+    _, result["churn_activate"] = probe.measure(agent.iterate)
+    neutron.activate(conn, ports, placeholder, status="DOWN")
+    _, result["churn_deactivate"] = probe.measure(agent.iterate)
+
+    # Repair: a link goes missing, which is repaired without querying the database
+    link = min(name for name in kernel.links if name.startswith("l2vni-"))
+    kernel.del_link(name=link)
+    _, result["repair"] = probe.measure(agent.repair)
+    result["repair"]["repaired"] = link in kernel.links
+
+    result["objects"] = {
+        "links": len(kernel.links),
+        "addresses": len(kernel.addresses),
+        "neighs": len(kernel.neighs),
+        "routes": len(kernel.routes),
+        "fdb": len(kernel.fdb),
+        "vlans": sum(len(vlans) for vlans in kernel.vlans.values()),
+        "frr_contexts": len(frr.contexts),
+        "ovs_ports": len(ovsdb.port_names(conf["ovs"]["name"])),
+    }
+    result["failures"] = kernel.failures[:20]
+    # Links in addrgenmode none should never have had a link-local address generated,
+    # which happens if they are set up before their addrgenmode has been set
+    result["stray_link_locals"] = sorted(
+        f"{address.local} on {address.ifname}"
+        for address in kernel.addresses.values()
+        if address.family == "inet6"
+        and address.scope == "link"
+        and kernel.links[address.ifname].inet6_addr_gen_mode == "none"
+    )
+    result["memory"] = {
+        "max_rss_before_kib": max_rss_before,
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if opts.trace_memory:
+        result["memory"]["python_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "-C", HERE, "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def passthrough(opts):
+    """Returns the command line options to pass on to the process running a scale"""
+    args = []
+    for option in parser.option_list:
+        if option.dest in (None, "scale", "networks", "ports", "output"):
+            continue
+        value = getattr(opts, option.dest)
+        if value is None or value is False:
+            continue
+        args.append(option.get_opt_string())
+        if option.action != "store_true":
+            args.append(str(value))
+    return args
+
+
+def main():
+    opts, _ = parser.parse_args()
+    runs = scales(opts)
+    if len(runs) == 1:
+        results = [benchmark(opts, *runs[0])]
+    else:
+        # Every scale is run in a process of its own, so that they do not affect each
+        # other's memory usage
+        results = []
+        for name, _, _ in runs:
+            proc = subprocess.run(
+                [sys.executable, __file__, "--scale", name] + passthrough(opts),
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            results.extend(json.loads(proc.stdout))
+    output = json.dumps(results, indent=2) + "\n"
+    if opts.output == "-":
+        sys.stdout.write(output)
+    else:
+        with open(opts.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
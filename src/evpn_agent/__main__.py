@@ -16,3 +16,5 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from . import agent
+
+agent.main()
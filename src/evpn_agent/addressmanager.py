@@ -16,71 +16,99 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
-from .utils import cmd, jsoncmd
+from . import metrics
+from .dataplane import batch, dump_addresses, subscribe
+from .utils import claim, claimed
 
 log = logging.getLogger(__name__)
 
+# The addresses on each device by name, keyed by "address/prefixlen"
 state = dict()
-known_addresses = []
+known_addresses = {}
+
+
+def init():
+    # Ensure the cache is populated, and kept up to date afterwards
+    subscribe(handler=handle_event, update=update)
+    update()
 
 
 def update():
     global state
-    state = jsoncmd(["ip", "-j", "-d", "address", "show"])
+    state = {}
+    for address in dump_addresses():
+        state.setdefault(address.ifname, {})[_address(address)] = address
 
 
-def finalise():
-    global known_addresses
+def handle_event(kind, action, record):
+    if kind == "link":
+        if action == "new":
+            state.setdefault(record.ifname, {})
+        else:
+            state.pop(record.ifname, None)
+    elif kind == "address":
+        addresses = state.setdefault(record.ifname, {})
+        if action == "new":
+            addresses[_address(record)] = record
+        else:
+            addresses.pop(_address(record), None)
 
-    prune()
-    update()
 
-    known_addresses = []
+def forget(owner):
+    known_addresses.pop(owner, None)
+
+
+def dirty(owner):
+    return any(
+        not _is_present(dev=dev, address=address)
+        for (dev, address) in known_addresses.get(owner, {})
+    )
 
 
 def get_primary_loopback_ipv4():
-    lo = [dev for dev in state if dev["ifname"] == "lo"][0]
-    for ai in lo["addr_info"]:
-        if ai["family"] == "inet" and ai["scope"] == "global":
-            return ai["local"]
+    for ai in state.get("lo", {}).values():
+        if ai.family == "inet" and ai.scope == "global":
+            return ai.local
 
 
+@metrics.timed(metrics.ensure_duration, function="AddressManager.ensure_address")
 def ensure_address(*, dev, address):
     log.info(f"Ensuring IP address {address} on {dev}")
-    known_addresses.append({"dev": dev, "address": address})
-
-    # Check if address is already present
-    for device in state:
-        if device["ifname"] != dev:
-            continue
-        for ai in device["addr_info"]:
-            if ai["local"] == address.split("/")[0] and ai["prefixlen"] == int(
-                address.split("/")[1]
-            ):
-                log.debug(f"…already present, nothing to do")
-                return
+    claim(known_addresses, (dev, address))
+
+    if _is_present(dev=dev, address=address):
+        log.debug(f"…already present, nothing to do")
+        return
 
     log.warning(f"Adding address {address} to {dev}")
-    cmd(
-        ["ip", "address", "add", "dev", dev, address]
-        + (["nodad"] if ":" in address else [])
+    batch(
+        "add_address", dev=dev, address=address, resource=f"address {address} on {dev}"
     )
 
 
+@metrics.timed(metrics.phase_duration, phase="AddressManager.prune")
 def prune():
-    for device in state:
-        dev = device["ifname"]
-        if not dev.startswith("irb-"):
-            continue
-        for ai in device["addr_info"]:
-            # Leave IPv6 link-locals alone
-            if ai["family"] == "inet6" and ai["scope"] == "link":
-                continue
-            address = ai["local"] + "/" + str(ai["prefixlen"])
-            if {"dev": dev, "address": address} not in known_addresses:
-                log.warning(f"Removing orphan address {address} from {dev}")
-                cmd(["ip", "address", "del", "dev", dev, address])
-
-
-# Ensure the cache is populated during initial import
-update()
+    present = {
+        (dev, address)
+        for dev, addresses in state.items()
+        if dev.startswith("irb-")
+        for address, ai in addresses.items()
+        # Leave IPv6 link-locals alone
+        if not (ai.family == "inet6" and ai.scope == "link")
+    }
+    for dev, address in present - claimed(known_addresses).keys():
+        log.warning(f"Removing orphan address {address} from {dev}")
+        batch(
+            "del_address",
+            dev=dev,
+            address=address,
+            resource=f"orphan address {address} on {dev}",
+        )
+
+
+def _is_present(*, dev, address):
+    return address in state.get(dev, {})
+
+
+def _address(ai):
+    return ai.local + "/" + str(ai.prefixlen)
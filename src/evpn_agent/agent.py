@@ -15,18 +15,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+from datetime import datetime, timezone
+import hashlib
 from ipaddress import ip_address, ip_network
+import json
 import logging
+import random
+import signal
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+from . import config
+from . import metrics
+from . import profiler
 from .config import conf
 
 log = logging.getLogger(__name__)
 logfmt = "[%(filename)s:%(lineno)s → %(funcName)s()] %(message)s"
-logging.basicConfig(
-    format=logfmt, level=conf["agent"]["loglevel"].upper(), stream=sys.stdout
-)
 
 from . import addressmanager as AddressManager
 from . import bridgemanager as BridgeManager
@@ -36,18 +43,25 @@ from . import neighmanager as NeighManager
 from . import ovsmanager as OvsManager
 from . import routemanager as RouteManager
 from . import frrmanager as FrrManager
+from . import dataplane
+from .dataplane import BatchError, flush
+from .utils import claimed, owner
+
+# The managers of kernel resources, which are able to tell if any of the resources they
+# have been asked to ensure on behalf of a given owner have gone missing
+kernel_managers = (
+    AddressManager,
+    BridgeManager,
+    LinkManager,
+    NeighManager,
+    RouteManager,
+)
+managers = kernel_managers + (FrrManager,)
 
 
-# Main program loop. The basic work flow of the agent is to determine all the resources
-# that should be active on this particular hypervisor, use the ensure_foo() functions in
-# the various manager modules to ensure they are present, then finally garbage collect
-# any resource that were created previously but should no longer be active on this
-# hypervisor (e.g., a port belonging to a VM that has been deleted or migrated to
-# to another hypervisor.)
-while True:
-    # Ensure the main EVPN bridge exist and that it is connected to the OVS bridge via a
-    # veth pair.
-    log.info("Main loop: ensuring EVPN bridge and OVS downlink")
+def ensure_bridge():
+    """Ensures the main EVPN bridge exists, and that it is connected to the OVS bridge
+    via a veth pair"""
     LinkManager.ensure_link(
         name=conf["bridge"]["name"],
         type="bridge",
@@ -80,308 +94,741 @@ while True:
             "mtu": int(conf["bridge"]["mtu"]),
         },
     )
+    LinkManager.commit()
     OvsManager.ensure_veth()
 
-    # Load the ports once per loop, not once per network, saving us some db queries
-    ports = Inventory.get_ports()
 
-    # Loop through each network active on this hypervisor and ensure all of its
-    # resources are properly provisioned.
-    log.info("Main loop: evaluationg active networks")
-    for net in Inventory.get_networks():
-        log.info(f"Processing network: {net}")
-
-        vid = net["segmentation_id"]
-        mtu = net["mtu"]
-        l2vni = net["l2vni"]
-        l3vni = net["l3vni"]
-        advertise_connected = net["advertise_connected"]
-
-        # If the network has a L3VNI assigned, associate it to a VRF that is shared
-        # between all networks using that L3VNI. Otherwise, associate it to an isolated
-        # VLAN specific VRF (mostly useful in order to leak routes into the underlay)
-        vrf_id = l3vni if l3vni else vid
-        rt_table = vrf_id + int(conf["agent"]["rt_table_offset"])
-
-        # Ensure that the VLAN is added to the veth port (connected to the OVS bridge)
-        BridgeManager.ensure_vlan(vid=vid, dev=conf["bridge"]["veth"])
-
-        # The L2VNI might be configured explicitly per-VLAN, or implicitly through the
-        # 'l2vni_offset' agent configuration option.
-        if l2vni is None and "l2vni_offset" in conf["agent"]:
-            l2vni = vid + int(conf["agent"]["l2vni_offset"])
-
-        # If the network has an L2VNI assigned (or implicitly through the use of the
-        # 'l2vni_offset' agent option), then create a VXLAN device for that L2VNI, hook
-        # it up to the EVPN bridge, and ensure the network's VLAN ID is added to the
-        # L2VNI bridge port.
-        if l2vni:
-            log.info(f"Ensuring L2VNI {l2vni} for {net['id']} (VLAN {vid})")
-            devname = "l2vni-" + str(l2vni)
-            LinkManager.ensure_link(
-                name=devname,
-                type="vxlan",
-                link_attrs={
-                    "master": conf["bridge"]["name"],
-                    "inet6_addr_gen_mode": "none",
-                    "mtu": mtu,
-                    "ifalias": "L2VNI for " + net["id"],
-                },
-                type_attrs={
-                    "id": l2vni,
-                    "learning": False,
-                    "local": AddressManager.get_primary_loopback_ipv4(),
-                    "port": 4789,
-                },
-                bridge_slave_attrs={
-                    "learning": False,
-                    "neigh_suppress": True,
-                },
-            )
-            BridgeManager.ensure_vlan(vid=vid, dev=devname, tagged=False)
-
-        # Create an IRB device (also called SVI) for the network, ensure it can send
-        # and receive traffic to the network's VLAN tag, and finally add all gateway
-        # addresses to it with the correct prefix length. FRR will take care of
-        # advertising routes for the link prefixes into the EVPN fabric with BGP thanks
-        # to the "redistribute connected" setting.
-        log.info(f"Ensuring VRF/IRB/L3VNI for VRF {vrf_id}")
-        vrf = "vrf-" + str(vrf_id)
-        irb = "irb-" + str(vrf_id)
+def ensure_network(net, snapshot):
+    """Ensures all the resources belonging to a given network are provisioned"""
+    log.info(f"Processing network: {net}")
+
+    vid = net["segmentation_id"]
+    ports = snapshot.ports.get(vid, [])
+    mtu = net["mtu"]
+    l2vni = net["l2vni"]
+    l3vni = net["l3vni"]
+    advertise_connected = net["advertise_connected"]
+
+    # If the network has a L3VNI assigned, associate it to a VRF that is shared
+    # between all networks using that L3VNI. Otherwise, associate it to an isolated
+    # VLAN specific VRF (mostly useful in order to leak routes into the underlay)
+    vrf_id = l3vni if l3vni else vid
+    rt_table = vrf_id + int(conf["agent"]["rt_table_offset"])
+
+    # Ensure that the VLAN is added to the veth port (connected to the OVS bridge)
+    BridgeManager.ensure_vlan(vid=vid, dev=conf["bridge"]["veth"])
+
+    # The L2VNI might be configured explicitly per-VLAN, or implicitly through the
+    # 'l2vni_offset' agent configuration option.
+    if l2vni is None and "l2vni_offset" in conf["agent"]:
+        l2vni = vid + int(conf["agent"]["l2vni_offset"])
+
+    # If the network has an L2VNI assigned (or implicitly through the use of the
+    # 'l2vni_offset' agent option), then create a VXLAN device for that L2VNI, hook
+    # it up to the EVPN bridge, and ensure the network's VLAN ID is added to the
+    # L2VNI bridge port.
+    if l2vni:
+        log.info(f"Ensuring L2VNI {l2vni} for {net['id']} (VLAN {vid})")
+        devname = "l2vni-" + str(l2vni)
         LinkManager.ensure_link(
-            name=vrf,
-            type="vrf",
+            name=devname,
+            type="vxlan",
             link_attrs={
-                "ifalias": "VRF " + str(vrf_id),
+                "master": conf["bridge"]["name"],
                 "inet6_addr_gen_mode": "none",
+                "mtu": mtu,
+                "ifalias": "L2VNI for " + net["id"],
+            },
+            type_attrs={
+                "id": l2vni,
+                "learning": False,
+                "local": AddressManager.get_primary_loopback_ipv4(),
+                "port": 4789,
+            },
+            bridge_slave_attrs={
+                "learning": False,
+                "neigh_suppress": True,
             },
-            type_attrs={"table": rt_table},
         )
+        BridgeManager.ensure_vlan(vid=vid, dev=devname, tagged=False)
 
-        FrrManager.ensure_vrf(vrf=vrf, l3vni=l3vni)
+    # Create an IRB device (also called SVI) for the network, ensure it can send
+    # and receive traffic to the network's VLAN tag, and finally add all gateway
+    # addresses to it with the correct prefix length. FRR will take care of
+    # advertising routes for the link prefixes into the EVPN fabric with BGP thanks
+    # to the "redistribute connected" setting.
+    log.info(f"Ensuring VRF/IRB/L3VNI for VRF {vrf_id}")
+    vrf = "vrf-" + str(vrf_id)
+    irb = "irb-" + str(vrf_id)
+    LinkManager.ensure_link(
+        name=vrf,
+        type="vrf",
+        link_attrs={
+            "ifalias": "VRF " + str(vrf_id),
+            "inet6_addr_gen_mode": "none",
+        },
+        type_attrs={"table": rt_table},
+    )
+
+    FrrManager.ensure_vrf(vrf=vrf, l3vni=l3vni)
+
+    # Create an IRB device bound bound to the VRF created above
+    log.info(f"Ensuring IRB for {net['id']} (VLAN {vid})")
+    dev = "irb-" + str(vid)
+    LinkManager.ensure_link(
+        name=dev,
+        link=conf["bridge"]["name"],
+        type="vlan",
+        link_attrs={
+            "mtu": mtu,
+            "ifalias": "IRB for VLAN " + str(vid),
+            "master": "vrf-" + str(vrf_id),
+        },
+        type_attrs={"id": vid},
+    )
+    BridgeManager.ensure_vlan(vid=vid, dev=conf["bridge"]["name"])
 
-        # Create an IRB device bound bound to the VRF created above
-        log.info(f"Ensuring IRB for {net['id']} (VLAN {vid})")
-        dev = "irb-" + str(vid)
+    # If the network has a L3VNI assigned, create it plus an IRB device that can
+    # is used to send/receive L3 traffic to/from the VXLAN device.
+    if l3vni:
         LinkManager.ensure_link(
-            name=dev,
-            link=conf["bridge"]["name"],
-            type="vlan",
+            name=irb,
+            type="bridge",
             link_attrs={
-                "mtu": mtu,
-                "ifalias": "IRB for VLAN " + str(vid),
-                "master": "vrf-" + str(vrf_id),
+                "ifalias": "IRB for VRF " + str(vrf_id),
+                "inet6_addr_gen_mode": "none",
+                "master": vrf,
+                "mtu": int(conf["bridge"]["mtu"]) - 50,
+            },
+        )
+        LinkManager.ensure_link(
+            name="l3vni-" + str(l3vni),
+            type="vxlan",
+            link_attrs={
+                "ifalias": "L3VNI for VRF " + str(vrf_id),
+                "inet6_addr_gen_mode": "none",
+                "master": irb,
+                "mtu": int(conf["bridge"]["mtu"]) - 50,
+            },
+            type_attrs={
+                "id": l3vni,
+                "learning": False,
+                "local": AddressManager.get_primary_loopback_ipv4(),
+                "port": 4789,
+            },
+            bridge_slave_attrs={
+                "learning": False,
+                "neigh_suppress": True,
             },
-            type_attrs={"id": vid},
         )
-        BridgeManager.ensure_vlan(vid=vid, dev=conf["bridge"]["name"])
-
-        # If the network has a L3VNI assigned, create it plus an IRB device that can
-        # is used to send/receive L3 traffic to/from the VXLAN device.
-        if l3vni:
-            LinkManager.ensure_link(
-                name=irb,
-                type="bridge",
-                link_attrs={
-                    "ifalias": "IRB for VRF " + str(vrf_id),
-                    "inet6_addr_gen_mode": "none",
-                    "master": vrf,
-                    "mtu": int(conf["bridge"]["mtu"]) - 50,
-                },
-            )
-            LinkManager.ensure_link(
-                name="l3vni-" + str(l3vni),
-                type="vxlan",
-                link_attrs={
-                    "ifalias": "L3VNI for VRF " + str(vrf_id),
-                    "inet6_addr_gen_mode": "none",
-                    "master": irb,
-                    "mtu": int(conf["bridge"]["mtu"]) - 50,
-                },
-                type_attrs={
-                    "id": l3vni,
-                    "learning": False,
-                    "local": AddressManager.get_primary_loopback_ipv4(),
-                    "port": 4789,
-                },
-                bridge_slave_attrs={
-                    "learning": False,
-                    "neigh_suppress": True,
-                },
-            )
 
-        # When there's a L3VNI, enable Layer-3 IP addressing and routing on the IRB for
-        # the provider network.
+    # When there's a L3VNI, enable Layer-3 IP addressing and routing on the IRB for
+    # the provider network.
+    #
+    # Also do so if the L3VNI is explicitly set to 0 (as opposed to the default
+    # NULL). In this case, the routing domain will be isolated on the hypervisor,
+    # which is probably only useful if the routes is being leaked to/from another
+    # VRF by FRR, such as to the underlay.
+    #
+    # Don't enable the anycast gateway nor any routes if the L3VNI is NULL, as that
+    # is taken to mean the provider network is L2 only, and that the L3 gateway (if
+    # any) is located on a device external to OpenStack (behind a remote VTEP).
+    if l3vni is not None:
+        # If the network is configured for advertisement of its connected prefixes,
+        # ensure the redistribute connected route map for the VRF allows that.
         #
-        # Also do so if the L3VNI is explicitly set to 0 (as opposed to the default
-        # NULL). In this case, the routing domain will be isolated on the hypervisor,
-        # which is probably only useful if the routes is being leaked to/from another
-        # VRF by FRR, such as to the underlay.
-        #
-        # Don't enable the anycast gateway nor any routes if the L3VNI is NULL, as that
-        # is taken to mean the provider network is L2 only, and that the L3 gateway (if
-        # any) is located on a device external to OpenStack (behind a remote VTEP).
-        if l3vni is not None:
-            # If the network is configured for advertisement of its connected prefixes,
-            # ensure the redistribute connected route map for the VRF allows that.
-            #
-            # If this is unset, only known IP addresses associated to OpenStack ports
-            # are advertised. This eliminates Internet background radiation (scanning
-            # and so on) addressed to unused IP addresses from reaching the IRB and
-            # causing pointless ARP/NS queries. However it means that IP addresses not
-            # known to OpenStack will not be reachable.
-            if advertise_connected:
-                FrrManager.ensure_advertise_connected(vrf=vrf, vlanid=vid)
-
-            # Add the default gateway IP for each subnet associated with the network
-            # to the IRB device.
-            subnets = Inventory.get_subnets(network=net["id"])
-            for subnet in subnets:
-                log.debug(f"Processing subnet {subnet}")
-                gw = subnet["gateway_ip"] + "/" + subnet["cidr"].split("/")[-1]
-                AddressManager.ensure_address(dev=dev, address=gw)
-                if subnet["enable_dhcp"] and subnet["ipv6_ra_mode"]:
-                    FrrManager.ensure_ra(
-                        dev=dev, prefix=subnet["cidr"], mode=subnet["ipv6_ra_mode"]
+        # If this is unset, only known IP addresses associated to OpenStack ports
+        # are advertised. This eliminates Internet background radiation (scanning
+        # and so on) addressed to unused IP addresses from reaching the IRB and
+        # causing pointless ARP/NS queries. However it means that IP addresses not
+        # known to OpenStack will not be reachable.
+        if advertise_connected:
+            FrrManager.ensure_advertise_connected(vrf=vrf, vlanid=vid)
+
+        # Add the default gateway IP for each subnet associated with the network
+        # to the IRB device.
+        for subnet in snapshot.subnets.get(net["id"], []):
+            log.debug(f"Processing subnet {subnet}")
+            gw = subnet["gateway_ip"] + "/" + subnet["cidr"].split("/")[-1]
+            AddressManager.ensure_address(dev=dev, address=gw)
+            if subnet["enable_dhcp"] and subnet["ipv6_ra_mode"]:
+                FrrManager.ensure_ra(
+                    dev=dev, prefix=subnet["cidr"], mode=subnet["ipv6_ra_mode"]
+                )
+
+            # Add any subnet routes (from openstack subnet set --host-route) if the
+            # nexthop of the subnet route is local to this hypervisor. It will be
+            # advertised upstream by FRR thanks to 'redistribute kernel'.
+            for subnetroute in snapshot.subnetroutes.get(subnet["id"], []):
+                log.debug(f"Considering subnet route {subnetroute}")
+
+                # As a special case/hack, if the gateway is set to 0.179.x.y or
+                # ::179:x:y, then instead of creating a regular route, we enable a
+                # dynamic BGP listener that allows VMs on this network to advertise
+                # routes from within the destination prefix to FRR running on the
+                # hypervisor, which in turn will re-advertise those onward to the
+                # data centre fabric as Type-5 EVPN routes (or regular IPvX Unicast
+                # routes if underlay leaking is configured). x and y will be used as
+                # the ge/le values in the FRR prefix list.
+                nh = ip_address(subnetroute["nexthop"])
+                if (nh in ip_network("0.179.0.0/16")) or (
+                    nh in ip_network("::179:0:0/96")
+                ):
+                    FrrManager.ensure_bgp_listener(
+                        dev=dev,
+                        vrf=vrf,
+                        subnet=subnet["cidr"],
+                        route=subnetroute,
                     )
+                    continue
 
-                # Add any subnet routes (from openstack subnet set --host-route) if the
-                # nexthop of the subnet route is local to this hypervisor. It will be
-                # advertised upstream by FRR thanks to 'redistribute kernel'.
-                for subnetroute in Inventory.get_subnetroutes(subnet_id=subnet["id"]):
-                    log.debug(f"Considering subnet route {subnetroute}")
-
-                    # As a special case/hack, if the gateway is set to 0.179.x.y or
-                    # ::179:x:y, then instead of creating a regular route, we enable a
-                    # dynamic BGP listener that allows VMs on this network to advertise
-                    # routes from within the destination prefix to FRR running on the
-                    # hypervisor, which in turn will re-advertise those onward to the
-                    # data centre fabric as Type-5 EVPN routes (or regular IPvX Unicast
-                    # routes if underlay leaking is configured). x and y will be used as
-                    # the ge/le values in the FRR prefix list.
-                    nh = ip_address(subnetroute["nexthop"])
-                    if (nh in ip_network("0.179.0.0/16")) or (
-                        nh in ip_network("::179:0:0/96")
-                    ):
-                        FrrManager.ensure_bgp_listener(
-                            dev=dev,
-                            vrf=vrf,
-                            subnet=subnet["cidr"],
-                            route=subnetroute,
-                        )
-                        continue
+                if not [p for p in ports if p["ip_address"] == subnetroute["nexthop"]]:
+                    log.debug("Skipping because the nexthop has no local port")
+                    continue
+                RouteManager.ensure_route(
+                    RouteManager.Route(
+                        dst=subnetroute["destination"],
+                        gateway=subnetroute["nexthop"],
+                        dev=dev,
+                        table=str(rt_table),
+                    )
+                )
 
-                    if not [
-                        p
-                        for p in ports
-                        if p["segmentation_id"] == vid
-                        and p["ip_address"] == subnetroute["nexthop"]
-                    ]:
-                        log.debug("Skipping because the nexthop has no local port")
+            # Add any routes to tenant subnets located behind router gateway ports
+            # (lrp) ports attached to this subnet, if the inside/outside address
+            # scopes match
+            if subnet["address_scope_id"]:
+                log.info(
+                    "Looking for tenant networks with address scope "
+                    + subnet["address_scope_id"]
+                )
+                for port in ports:
+                    log.debug(f"Considering {port}")
+                    if port.get("subnet_id") != subnet["id"]:
+                        log.debug(f"…does not belong to {subnet['id']}, skipping")
+                        continue
+                    if port.get("device_owner") != "network:router_gateway":
+                        log.debug(f"…is not a router gateway, skipping")
                         continue
-                    RouteManager.ensure_route(
-                        RouteManager.Route(
-                            dst=subnetroute["destination"],
-                            gateway=subnetroute["nexthop"],
-                            dev=dev,
-                            table=str(rt_table),
-                        )
-                    )
 
-                # Add any routes to tenant subnets located behind router gateway ports
-                # (lrp) ports attached to this subnet, if the inside/outside address
-                # scopes match
-                if subnet["address_scope_id"]:
-                    log.info(
-                        "Looking for tenant networks with address scope "
-                        + subnet["address_scope_id"]
+                    tenantnets = snapshot.tenant_networks.get(
+                        (port["device_id"], subnet["address_scope_id"]), []
                     )
-                    for port in ports:
-                        log.debug(f"Considering {port}")
-                        if port.get("subnet_id") != subnet["id"]:
-                            log.debug(f"…does not belong to {subnet['id']}, skipping")
-                            continue
-                        if port.get("device_owner") != "network:router_gateway":
-                            log.debug(f"…is not a router gateway, skipping")
-                            continue
-
-                        tenantnets = Inventory.get_tenant_networks(
-                            device_id=port["device_id"],
-                            address_scope_id=subnet["address_scope_id"],
-                        )
-                        log.info(f"Tenant networks found: {tenantnets}")
-
-                        for tenantnet in tenantnets:
-                            RouteManager.ensure_route(
-                                RouteManager.Route(
-                                    dst=tenantnet["cidr"],
-                                    gateway=port["ip_address"],
-                                    dev=dev,
-                                    table=str(rt_table),
-                                )
+                    log.info(f"Tenant networks found: {tenantnets}")
+
+                    for tenantnet in tenantnets:
+                        RouteManager.ensure_route(
+                            RouteManager.Route(
+                                dst=tenantnet["cidr"],
+                                gateway=port["ip_address"],
+                                dev=dev,
+                                table=str(rt_table),
                             )
+                        )
+
+    # Configure static FDB and neighbor entries for each of the known ports on the
+    # network. This reduces the reliance on flooding and learning, and may help
+    # reducing BGP churn (consider rather silent host that would otherwise drop in
+    # and out of the FDB and/or the neighbour cache).
+    log.info(f"Ensuring static FDB/neigh entries for {net['id']} (VLAN {vid})")
+    for port in ports:
+        ensure_port(port, l3vni=l3vni, rt_table=rt_table)
 
-        # Configure static FDB and neighbor entries for each of the known ports on the
-        # network. This reduces the reliance on flooding and learning, and may help
-        # reducing BGP churn (consider rather silent host that would otherwise drop in
-        # and out of the FDB and/or the neighbour cache).
-        log.info(f"Ensuring static FDB/neigh entries for {net['id']} (VLAN {vid})")
-        for port in [p for p in ports if p["segmentation_id"] == vid]:
-            log.info(f"Processing port {port}")
-            # If the port has multiple IP addresses, we'll ensure the same FDB multiple
-            # times here - but ensure_fdb() is idempotent, so whatever.
-            BridgeManager.ensure_fdb(
-                lladdr=port["mac_address"], vid=port["segmentation_id"]
-            )
 
-            if port["ip_address"]:
-                log.info("Adding static neighbour entry")
-                NeighManager.ensure_neigh(
+def ensure_port(port, *, l3vni, rt_table):
+    """Ensures the static FDB and neighbour entries (plus the host route, if needed)
+    for a given port are provisioned. The rest of its network must be in place."""
+    log.info(f"Processing port {port}")
+    # If the port has multiple IP addresses, we'll ensure the same FDB multiple
+    # times here - but ensure_fdb() is idempotent, so whatever.
+    BridgeManager.ensure_fdb(lladdr=port["mac_address"], vid=port["segmentation_id"])
+
+    if port["ip_address"]:
+        log.info("Adding static neighbour entry")
+        NeighManager.ensure_neigh(
+            dst=port["ip_address"],
+            lladdr=port["mac_address"],
+            dev="irb-" + str(port["segmentation_id"]),
+        )
+
+        # If the IRB is not bound to an L3VNI, the Type-2 MACIP routes for the
+        # static neigh entries added above will not be leaked into other VRFs
+        # as regular host routes, only the on-link prefix would. Therefore,
+        # routing to the IP addresses in question would follow the route to the
+        # subnet prefix on the network. Since the subnet prefix will be
+        # advertised by all hypervisors where the network is active, this will
+        # lead to inefficient routing, as the external routers might send the
+        # traffic to a hypervisor where the port is not active, which will in
+        # turn have to transmit it onwards to the correct hypervisor via the
+        # L2VNI (assuming there is one).
+        #
+        # Upstream bug report: https://github.com/FRRouting/frr/issues/16161
+        #
+        # To work around this, and ensure that traffic to known ports is routed
+        # directly to the correct hypervisor by external routes, add a static
+        # host route for the IP address as well. This host route can then be
+        # leaked as a regular unicast route to other VRFs (or the underlay), and
+        # be advertised onwards from there, ensuring efficient routing.
+        if l3vni == 0:
+            log.info("Adding static host route in underlay")
+            RouteManager.ensure_route(
+                RouteManager.Route(
                     dst=port["ip_address"],
-                    lladdr=port["mac_address"],
                     dev="irb-" + str(port["segmentation_id"]),
+                    table=str(rt_table),
                 )
+            )
 
-                # If the IRB is not bound to an L3VNI, the Type-2 MACIP routes for the
-                # static neigh entries added above will not be leaked into other VRFs
-                # as regular host routes, only the on-link prefix would. Therefore,
-                # routing to the IP addresses in question would follow the route to the
-                # subnet prefix on the network. Since the subnet prefix will be
-                # advertised by all hypervisors where the network is active, this will
-                # lead to inefficient routing, as the external routers might send the
-                # traffic to a hypervisor where the port is not active, which will in
-                # turn have to transmit it onwards to the correct hypervisor via the
-                # L2VNI (assuming there is one).
-                #
-                # Upstream bug report: https://github.com/FRRouting/frr/issues/16161
-                #
-                # To work around this, and ensure that traffic to known ports is routed
-                # directly to the correct hypervisor by external routes, add a static
-                # host route for the IP address as well. This host route can then be
-                # leaked as a regular unicast route to other VRFs (or the underlay), and
-                # be advertised onwards from there, ensuring efficient routing.
-                if l3vni == 0:
-                    log.info("Adding static host route in underlay")
-                    RouteManager.ensure_route(
-                        RouteManager.Route(
-                            dst=port["ip_address"],
-                            dev="irb-" + str(port["segmentation_id"]),
-                            table=str(rt_table),
-                        )
-                    )
+
+def dirty_owners(owners):
+    """Returns the owners that have had any of their kernel resources go missing"""
+    return [o for o in owners if [m for m in kernel_managers if m.dirty(o)]]
+
+
+def network_digest(net, snapshot):
+    """Returns a digest of the desired state of a given network, i.e., everything in
+    the snapshot that ensure_network() bases its decisions on"""
+    vid = net["segmentation_id"]
+    ports = snapshot.ports.get(vid, [])
+    subnets = snapshot.subnets.get(net["id"], [])
+    routers = {
+        p["device_id"] for p in ports if p["device_owner"] == "network:router_gateway"
+    }
+    desired = {
+        "network": net,
+        "subnets": _sorted(subnets),
+        "subnetroutes": _sorted(
+            r for s in subnets for r in snapshot.subnetroutes.get(s["id"], [])
+        ),
+        # The update time of a port does not affect how it is provisioned
+        "ports": _sorted(
+            {k: v for k, v in port.items() if k != "updated_at"} for port in ports
+        ),
+        "tenant_networks": _sorted(
+            tn
+            for (device_id, _), tns in snapshot.tenant_networks.items()
+            if device_id in routers
+            for tn in tns
+        ),
+        "loopback": AddressManager.get_primary_loopback_ipv4(),
+    }
+    return hashlib.sha256(_json(desired).encode()).hexdigest()
+
+
+def activated_ports(snapshot):
+    """Returns the ports in the snapshot that were not active in the previous one (i.e.,
+    the ports that have been activated or bound to this hypervisor since, including
+    floating IPs that have been associated), keyed by what identifies them"""
+    global known_ports
+    prev_ports = known_ports
+    known_ports = {
+        _port_key(port): port for ports in snapshot.ports.values() for port in ports
+    }
+    if prev_ports is None:
+        # Everything is new on startup
+        return {}
+    return {key: port for key, port in known_ports.items() if key not in prev_ports}
+
+
+def fast_path(activated, snapshot):
+    """Provisions newly activated ports on networks that were already in place ahead of
+    everything else, in order to minimise the time it takes for a booting VM to get
+    connectivity. Returns the keys of the ports that were provisioned."""
+    networks = {net["segmentation_id"]: net for net in snapshot.networks}
+    done = []
+    for key, port in activated.items():
+        net = networks.get(port["segmentation_id"])
+        if not net or net["id"] not in digests:
+            continue
+        vrf_id = net["l3vni"] if net["l3vni"] else net["segmentation_id"]
+        with owner(net["id"]):
+            ensure_port(
+                port,
+                l3vni=net["l3vni"],
+                rt_table=vrf_id + int(conf["agent"]["rt_table_offset"]),
+            )
+        done.append(key)
+    if not done:
+        return []
+    log.info(f"Fast path: provisioning {len(done)} newly activated port(s)")
+    try:
+        flush()
+    except BatchError as e:
+        # The full iteration that follows will try again
+        log.error(f"Fast path: {e}")
+        return []
+    finally:
+        dataplane.sync()
+    return done
+
+
+def report_latency(ports, detected):
+    """Logs the time it took to provision newly activated ports, both since they were
+    detected by the agent and since they became active according to Neutron"""
+    now = time.monotonic()
+    utcnow = datetime.now(timezone.utc).replace(tzinfo=None)
+    for port in ports:
+        msg = (
+            f"Port {port['mac_address']} ({port['ip_address']}) on VLAN "
+            f"{port['segmentation_id']} provisioned in {(now - detected) * 1000:.0f} ms"
+        )
+        # Neutron stores timestamps in UTC, with one second resolution
+        if port.get("updated_at"):
+            latency = (utcnow - port["updated_at"]).total_seconds()
+            msg += f", {latency * 1000:.0f} ms after activation"
+        log.warning(msg)
+
+
+def _port_key(port):
+    return (port["segmentation_id"], port["mac_address"], port["ip_address"])
+
+
+def _sorted(rows):
+    # The database returns rows in no particular order
+    return sorted(rows, key=_json)
+
+
+def _json(obj):
+    return json.dumps(obj, sort_keys=True, default=str)
+
+
+def init():
+    """Loads everything the main loop depends on: connects to the database, loads
+    frr-reload and the running FRR config, and populates the caches of kernel state.
+    The loads are mostly independent of each other, so they are done in parallel."""
+    metrics.init()
+    # The dataplane monitor must be listening before any kernel state is loaded
+    dataplane.init()
+    jobs = {
+        "database": Inventory.init,
+        "FRR": FrrManager.init,
+        "OVS": OvsManager.init,
+        "links": LinkManager.init,
+        "bridge": BridgeManager.init,
+        "addresses": AddressManager.init,
+        "neighbours": NeighManager.init,
+        "routes": RouteManager.init,
+    }
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = {name: executor.submit(_timed, job) for name, job in jobs.items()}
+        for name, future in futures.items():
+            log.info(f"Loaded {name} in {future.result():.3f}s")
+
+
+def _timed(job):
+    start = time.monotonic()
+    job()
+    return time.monotonic() - start
+
+
+def main(args=None):
+    config.load(args)
+    logging.basicConfig(
+        format=logfmt, level=conf["agent"]["loglevel"].upper(), stream=sys.stdout
+    )
+
+    start = time.monotonic()
+    init()
+    log.warning(f"Agent started in {time.monotonic() - start:.3f}s")
+    profiler.init()
+
+    if "oneshot" in conf["agent"]:
+        iterate()
+    else:
+        asyncio.run(run())
+
+
+async def run():
+    """The daemon core, which runs an iteration of the main loop (i.e., polls the
+    database) whenever the database poll timer or the periodic resync timer fires. In
+    between, the dataplane monitor and the OVSDB monitor are watched for changes to
+    the kernel objects and the OVS bridge, and anything managed by the agent that goes
+    missing is repaired right away, without querying the database (see repair()).
+    Events arriving in a burst are coalesced into a single repair.
+
+    The database is polled every interval seconds after a change has been found, while
+    it keeps changing, backing off exponentially to max_interval seconds while it stays
+    idle. Each delay is randomised by up to interval_jitter (a fraction) either way, so
+    that the agents on different hypervisors do not poll the database in lockstep."""
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    delay = float(conf["agent"]["interval"])
+    next_poll = 0
+    loop.add_signal_handler(signal.SIGUSR1, profiler.request)
+
+    # The notifications are applied to the caches as they arrive, and only those that
+    # may concern something managed by the agent wake it up, so that e.g. the churn of
+    # the neighbours and routes of FRR does not
+    def on_kernel_event():
+        if dataplane.sync():
+            wakeup.set()
+
+    def on_ovsdb_event():
+        OvsManager.update()
+        if OvsManager.dirty():
+            wakeup.set()
+
+    while True:
+        # The OVSDB connection is re-established if lost, so the socket may change (or
+        # be missing until the connection has been re-established)
+        readers = [
+            (fd, callback)
+            for fd, callback in (
+                (dataplane.monitor.sock.fileno(), on_kernel_event),
+                (OvsManager.fileno(), on_ovsdb_event),
+            )
+            if fd is not None
+        ]
+        for fd, callback in readers:
+            loop.add_reader(fd, callback)
+        timeout = min(next_poll, next_resync) - time.monotonic()
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        else:
+            await asyncio.sleep(float(conf["agent"]["debounce"]))
+        # The caches must not be touched while the worker thread below uses them
+        for fd, _ in readers:
+            loop.remove_reader(fd)
+        wakeup.clear()
+        # Repairs and iterations are blocking, so run them in a worker thread. If one
+        # fails (e.g., because the database or FRR is unavailable, or the kernel has
+        # rejected a change), the database is polled again after interval seconds, and
+        # the next iteration tries again to do whatever may not have been done.
+        try:
+            if time.monotonic() < min(next_poll, next_resync):
+                await loop.run_in_executor(None, repair)
+                continue
+            changed = await loop.run_in_executor(None, iterate)
+        except Exception as e:
+            log.exception(f"Main loop failed: {e}")
+            changed = True
+        if changed:
+            delay = float(conf["agent"]["interval"])
+        else:
+            delay = min(delay * 2, float(conf["agent"]["max_interval"]))
+        jitter = float(conf["agent"]["interval_jitter"])
+        next_poll = time.monotonic() + delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+# Main program loop. The basic work flow of the agent is to determine all the
+# resources that should be active on this particular hypervisor, use the
+# ensure_foo() functions in the various manager modules to ensure they are present,
+# then finally garbage collect any resource that were created previously but should
+# no longer be active on this hypervisor (e.g., a port belonging to a VM that has
+# been deleted or migrated to to another hypervisor.)
+#
+# In order to keep idle compute nodes idle, a full iteration is only performed if
+# the relevant Neutron state has changed since the previous one, if any of the
+# kernel objects ensured previously have gone missing (as reported by the dataplane
+# monitor), or if a periodic resync is due. Otherwise the loop goes straight back to
+# sleep. Similarly, within an iteration, a network is only processed if its desired
+# state has changed, or if any of its kernel objects have gone missing. Resources
+# belonging to networks that are not processed are retained by the managers (see
+# utils.owner()), so that they are not garbage collected.
+#
+# Ports that have been activated since the previous iteration on networks that are
+# already in place are provisioned on a fast path ahead of everything else, see
+# fast_path(). Kernel objects that go missing in between iterations are repaired
+# based on the snapshot of the database loaded by the previous one, see repair().
+fingerprint = None
+next_resync = 0
+digests = {}
+known_ports = None
+snapshot = None
+
+
+def iterate():
+    """Performs a single iteration of the main loop, returning whether anything needed
+    to be done"""
+    start = time.monotonic()
+    changed = _iterate()
+    metrics.iteration_duration.observe(
+        time.monotonic() - start, result="full" if changed else "skipped"
+    )
+    for kind, known in (
+        ("address", AddressManager.known_addresses),
+        ("fdb", BridgeManager.known_fdbs),
+        ("frr_snippet", FrrManager.known_config),
+        ("link", LinkManager.known_links),
+        ("neigh", NeighManager.known_neighs),
+        ("route", RouteManager.known_routes),
+        ("vlan", BridgeManager.known_vlans),
+    ):
+        metrics.managed_objects.set(len(claimed(known)), kind=kind)
+    metrics.managed_objects.set(len(digests), kind="network")
+    metrics.finalise()
+    return changed
+
+
+@metrics.timed(metrics.phase_duration, phase="repair")
+def repair():
+    """Repairs the kernel objects and the OVS downlink that have gone missing since the
+    previous iteration of the main loop, returning whether anything needed to be done.
+    The desired state is the one loaded by the previous iteration, so the database is
+    not queried, and nothing is garbage collected."""
+    global fingerprint
+    dataplane.sync()
+    OvsManager.update()
+    if snapshot is None:
+        # Nothing has been ensured yet
+        return False
+    dirty = dirty_owners([None] + list(digests))
+    if not dirty and not OvsManager.dirty():
+        log.debug("Repair: nothing has gone missing")
+        return False
+
+    if None in dirty or OvsManager.dirty():
+        log.warning("Repair: the EVPN bridge or the OVS downlink has gone missing")
+        for m in kernel_managers:
+            m.forget(None)
+        ensure_bridge()
+    networks = {net["id"]: net for net in snapshot.networks}
+    try:
+        for net_id in dirty:
+            if net_id is None:
+                continue
+            log.warning(f"Repair: kernel objects of network {net_id} have gone missing")
+            for m in kernel_managers:
+                m.forget(net_id)
+            with owner(net_id):
+                ensure_network(networks[net_id], snapshot)
+        LinkManager.commit()
+        flush()
+    except Exception:
+        # Have the next poll of the database perform a full iteration, which processes
+        # the networks with kernel objects still missing
+        fingerprint = None
+        raise
+    finally:
+        dataplane.sync()
+    return True
+
+
+def _iterate():
+    global fingerprint, next_resync
+
+    prev_fingerprint = fingerprint
+    fingerprint = Inventory.get_fingerprint()
+    kernel_changed = dataplane.sync()
+    OvsManager.update()
+    resync = time.monotonic() >= next_resync
+    if fingerprint == prev_fingerprint and not resync:
+        if OvsManager.dirty():
+            log.warning("Main loop: the OVS downlink has gone missing, repairing")
+        elif not (kernel_changed and dirty_owners([None] + list(digests))):
+            log.debug("Main loop: nothing has changed, skipping iteration")
+            return False
+        else:
+            log.warning("Main loop: kernel objects have gone missing, repairing")
+    if resync:
+        log.info("Main loop: periodic resync, reprocessing all networks")
+        next_resync = time.monotonic() + int(conf["agent"]["resync_interval"])
+
+    # Only full iterations are profiled, so that skipped ones do not use up the
+    # iterations requested to be profiled
+    with profiler.profile():
+        try:
+            _process(resync)
+        except Exception:
+            # Make sure that the next poll of the database does not skip the iteration
+            # (see _process() for which networks are processed again)
+            fingerprint = None
+            raise
+    return True
+
+
+def _process(resync):
+    """Performs a full iteration of the main loop"""
+    global digests, snapshot
+
+    # Collect the state the iteration is based on: all the desired state from the
+    # database in one go (rather than querying it for the subnets, routes and so on
+    # of each individual network as we go along), the running FRR config (if it is
+    # certain to be needed), and on a periodic resync the kernel state. These are
+    # independent of each other, so they are loaded concurrently, and the iteration
+    # proceeds once all of them have been loaded.
+    collect = metrics.phase_duration.time(phase="collect")
+    with collect, ThreadPoolExecutor(max_workers=3) as executor:
+        jobs = [
+            executor.submit(Inventory.get_snapshot),
+            executor.submit(FrrManager.prefetch),
+        ]
+        if resync:
+            jobs.append(executor.submit(dataplane.resync))
+        snapshot = jobs[0].result()
+        # There is no need to wait for the rest of the state in order to provision newly
+        # activated ports, unless the kernel state is being repopulated (in which case
+        # all ports are provisioned by the full iteration anyway)
+        detected = time.monotonic()
+        activated = activated_ports(snapshot)
+        if activated and not resync:
+            with metrics.phase_duration.time(phase="fast_path"):
+                done = fast_path(activated, snapshot)
+            report_latency([activated.pop(key) for key in done], detected)
+        for job in jobs[1:]:
+            job.result()
+
+    # The resources not belonging to any network are ensured from scratch below
+    for m in managers:
+        m.forget(None)
+
+    log.info("Main loop: ensuring EVPN bridge and OVS downlink")
+    ensure_bridge()
+
+    # Loop through each network active on this hypervisor and ensure all of its
+    # resources are properly provisioned.
+    log.info("Main loop: evaluationg active networks")
+    #
+    # The digests of the networks processed are only recorded once their changes have
+    # all been executed at the end of the iteration. Until then their digest is None,
+    # so that they are processed again by the next iteration if this one fails.
+    prev_digests = digests
+    digests = {}
+    processed = {}
+    with metrics.phase_duration.time(phase="networks"):
+        for net in snapshot.networks:
+            digest = network_digest(net, snapshot)
+            if (
+                not resync
+                and digest == prev_digests.get(net["id"])
+                and not [m for m in kernel_managers if m.dirty(net["id"])]
+            ):
+                log.info(f"Network {net['id']} is unchanged, skipping")
+                digests[net["id"]] = digest
+                continue
+            digests[net["id"]] = None
+            processed[net["id"]] = digest
+            for m in managers:
+                m.forget(net["id"])
+            with owner(net["id"]):
+                ensure_network(net, snapshot)
+
+    # Release the resources belonging to networks that are no longer active on this
+    # hypervisor, so that they are garbage collected below
+    for net_id in prev_digests.keys() - digests.keys():
+        log.info(f"Network {net_id} is gone, releasing its resources")
+        for m in managers:
+            m.forget(net_id)
+
+    # Most of the changes needed to ensure the resources above have been queued
+    # rather than executed one by one (including the creation of any missing links),
+    # so execute them all in one go
+    LinkManager.commit()
 
     # Prune any orphaned resources (i.e., not ensured previously in the main loop),
     # before proceeding to the next iteration of the main loop. This makes sure that
-    # deleted resources are garbage collected.
+    # deleted resources are garbage collected. The removals queued by the kernel
+    # managers are executed together, in the order required by their dependencies
+    # (e.g., bridge VLANs must be removed before links, see dataplane.dependencies).
     log.info("Main loop: garbage collecting orphaned resources")
     FrrManager.finalise()
-    NeighManager.finalise()
-    RouteManager.finalise()
-    AddressManager.finalise()
-    BridgeManager.finalise()
-    LinkManager.finalise()
+    for m in kernel_managers:
+        m.prune()
+    flush()
+    dataplane.sync()
+    digests.update(processed)
+    report_latency(activated.values(), detected)
 
     log.info("Main loop: complete")
-    if "oneshot" in conf["agent"]:
-        break
-    time.sleep(int(conf["agent"]["interval"]))
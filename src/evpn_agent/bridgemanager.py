@@ -15,148 +15,184 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import errno
 import logging
-from .utils import cmd, jsoncmd
+from . import metrics
+from .dataplane import batch, dump_bridge_ports, dump_fdb, subscribe
+from .utils import claim, claimed
 from .config import conf
-from . import linkmanager as LinkManager
 
 log = logging.getLogger(__name__)
 
+# FDB entries on the veth keyed by MAC, VLAN and master, bridge ports by name, and the
+# set of VLANs on each bridge port (or bridge) that has any
 state = dict()
-known_fdbs = []
+known_fdbs = {}
 known_vlans = {}
 
 
-def update():
-    global state
-    if LinkManager.get_link(conf["bridge"]["veth"]):
-        state["fdb"] = jsoncmd(
-            ["bridge", "-j", "-d", "fdb", "show", "dev", conf["bridge"]["veth"]]
-        )
-    else:
-        state["fdb"] = {}
-    state["link"] = jsoncmd(["bridge", "-j", "-d", "link", "show"])
-    state["vlan"] = jsoncmd(["bridge", "-j", "-d", "vlan", "show"])
+def init():
+    # Ensure the cache is populated, and kept up to date afterwards
+    subscribe(handler=handle_event, update=update)
+    update()
 
 
-def finalise():
-    global known_fdbs
-    global known_vlans
+def update():
     global state
-
-    prune()
-    update()
-    known_fdbs = []
-    known_vlans = {}
+    try:
+        state["fdb"] = {
+            _fdb_key(entry): entry
+            for entry in dump_fdb(
+                dev=conf["bridge"]["veth"], master=conf["bridge"]["name"]
+            )
+        }
+    except OSError as e:
+        if e.errno != errno.ENODEV:
+            raise
+        # The veth or the bridge does not exist (yet)
+        state["fdb"] = {}
+    # Links and VLANs are retrieved with a single dump
+    state["link"] = {port.ifname: port for port in dump_bridge_ports()}
+    state["vlan"] = {
+        name: port.vlans for name, port in state["link"].items() if port.vlans
+    }
+
+
+def handle_event(kind, action, record):
+    if kind == "link" and action == "del":
+        if record.ifname in (conf["bridge"]["veth"], conf["bridge"]["name"]):
+            state["fdb"] = {}
+        state["link"].pop(record.ifname, None)
+        state["vlan"].pop(record.ifname, None)
+    elif kind == "bridge_port":
+        state["link"].pop(record.ifname, None)
+        state["vlan"].pop(record.ifname, None)
+        if action == "new":
+            state["link"][record.ifname] = record
+            if record.vlans:
+                state["vlan"][record.ifname] = record.vlans
+    elif kind == "fdb" and record.dev == conf["bridge"]["veth"]:
+        if action == "new":
+            state["fdb"][_fdb_key(record)] = record
+        else:
+            state["fdb"].pop(_fdb_key(record), None)
+
+
+def forget(owner):
+    known_fdbs.pop(owner, None)
+    known_vlans.pop(owner, None)
+
+
+def dirty(owner):
+    return any(
+        not _has_fdb(lladdr=lladdr, vid=vid)
+        for (lladdr, vid) in known_fdbs.get(owner, {})
+    ) or any(
+        not _has_vlan(dev=dev, vid=vid) for (dev, vid) in known_vlans.get(owner, {})
+    )
 
 
+@metrics.timed(metrics.ensure_duration, function="BridgeManager.ensure_fdb")
 def ensure_fdb(*, lladdr, vid):
-    global known_fdbs
-
-    known_fdbs.append({"mac": lladdr, "vlan": vid})
+    claim(known_fdbs, (lladdr, vid))
 
     log.info(f"Ensuring FDB entry for {lladdr} on VLAN {vid}")
-    for entry in state["fdb"]:
-        if (
-            entry["mac"] == lladdr
-            and entry["vlan"] == vid
-            and (
-                entry["flags"] == ["sticky"]
-                # If the FDB was previously learned from a remote VTEP and installed
-                # by FRR, it'll have the extern_learn flag, which will stay there if
-                # we take over management of it. However there does no appear to be a
-                # way of creating a FDB entry from scratch with both flags in one go,
-                # nor a way of clearing the extern_learn flag with 'bridge fdb replace',
-                # so just accept both cases for now, even though it would be more
-                # appropriate to ensure the extern_learn flag is either always or never
-                # present on the fdb entries managed by the agent. 
-                or entry["flags"] == ["extern_learn", "sticky"]
-            )
-            and entry["master"] == conf["bridge"]["name"]
-            and entry["state"] == "static"
-        ):
-            log.debug(f"…already present: {entry}")
-            return
+    if _has_fdb(lladdr=lladdr, vid=vid):
+        log.debug(f"…already present")
+        return
     log.warning(f"Adding static sticky FDB entry for {lladdr} on VLAN {vid}")
-    cmd(
-        [
-            "bridge",
-            "fdb",
-            "replace",
-            lladdr,
-            "dev",
-            conf["bridge"]["veth"],
-            "master",
-            "vlan",
-            str(vid),
-            "static",
-            "sticky",
-        ]
+    batch(
+        "replace_fdb",
+        mac=lladdr,
+        dev=conf["bridge"]["veth"],
+        vid=vid,
+        resource=f"FDB entry {lladdr} on VLAN {vid}",
     )
 
 
+@metrics.timed(metrics.ensure_duration, function="BridgeManager.ensure_vlan")
 def ensure_vlan(*, dev, vid, tagged=True):
-    global known_vlans
-
-    known_vlans.setdefault(dev, [])
-    known_vlans[dev].append(vid)
+    claim(known_vlans, (dev, vid))
 
     log.info(f"Ensuring bridge VLAN {vid} is present on {dev} {tagged=}")
-    cur_vlans = [port["vlans"] for port in state["vlan"] if port["ifname"] == dev]
-    if not cur_vlans or not [vlan for vlan in cur_vlans[0] if vlan["vlan"] == vid]:
+    if not _has_vlan(dev=dev, vid=vid):
         log.warning(f"Adding VLAN {vid} to device {dev} ({tagged=})")
-        cmd(
-            ["bridge", "vlan", "add", "dev", dev, "vid", str(vid)]
-            + (["pvid", "untagged"] if not tagged else [])
-            + (["self"] if dev == conf["bridge"]["name"] else [])
+        batch(
+            "add_vlan",
+            dev=dev,
+            vid=vid,
+            tagged=tagged,
+            bridge=dev == conf["bridge"]["name"],
+            resource=f"VLAN {vid} on {dev}",
         )
 
 
+@metrics.timed(metrics.phase_duration, phase="BridgeManager.prune")
 def prune():
     # It is necessary to remove FDBs before removing the VLANs, otherwise the FDB entries
     # end up in a state where they cannot be removed, with the kernel complaining
     # 'bridge: RTM_DELNEIGH with unconfigured vlan 1234 on veth-to-ovs'
-    for fdb in state["fdb"]:
-        if fdb["state"] != "static":
+    known = claimed(known_fdbs)
+    for fdb in state["fdb"].values():
+        if fdb.state != "static":
             continue
-        if {"mac": fdb["mac"], "vlan": fdb["vlan"]} in known_fdbs:
+        if (fdb.mac, fdb.vlan) in known:
             continue
         log.warning(f"Removing orphaned FDB entry {fdb}")
-        cmd(
-            [
-                "bridge",
-                "fdb",
-                "del",
-                fdb["mac"],
-                "dev",
-                conf["bridge"]["veth"],
-                "master",
-                "vlan",
-                str(fdb["vlan"]),
-            ]
+        batch(
+            "del_fdb",
+            mac=fdb.mac,
+            dev=conf["bridge"]["veth"],
+            vid=fdb.vlan,
+            resource=f"orphan FDB entry {fdb.mac} on VLAN {fdb.vlan}",
         )
 
-    for dev in state["vlan"]:
+    known = claimed(known_vlans)
+    for ifname, vlans in state["vlan"].items():
         # Only consider devices that either are the EVPN bridge itself, or have the EVPN
         # bridge as their master. Otherwise we'll end up trying to remove the default
         # VLAN from the untagged IRB bridge device associated with L3VNIs
-        if dev["ifname"] != conf["bridge"]["name"] and not [
-            x
-            for x in state["link"]
-            if x["ifname"] == dev["ifname"] and x["master"] == conf["bridge"]["name"]
-        ]:
-            log.debug(f"Ignoring VLANs on {dev['ifname']}, not part of EVPN bridge")
+        if (
+            ifname != conf["bridge"]["name"]
+            and state["link"][ifname].master != conf["bridge"]["name"]
+        ):
+            log.debug(f"Ignoring VLANs on {ifname}, not part of EVPN bridge")
             continue
-        for vlan in dev["vlans"]:
-            ifname = dev["ifname"]
-            vlan = vlan["vlan"]
-            if not vlan in known_vlans.get(ifname, []):
+        for vlan in sorted(vlans):
+            if not (ifname, vlan) in known:
                 log.warning(f"Removing orphaned VLAN {vlan} from {ifname}")
-                cmd(
-                    ["bridge", "vlan", "del", "dev", ifname, "vid", str(vlan)]
-                    + (["self"] if ifname == conf["bridge"]["name"] else [])
+                batch(
+                    "del_vlan",
+                    dev=ifname,
+                    vid=vlan,
+                    bridge=ifname == conf["bridge"]["name"],
+                    resource=f"orphan VLAN {vlan} on {ifname}",
                 )
 
 
-# Ensure the cache is populated during initial import
-update()
+def _has_fdb(*, lladdr, vid):
+    entry = state["fdb"].get((lladdr, vid, conf["bridge"]["name"]))
+    return bool(
+        entry
+        and (
+            entry.flags == ("sticky",)
+            # If the FDB was previously learned from a remote VTEP and installed
+            # by FRR, it'll have the extern_learn flag, which will stay there if
+            # we take over management of it. However there does no appear to be a
+            # way of creating a FDB entry from scratch with both flags in one go,
+            # nor a way of clearing the extern_learn flag with 'bridge fdb replace',
+            # so just accept both cases for now, even though it would be more
+            # appropriate to ensure the extern_learn flag is either always or never
+            # present on the fdb entries managed by the agent.
+            or entry.flags == ("extern_learn", "sticky")
+        )
+        and entry.state == "static"
+    )
+
+
+def _has_vlan(*, dev, vid):
+    return vid in state["vlan"].get(dev, ())
+
+
+def _fdb_key(entry):
+    return (entry.mac, entry.vlan, entry.master)
@@ -25,10 +25,24 @@ conf = configparser.ConfigParser()
 
 # Set defaults
 conf["agent"] = {
+    "batch_workers": 4,
+    "dataplane": "iproute2",
+    "debounce": 0.1,
     "distributed_floating_ips": "true",
+    "frr_config": "/etc/frr/frr.conf",
+    "frr_drift_check_interval": 300,
+    "frr_reload": "/usr/libexec/frr/frr-reload.py",
+    "frr_transport": "vtysh",
+    "frr_vty_socket_dir": "/var/run/frr",
     "interval": 1,
+    "interval_jitter": 0.1,
     "loglevel": "WARNING",
+    "max_interval": 4,
+    "metrics_address": "localhost",
     "physical_network": "physnet1",
+    "profile_dir": "/var/tmp/evpn_agent",
+    "profile_iterations": 1,
+    "resync_interval": 60,
     "rt_proto": "255",
     "rt_table_offset": "100000000",
 }
@@ -42,14 +56,13 @@ conf["db"] = {
     "database": "neutron",
 }
 conf["ovs"] = {
+    "db_socket": "/var/run/openvswitch/db.sock",
+    "db_timeout": 10,
     "name": "br-ex",
     "veth": "veth-to-evpn",
 }
 
-# Read config file
-conf.read("/etc/neutron/evpn_agent.ini")
-
-# Add config overrides from commmand line
+# Command line options
 parser = optparse.OptionParser()
 parser.add_option(
     "-1",
@@ -67,6 +80,15 @@ parser.add_option(
     action="store_true",
     help="Set log level to DEBUG",
 )
+parser.add_option(
+    "-p",
+    "--profile",
+    dest="profile",
+    default=0,
+    type="int",
+    metavar="N",
+    help="Profile the first N full iterations of the main loop",
+)
 parser.add_option(
     "-v",
     "--verbose",
@@ -76,12 +98,21 @@ parser.add_option(
     help="Set log level to INFO",
 )
 
-opts, remainder = parser.parse_args()
 
-if opts.debug:
-    conf["agent"]["loglevel"] = "DEBUG"
-elif opts.verbose:
-    conf["agent"]["loglevel"] = "INFO"
+def load(args=None):
+    """Reads the config file, and applies any overrides from the command line (by
+    default sys.argv)"""
+    conf.read("/etc/neutron/evpn_agent.ini")
+
+    opts, remainder = parser.parse_args(args)
+
+    if opts.debug:
+        conf["agent"]["loglevel"] = "DEBUG"
+    elif opts.verbose:
+        conf["agent"]["loglevel"] = "INFO"
+
+    if opts.oneshot:
+        conf["agent"]["oneshot"] = str(opts.oneshot)
 
-if opts.oneshot:
-    conf["agent"]["oneshot"] = str(opts.oneshot)
+    if opts.profile:
+        conf["agent"]["profile"] = str(opts.profile)
@@ -0,0 +1,355 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The interface between the managers and the dataplane they manage, i.e., the links,
+# addresses, neighbours, routes, bridge VLANs and FDB entries of the kernel. The
+# managers read the dataplane using the dump_foo() functions, keep their caches up to
+# date by subscribing to change notifications (see subscribe() and sync()), and change
+# it by queueing operations with batch() which are executed by flush().
+#
+# All of these are implemented by a backend (see Backend), selected by the dataplane
+# option: iproute2 (see iproute2.py), which manages the kernel of the host using
+# rtnetlink and the ip and bridge commands, or simulated (see simkernel.py), an
+# in-memory simulation of the kernel which is useful for testing and profiling.
+
+import abc
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import errno
+import logging
+
+from . import metrics
+from .config import conf
+from .netlink import rt_proto
+
+log = logging.getLogger(__name__)
+
+# The backend in use, and its monitor, see init()
+backend = None
+monitor = None
+
+# The caches kept up to date with change notifications, see subscribe()
+subscribers = []
+
+# Operations waiting to be executed, per kind (see batch())
+pending = {}
+
+# The kinds of operations, by object and whether or not they remove it, along with the
+# kinds of operations that must be executed before them if queued at the same time.
+# For example, addresses can only be added to links that exist, routes via a gateway
+# can only be added once the gateway's subnet is present, bridge FDB entries must be
+# removed before their VLANs, and links must be removed last. Neighbours and routes
+# must be removed before any are added, as one that is replaced (e.g., a route with a
+# new gateway) is removed and added again with the same key.
+dependencies = {
+    ("link", False): {("link", True)},
+    ("address", False): {("link", False)},
+    ("neigh", False): {("link", False), ("neigh", True)},
+    ("route", False): {("link", False), ("address", False), ("route", True)},
+    ("vlan", False): {("link", False)},
+    ("fdb", False): {("vlan", False)},
+    ("fdb", True): set(),
+    ("vlan", True): {("fdb", True)},
+    ("neigh", True): set(),
+    ("route", True): set(),
+    ("address", True): {("route", True)},
+    ("link", True): {
+        ("vlan", True),
+        ("neigh", True),
+        ("address", True),
+    },
+}
+
+
+class Error(Exception):
+    """Raised by a backend when an operation is rejected, with the error message"""
+
+
+class BatchError(Exception):
+    """Raised by flush() if any of the queued operations failed. The failures
+    attribute holds the resource, operation and error message of each of them."""
+
+    def __init__(self, failures):
+        super().__init__(f"{len(failures)} batched operation(s) failed")
+        self.failures = failures
+
+
+class Backend(abc.ABC):
+    """The interface implemented by the backends. The dump methods return the records
+    defined in netlink.py, and monitor() returns an object with a socket (sock) that
+    becomes readable when there are change notifications, and a read() method which
+    returns the (kind, action, record) of each of them without blocking, as described
+    for subscribe().
+
+    The remaining methods are the operations queued by batch(), named after the action
+    and the kind of object they apply to. Links are identified by name, and their
+    attributes are given using the field names of the Link record (plus "up"), and the
+    attributes specific to their type using the keys of its info_data (or slave_data).
+    execute() executes a queue of operations of the same kind, by default by calling
+    the method of each of them in turn."""
+
+    @abc.abstractmethod
+    def monitor(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def dump_links(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def dump_addresses(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def dump_neighs(self, *, proto):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def dump_routes(self, *, proto):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def dump_fdb(self, *, dev, master):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def dump_bridge_ports(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_link(self, *, name, type, link=None, attrs={}, type_attrs={}):
+        """Creates a link, which is only set up if "up" is among the attributes. The
+        link is the lower device of a VLAN device or VXLAN interface, or the name of
+        the peer of a veth pair."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_link(self, *, name, attrs={}, type=None, type_attrs={}):
+        """Changes the attributes of a link. The type is bridge_slave in order to
+        change the attributes of a bridge port."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def del_link(self, *, name):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_address(self, *, dev, address):
+        """Adds an address given as "address/prefixlen" (without DAD if IPv6)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def del_address(self, *, dev, address):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def replace_neigh(self, *, dst, dev, lladdr, proto):
+        """Adds or replaces a permanent neighbour entry"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def del_neigh(self, *, dst, dev, lladdr, proto):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_route(self, *, route, proto):
+        """Adds a route given as a routemanager.Route"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def del_route(self, *, dst, table, proto):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_vlan(self, *, dev, vid, tagged=True, bridge=False):
+        """Adds a VLAN to a bridge port, or to the bridge itself if bridge is true"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def del_vlan(self, *, dev, vid, bridge=False):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def replace_fdb(self, *, mac, dev, vid):
+        """Adds or replaces a static sticky entry in the FDB of the bridge the device
+        is a port of"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def del_fdb(self, *, mac, dev, vid):
+        raise NotImplementedError
+
+    def execute(self, kind, queue):
+        """Executes a list of queued operations of the given kind, returning the
+        failed ones"""
+        failures = []
+        for operation, args, resource in queue:
+            try:
+                getattr(self, operation)(**args)
+            except Error as e:
+                description = f"{operation} " + " ".join(
+                    f"{k}={v}" for k, v in args.items()
+                )
+                log.error(f"Operation '{description}' for {resource} failed: {e}")
+                failures.append((resource, description, str(e)))
+        return failures
+
+
+def init():
+    """Sets up the backend, unless one has been set up already, and opens its monitor.
+    This must be done before any of the caches are first populated, so that no changes
+    made in between can go unnoticed."""
+    global backend, monitor
+    if backend is None:
+        name = conf["agent"]["dataplane"]
+        if name == "iproute2":
+            from .iproute2 import Iproute2
+
+            backend = Iproute2()
+        elif name == "simulated":
+            from .simkernel import SimulatedKernel
+
+            backend = SimulatedKernel()
+        else:
+            raise ValueError(f"Unknown dataplane {name}")
+    monitor = backend.monitor()
+
+
+def subscribe(*, handler, update):
+    """Registers a cache that should be kept up to date with the dataplane. handler()
+    is called for every change notification with the kind of object ("link",
+    "bridge_port", "address", "neigh", "fdb" or "route"), the action ("new" or "del"),
+    and the object itself, as a record of the corresponding type in netlink.py.
+    update() is called whenever the cache must be repopulated from scratch."""
+    subscribers.append((handler, update))
+
+
+def sync():
+    """Applies any change notifications received since the previous call to the caches
+    of the subscribers, returning whether there were any that may concern the kernel
+    objects managed by the agent (see relevant()). If notifications have been lost due
+    to the socket buffer overflowing, the caches are repopulated instead."""
+    try:
+        events = monitor.read()
+    except OSError as e:
+        if e.errno != errno.ENOBUFS:
+            raise
+        log.warning("Dataplane monitor overflowed, resynchronising all kernel state")
+        resync()
+        return True
+    for event in events:
+        for handler, _ in subscribers:
+            handler(*event)
+    return any(relevant(*event) for event in events)
+
+
+def relevant(kind, action, record):
+    """Returns whether a change notification may concern a kernel object managed by the
+    agent, which neighbours and routes of other protocols (e.g., those of FRR) and
+    learned FDB entries do not"""
+    if kind in ("neigh", "route"):
+        return record.protocol == rt_proto(conf["agent"]["rt_proto"])
+    if kind == "fdb":
+        return record.state in ("permanent", "static")
+    return True
+
+
+@metrics.timed(metrics.phase_duration, phase="dataplane.resync")
+def resync():
+    """Repopulates the caches of all subscribers from scratch"""
+    # Any notifications received while the caches are being repopulated are applied by
+    # the next sync(), which is harmless, so only those already queued are discarded
+    while True:
+        try:
+            monitor.read()
+            break
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+    # The caches are independent of each other, so they are repopulated concurrently
+    with ThreadPoolExecutor(max_workers=len(subscribers) or 1) as executor:
+        for future in [executor.submit(update) for _, update in subscribers]:
+            future.result()
+
+
+def dump_links():
+    return backend.dump_links()
+
+
+def dump_addresses():
+    return backend.dump_addresses()
+
+
+def dump_neighs(*, proto):
+    return backend.dump_neighs(proto=proto)
+
+
+def dump_routes(*, proto):
+    return backend.dump_routes(proto=proto)
+
+
+def dump_fdb(*, dev, master):
+    return backend.dump_fdb(dev=dev, master=master)
+
+
+def dump_bridge_ports():
+    return backend.dump_bridge_ports()
+
+
+def batch(operation, *, resource=None, **args):
+    """Queues an operation (e.g., "add_link", see Backend) with the given arguments, to
+    be executed by flush() along with any other queued operations. The resource the
+    operation is issued on behalf of is included when reporting failures."""
+    log.debug(f"Queueing: {operation} {args}")
+    action, obj = operation.split("_", 1)
+    pending.setdefault((obj, action == "del"), []).append((operation, args, resource))
+
+
+@metrics.timed(metrics.phase_duration, phase="flush")
+def flush():
+    """Executes all queued operations. The operations of each kind are executed in
+    order by the backend (e.g., using a single 'ip -batch' or 'bridge -batch' process),
+    while different kinds of operations are executed concurrently (using up to
+    batch_workers threads) unless one depends on the other (see dependencies). Failed
+    operations do not prevent the remaining ones from being executed, but cause
+    BatchError to be raised at the end."""
+    global pending
+    queued, pending = pending, {}
+
+    # Wait for the kinds each kind depends on, directly or indirectly, if queued
+    def waits_for(kind, seen=()):
+        waits = set()
+        for dep in dependencies[kind]:
+            if dep not in seen:
+                waits |= ({dep} & queued.keys()) | waits_for(dep, seen + (kind,))
+        return waits
+
+    waiting = {kind: waits_for(kind) for kind in queued}
+    failures = []
+    with ThreadPoolExecutor(max_workers=int(conf["agent"]["batch_workers"])) as pool:
+        running = {}
+        while waiting or running:
+            for kind in [k for k, waits in waiting.items() if not waits]:
+                del waiting[kind]
+                running[pool.submit(backend.execute, kind, queued[kind])] = kind
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind = running.pop(future)
+                for waits in waiting.values():
+                    waits.discard(kind)
+                failures.extend(future.result())
+    if failures:
+        raise BatchError(failures)
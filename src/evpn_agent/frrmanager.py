@@ -15,36 +15,131 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
 import ipaddress
 import logging
+import os
 import re
+import time
 from tempfile import NamedTemporaryFile
 from textwrap import dedent
 from importlib.machinery import SourceFileLoader
-from .utils import cmd
+from . import metrics
+from .config import conf
+from .utils import claim, claimed, cmd
+from .vty import Vty
 
 log = logging.getLogger(__name__)
 
-frrlib = SourceFileLoader("frrlib", "/usr/libexec/frr/frr-reload.py").load_module()
-
-vtysh = frrlib.Vtysh()
+# frr-reload.py and the vtysh wrapper it provides, loaded by init(). The running config
+# is fetched and changes are applied either by forking vtysh, or by talking to the
+# daemons directly via their VTY sockets (see vty.py), depending on the client used.
+# Reading frr.conf requires vtysh either way.
+frrlib = None
+vtysh = None
+client = None
 
 running_config = None
-target_config = None
+known_config = {}
+asn = None
+
+# The fingerprint of the target config last applied successfully, and the time at which
+# the running config is to be compared with the target config even if it is unchanged
+applied = None
+next_drift_check = 0
+
+# Whether the running config has been loaded by prefetch() since the last finalise()
+prefetched = False
+
+# The normalised lines of frr.conf along with its mtime, and of each snippet in
+# the target config, so that they only have to be produced once
+static_lines = (None, [])
+snippet_lines = {}
 
 
+def init():
+    global frrlib, vtysh, client
+
+    frrlib = SourceFileLoader("frrlib", conf["agent"]["frr_reload"]).load_module()
+    vtysh = frrlib.Vtysh()
+    if conf["agent"]["frr_transport"] == "vty":
+        client = Vty(sockdir=conf["agent"]["frr_vty_socket_dir"])
+    else:
+        client = vtysh
+    # The running config is needed right away by get_asn(), as well as by the first
+    # finalise()
+    prefetch()
+
+
+@metrics.timed(metrics.phase_duration, phase="FrrManager.update")
 def update():
-    global running_config
-    global target_config
+    global running_config, asn
 
-    running_config = frrlib.Config(vtysh=vtysh)
+    running_config = frrlib.Config(vtysh=client)
     running_config.load_from_show_running(daemon=None)
+    asn = None
+    for line in running_config.contexts:
+        if match := re.match(r"router bgp (\d+)$", line[0]):
+            asn = match.group(1)
+            break
 
-    target_config = frrlib.Config(vtysh=vtysh)
-    target_config.load_from_file("/etc/frr/frr.conf")
+
+def prefetch():
+    """Loads the running config ahead of finalise() if it is certain to be needed, i.e.,
+    if the previous attempt to apply the target config failed, or if it is time for a
+    drift check. This allows the main loop to load it concurrently with other state."""
+    global prefetched
+    if prefetched:
+        return
+    if applied is None or time.monotonic() >= next_drift_check:
+        update()
+        prefetched = True
 
 
 def finalise():
+    global applied, next_drift_check, prefetched
+    was_prefetched, prefetched = prefetched, False
+
+    # Fetching and parsing the running config is expensive, so only do it if the target
+    # config has changed since it was last applied successfully, or if it is time to
+    # check whether the running config has drifted away from it
+    target = _fingerprint()
+    if target == applied and time.monotonic() < next_drift_check:
+        log.debug("FRR target config is unchanged, skipping comparison")
+        return
+    applied = None
+    next_drift_check = time.monotonic() + int(conf["agent"]["frr_drift_check_interval"])
+    if not was_prefetched:
+        update()
+
+    changes = _compare()
+    if changes:
+        _apply(changes)
+    applied = target
+
+
+@metrics.timed(metrics.phase_duration, phase="FrrManager.compare")
+def _compare():
+    """Returns the (ctx, line, delete) changes needed to make the running config match
+    the target config"""
+    global snippet_lines
+
+    # The target config consists of the static config file plus all the known config
+    # snippets. Identical snippets (e.g., the VRF config for an L3VNI shared by many
+    # networks) are only claimed, and thus loaded, once. The snippets are generated by
+    # the agent itself in the same format as 'vtysh -m' produces, so rather than having
+    # frr-reload read each one from a file through vtysh, their lines are normalised
+    # the same way it would and parsed into contexts in one go along with frr.conf.
+    snippet_lines = {
+        frrconf: snippet_lines.get(frrconf) or _normalise(frrconf)
+        for frrconf in claimed(known_config)
+    }
+    target_config = frrlib.Config(vtysh=vtysh)
+    target_config.lines = list(_static_lines())
+    for lines in snippet_lines.values():
+        target_config.lines.extend(lines)
+    target_config.load_contexts()
+
     (add, delete) = frrlib.compare_context_objects(target_config, running_config)
 
     # The comparison may produce redundant commands, e.g., if the same resource has been
@@ -52,19 +147,71 @@ def finalise():
     # the VRF/L3VNI mapping will have been ensured once per network). Run them through a
     # dict to get rid of the duplicates (while maintaining the ordering of the first
     # occurrences, which set() unfortunately won't do for us).
+    return [(ctx, line, True) for ctx, line in dict.fromkeys(delete).keys()] + [
+        (ctx, line, False) for ctx, line in dict.fromkeys(add).keys()
+    ]
+
+
+@metrics.timed(metrics.phase_duration, phase="FrrManager.apply")
+def _apply(changes):
+    """Applies a list of (ctx, line, delete) changes in one go, in the given order.
+    Failed changes do not prevent the remaining ones from being applied, but cause
+    frrlib.VtyshException to be raised at the end."""
+    blocks = []
+    for ctx, line, delete in changes:
+        blocks.append(frrlib.lines_to_config(ctx, line, delete=delete))
+        log.warning(f"Configuring FRR: {blocks[-1]}")
+    log.debug(f"Applying {len(changes)} FRR config change(s) in one session")
+    if isinstance(client, Vty):
+        errors = client.configure(blocks)
+    else:
+        errors = _configure_vtysh(blocks)
+
+    for i, error in errors:
+        ctx, line, delete = changes[i]
+        log.error(
+            f"Failed to {'delete' if delete else 'add'} FRR config {line!r} in "
+            f"context {ctx}: {error}"
+        )
+    if errors:
+        raise frrlib.VtyshException(
+            f"{len(errors)} of {len(changes)} FRR config change(s) failed"
+        )
+
+
+def _configure_vtysh(blocks):
+    # Remember which block each line in the file belongs to, in order to be able to
+    # attribute any errors reported by vtysh (which refers to them by line number)
+    lines = []
+    with NamedTemporaryFile(mode="w") as tmp:
+        for i, block in enumerate(blocks):
+            for text in block:
+                tmp.file.write(text + "\n")
+                lines.append(i)
+        tmp.file.flush()
+        proc = cmd(
+            vtysh.common_args + ["-f", tmp.name],
+            check=False,
+            capture_output=True,
+            text=True,
+        )
+
+    errors = []
+    for msg in proc.stderr.splitlines():
+        if match := re.match(r"line (\d+): (.*)", msg):
+            errors.append((lines[int(match.group(1)) - 1], match.group(2).strip()))
+    if proc.returncode and not errors:
+        raise frrlib.VtyshException(
+            f"vtysh returned status {proc.returncode}: {proc.stderr}"
+        )
+    return errors
 
-    for ctx, line in dict.fromkeys(delete).keys():
-        cmd = frrlib.lines_to_config(ctx, line, delete=True)
-        log.warning(f"Configuring FRR: {cmd}")
-        vtysh(["configure"] + cmd)
-    for ctx, line in dict.fromkeys(add).keys():
-        cmd = frrlib.lines_to_config(ctx, line, delete=False)
-        log.warning(f"Configuring FRR: {cmd}")
-        vtysh(["configure"] + cmd)
 
-    update()
+def forget(owner):
+    known_config.pop(owner, None)
 
 
+@metrics.timed(metrics.ensure_duration, function="FrrManager.ensure_vrf")
 def ensure_vrf(*, vrf, l3vni=None):
     asn = get_asn()
 
@@ -131,6 +278,9 @@ def ensure_vrf(*, vrf, l3vni=None):
     add_config(frrconf)
 
 
+@metrics.timed(
+    metrics.ensure_duration, function="FrrManager.ensure_advertise_connected"
+)
 def ensure_advertise_connected(*, vrf, vlanid):
     add_config(
         dedent(
@@ -143,6 +293,7 @@ def ensure_advertise_connected(*, vrf, vlanid):
     )
 
 
+@metrics.timed(metrics.ensure_duration, function="FrrManager.ensure_ra")
 def ensure_ra(*, dev, prefix, mode):
     log.info(f"Ensuring ICMPv6 RA on {dev} for {prefix} ({mode})")
 
@@ -165,6 +316,7 @@ def ensure_ra(*, dev, prefix, mode):
     add_config(frrconf)
 
 
+@metrics.timed(metrics.ensure_duration, function="FrrManager.ensure_bgp_listener")
 def ensure_bgp_listener(*, dev, vrf, subnet, route):
     log.info(f"Ensuring dynamic BGP listener on {subnet} @ {dev} for {route} in {vrf}")
     asn = get_asn()
@@ -208,17 +360,45 @@ def add_config(frrconf):
     log.debug("Adding to FRR target config:")
     for line in frrconf.splitlines():
         log.debug("> " + line)
-    with NamedTemporaryFile(mode="w") as tmp:
-        tmp.file.write(frrconf)
-        tmp.file.flush()
-        target_config.load_from_file(tmp.name)
+    claim(known_config, frrconf)
 
 
 def get_asn():
-    for line in running_config.contexts:
-        if match := re.match(r"router bgp (\d+)$", line[0]):
-            return match.group(1)
+    return asn
+
+
+def _static_lines():
+    global static_lines
+    path = conf["agent"]["frr_config"]
+    mtime = os.stat(path).st_mtime_ns
+    if static_lines[0] != mtime:
+        log.info(f"Loading {path}")
+        config = frrlib.Config(vtysh=vtysh)
+        config.load_from_file(path)
+        static_lines = (mtime, config.lines)
+    return static_lines[1]
+
+
+def _normalise(frrconf):
+    # Mirrors what frrlib.Config.load_from_file() does to each line. Newer versions of
+    # frr-reload.py also normalise MAC addresses, and only IPv6 addresses otherwise.
+    normalise_line = getattr(
+        frrlib, "get_normalized_mac_ip_line", frrlib.get_normalized_ipv6_line
+    )
+    lines = []
+    for line in frrconf.splitlines():
+        line = " ".join(line.split())
+        if ":" in line:
+            line = normalise_line(line)
+        lines.append(line)
+    return lines
 
 
-# Ensure the cache is populated during initial import
-update()
+def _fingerprint():
+    digest = hashlib.sha256(
+        str(os.stat(conf["agent"]["frr_config"]).st_mtime_ns).encode()
+    )
+    for frrconf in claimed(known_config):
+        digest.update(b"\0" + frrconf.encode())
+    return digest.hexdigest()
+
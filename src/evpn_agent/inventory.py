@@ -17,23 +17,48 @@
 
 import pymysql.cursors
 import socket
+from typing import NamedTuple
 
+from . import metrics
 from .config import conf
 
-dbconn = pymysql.connect(**conf["db"])
+dbconn = None
 
 
-def run_query(sql, param=None):
-    """Executes an SQL query and returns the result"""
-    cur = dbconn.cursor(pymysql.cursors.DictCursor)
-    cur.execute(sql, param)
-    dbconn.commit()
-    return cur.fetchall()
+class Snapshot(NamedTuple):
+    networks: list
+    # network id → list of subnets
+    subnets: dict
+    # subnet id → list of subnet routes
+    subnetroutes: dict
+    # segmentation id → list of ports
+    ports: dict
+    # (router device id, address scope id) → list of tenant network prefixes
+    tenant_networks: dict
+
+
+def init():
+    global dbconn
+    dbconn = pymysql.connect(**conf["db"])
+
+
+def run_query(sql, param=None, *, function):
+    """Executes an SQL query and returns the result. The name of the function making
+    the query is used to label the metrics about it."""
+    metrics.db_queries.inc(function=function)
+    with metrics.db_query_duration.time(function=function):
+        cur = dbconn.cursor(pymysql.cursors.DictCursor)
+        cur.execute(sql, param)
+        dbconn.commit()
+        rows = cur.fetchall()
+    metrics.db_rows.inc(len(rows), function=function)
+    return rows
 
 
 def get_ports():
     """Returns a list of active ports (either normal of floating IPs) on this particular
-    compute node"""
+    compute node, along with the time they (or the floating IP) were last updated, which
+    for a newly activated port is the time it became active"""
 
     query = """
         SELECT
@@ -42,14 +67,17 @@ def get_ports():
             ports.device_id                 AS device_id,
             ports.device_owner              AS device_owner,
             ipallocations.ip_address        AS ip_address,
-            ipallocations.subnet_id         AS subnet_id
+            ipallocations.subnet_id         AS subnet_id,
+            standardattributes.updated_at   AS updated_at
         FROM
             ports LEFT JOIN ipallocations ON ports.id = ipallocations.port_id,
             ml2_port_bindings,
             networks,
-            networksegments
+            networksegments,
+            standardattributes
         WHERE
             ports.network_id = networks.id
+            AND ports.standard_attr_id = standardattributes.id
             AND ports.id = ml2_port_bindings.port_id
             AND networks.id = networksegments.network_id
             AND networksegments.network_type = 'vlan'
@@ -66,15 +94,18 @@ def get_ports():
                 ports.device_id                 AS device_id,
                 ports.device_owner              AS device_owner,
                 floatingips.floating_ip_address AS ip_address,
-                NULL                            AS subnet_id
+                NULL                            AS subnet_id,
+                standardattributes.updated_at   AS updated_at
             FROM
                 floatingips,
                 ports,
                 ml2_port_bindings,
                 networks,
-                networksegments
+                networksegments,
+                standardattributes
             WHERE
                 floatingips.floating_network_id = networks.id
+                AND floatingips.standard_attr_id = standardattributes.id
                 AND floatingips.fixed_port_id = ml2_port_bindings.port_id
                 AND floatingips.floating_port_id = ports.id
                 AND networks.id = networksegments.network_id
@@ -86,9 +117,107 @@ def get_ports():
     return run_query(
         query,
         {"host": socket.getfqdn(), "physnet": conf["agent"]["physical_network"]},
+        function="get_ports",
     )
 
 
+@metrics.timed(metrics.phase_duration, phase="Inventory.get_fingerprint")
+def get_fingerprint():
+    """Returns a cheap fingerprint of the Neutron state relevant to this particular
+    compute node. This changes whenever any of the resources that feed into the
+    snapshot are created, updated or deleted, so that it can be used to determine
+    whether or not the desired state needs to be rebuilt. Neutron bumps the revision
+    number of a port when its bindings or IP allocations change, and the revision
+    number of a subnet when its routes change. The evpnnetworks table has no revision
+    numbers, so a checksum of its contents is used instead."""
+
+    revisions = """
+        CONCAT_WS(
+            '/',
+            COUNT(*),
+            SUM(standardattributes.revision_number),
+            MAX(standardattributes.updated_at)
+        )"""
+
+    return run_query(
+        f"""SELECT
+            (SELECT {revisions}
+             FROM
+                ports,
+                ml2_port_bindings,
+                standardattributes
+             WHERE
+                ports.id = ml2_port_bindings.port_id
+                AND ports.standard_attr_id = standardattributes.id
+                AND (
+                    ml2_port_bindings.host = %(host)s
+                    OR ports.device_owner = "network:router_interface"
+                )
+            ) AS ports,
+            (SELECT {revisions}
+             FROM
+                networks,
+                networksegments,
+                standardattributes
+             WHERE
+                networks.id = networksegments.network_id
+                AND networks.standard_attr_id = standardattributes.id
+                AND networksegments.network_type = 'vlan'
+                AND networksegments.physical_network = %(physnet)s
+            ) AS networks,
+            (SELECT {revisions}
+             FROM
+                subnets,
+                networksegments,
+                standardattributes
+             WHERE
+                subnets.network_id = networksegments.network_id
+                AND subnets.standard_attr_id = standardattributes.id
+                AND networksegments.network_type = 'vlan'
+                AND networksegments.physical_network = %(physnet)s
+            ) AS subnets,
+            (SELECT {revisions}
+             FROM
+                subnetpools,
+                standardattributes
+             WHERE
+                subnetpools.standard_attr_id = standardattributes.id
+            ) AS subnetpools,
+            (SELECT {revisions}
+             FROM
+                floatingips,
+                networksegments,
+                standardattributes
+             WHERE
+                floatingips.floating_network_id = networksegments.network_id
+                AND floatingips.standard_attr_id = standardattributes.id
+                AND networksegments.network_type = 'vlan'
+                AND networksegments.physical_network = %(physnet)s
+            ) AS floatingips,
+            (SELECT
+                CONCAT_WS(
+                    '/',
+                    COUNT(*),
+                    BIT_XOR(
+                        CRC32(
+                            CONCAT_WS(
+                                ',',
+                                id,
+                                IFNULL(l2vni, 'NULL'),
+                                IFNULL(l3vni, 'NULL'),
+                                IFNULL(advertise_connected, 'NULL')
+                            )
+                        )
+                    )
+                )
+             FROM
+                evpnnetworks
+            ) AS evpnnetworks""",
+        {"host": socket.getfqdn(), "physnet": conf["agent"]["physical_network"]},
+        function="get_fingerprint",
+    )[0]
+
+
 def get_networks():
     """Returns a list of networks with active ports (ether normal of floating IPs) on
     this particular compute node"""
@@ -139,14 +268,18 @@ def get_networks():
             AND ml2_port_bindings.status = 'ACTIVE'
             AND ml2_port_bindings.host = %(host)s""",
         {"host": socket.getfqdn(), "physnet": conf["agent"]["physical_network"]},
+        function="get_networks",
     )
 
 
-def get_subnets(*, network):
-    """Returns a list of subnets on a given network object"""
+def get_subnets(*, networks):
+    """Returns a list of subnets on the given network IDs"""
+    if not networks:
+        return []
     return run_query(
         """SELECT
             subnets.id                   AS id,
+            subnets.network_id           AS network_id,
             subnets.gateway_ip           AS gateway_ip,
             subnets.cidr                 AS cidr,
             subnets.enable_dhcp          AS enable_dhcp,
@@ -154,32 +287,42 @@ def get_subnets(*, network):
             subnetpools.address_scope_id AS address_scope_id
         FROM
             subnets LEFT JOIN subnetpools ON subnets.subnetpool_id = subnetpools.id
-        WHERE            
-            subnets.network_id = %(network_id)s""",
-        {"network_id": network},
+        WHERE
+            subnets.network_id IN %(network_ids)s""",
+        {"network_ids": tuple(networks)},
+        function="get_subnets",
     )
 
 
-def get_subnetroutes(*, subnet_id):
-    """Returns a list of static routes on a given subnet object"""
+def get_subnetroutes(*, subnets):
+    """Returns a list of static routes on the given subnet IDs"""
+    if not subnets:
+        return []
     return run_query(
         """SELECT
+            subnet_id,
             destination,
             nexthop
         FROM
             subnetroutes
         WHERE
-            subnetroutes.subnet_id = %(subnet_id)s""",
-        {"subnet_id": subnet_id},
+            subnetroutes.subnet_id IN %(subnet_ids)s""",
+        {"subnet_ids": tuple(subnets)},
+        function="get_subnetroutes",
     )
 
 
-def get_tenant_networks(*, device_id, address_scope_id):
-    """Return a list of tenant network prefixes behind a given router, where the
-    tenant network address scope matches that of the router's external gateway"""
+def get_tenant_networks(*, device_ids):
+    """Return a list of tenant network prefixes behind the given routers, along with
+    the address scope of each prefix (so that it can be matched to the address scope of
+    the router's external gateway)"""
+    if not device_ids:
+        return []
     return run_query(
         """SELECT
-            subnets.cidr AS cidr
+            ports.device_id              AS device_id,
+            subnetpools.address_scope_id AS address_scope_id,
+            subnets.cidr                 AS cidr
         FROM
             ipallocations,
             ports,
@@ -190,7 +333,43 @@ def get_tenant_networks(*, device_id, address_scope_id):
             AND subnets.id = ipallocations.subnet_id
             AND subnetpools.id = subnets.subnetpool_id
             AND ports.device_owner = "network:router_interface"
-            AND ports.device_id = %(device_id)s
-            AND subnetpools.address_scope_id = %(address_scope_id)s""",
-        {"device_id": device_id, "address_scope_id": address_scope_id},
+            AND ports.device_id IN %(device_ids)s
+            AND subnetpools.address_scope_id IS NOT NULL""",
+        {"device_ids": tuple(device_ids)},
+        function="get_tenant_networks",
     )
+
+
+@metrics.timed(metrics.phase_duration, phase="Inventory.get_snapshot")
+def get_snapshot():
+    """Returns a Snapshot of all the desired state relevant to this particular compute
+    node. This is fetched using a fixed number of queries, regardless of the amount of
+    networks, subnets and ports involved, and returned grouped for cheap lookups."""
+    ports = get_ports()
+    networks = get_networks()
+    subnets = get_subnets(networks={net["id"] for net in networks})
+    subnetroutes = get_subnetroutes(subnets={subnet["id"] for subnet in subnets})
+    tenant_networks = get_tenant_networks(
+        device_ids={
+            port["device_id"]
+            for port in ports
+            if port["device_owner"] == "network:router_gateway"
+        }
+    )
+
+    return Snapshot(
+        networks=networks,
+        subnets=_group(subnets, lambda subnet: subnet["network_id"]),
+        subnetroutes=_group(subnetroutes, lambda route: route["subnet_id"]),
+        ports=_group(ports, lambda port: port["segmentation_id"]),
+        tenant_networks=_group(
+            tenant_networks, lambda tn: (tn["device_id"], tn["address_scope_id"])
+        ),
+    )
+
+
+def _group(rows, key):
+    groups = {}
+    for row in rows:
+        groups.setdefault(key(row), []).append(row)
+    return groups
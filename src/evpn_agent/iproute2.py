@@ -0,0 +1,206 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import re
+import shlex
+import subprocess
+
+from . import metrics
+from . import netlink
+from .dataplane import Backend
+
+log = logging.getLogger(__name__)
+
+
+class Iproute2(Backend):
+    """The dataplane backend managing the kernel of the host, which is read using
+    rtnetlink (see netlink.py) and changed using the ip and bridge commands. Rather
+    than executing operations one by one, execute() turns each of them into a command
+    line (which is what the operation methods return) and executes all of them using
+    a single 'ip -batch' or 'bridge -batch' process."""
+
+    monitor = staticmethod(netlink.Monitor)
+    dump_links = staticmethod(netlink.dump_links)
+    dump_addresses = staticmethod(netlink.dump_addresses)
+    dump_neighs = staticmethod(netlink.dump_neighs)
+    dump_routes = staticmethod(netlink.dump_routes)
+    dump_fdb = staticmethod(netlink.dump_fdb)
+    dump_bridge_ports = staticmethod(netlink.dump_bridge_ports)
+
+    def add_link(self, *, name, type, link=None, attrs={}, type_attrs={}):
+        args = ["link", "add", "name", name]
+        if type != "veth" and link:
+            args.extend(["link", link])
+        for k, v in attrs.items():
+            args.extend(_link_attr_to_cmd(k, v))
+        args.extend(["type", type])
+        if type == "veth" and link:
+            args.extend(["peer", "name", link])
+        for k, v in type_attrs.items():
+            args.extend(_type_attr_to_cmd(k, v))
+        return args
+
+    def set_link(self, *, name, attrs={}, type=None, type_attrs={}):
+        args = ["link", "set", name]
+        for k, v in attrs.items():
+            args.extend(_link_attr_to_cmd(k, v))
+        if type:
+            args.extend(["type", type])
+        for k, v in type_attrs.items():
+            if type == "bridge_slave":
+                args.extend(_bridge_slave_attr_to_cmd(k, v))
+            else:
+                args.extend(_type_attr_to_cmd(k, v))
+        return args
+
+    def del_link(self, *, name):
+        return ["link", "del", name]
+
+    def add_address(self, *, dev, address):
+        return ["address", "add", "dev", dev, address] + (
+            ["nodad"] if ":" in address else []
+        )
+
+    def del_address(self, *, dev, address):
+        return ["address", "del", "dev", dev, address]
+
+    def replace_neigh(self, *, dst, dev, lladdr, proto):
+        return [
+            "neigh",
+            "replace",
+            dst,
+            "dev",
+            dev,
+            "lladdr",
+            lladdr,
+            "nud",
+            "permanent",
+            "proto",
+            proto,
+        ]
+
+    def del_neigh(self, *, dst, dev, lladdr, proto):
+        return ["neigh", "del", dst, "dev", dev, "lladdr", lladdr, "proto", proto]
+
+    def add_route(self, *, route, proto):
+        return (
+            ["route", "add"]
+            + ([route.type] if route.type else [])
+            + [route.dst]
+            + (["via", route.gateway] if route.gateway else [])
+            + (["dev", route.dev] if route.dev else [])
+            + (["metric", str(route.metric)] if route.metric else [])
+            + (["table", str(route.table)] if route.table else [])
+            + ["proto", proto]
+        )
+
+    def del_route(self, *, dst, table, proto):
+        return ["route", "del", dst, "table", str(table), "proto", proto]
+
+    def add_vlan(self, *, dev, vid, tagged=True, bridge=False):
+        return (
+            ["vlan", "add", "dev", dev, "vid", str(vid)]
+            + (["pvid", "untagged"] if not tagged else [])
+            + (["self"] if bridge else [])
+        )
+
+    def del_vlan(self, *, dev, vid, bridge=False):
+        return ["vlan", "del", "dev", dev, "vid", str(vid)] + (
+            ["self"] if bridge else []
+        )
+
+    def replace_fdb(self, *, mac, dev, vid):
+        return [
+            "fdb",
+            "replace",
+            mac,
+            "dev",
+            dev,
+            "master",
+            "vlan",
+            str(vid),
+            "static",
+            "sticky",
+        ]
+
+    def del_fdb(self, *, mac, dev, vid):
+        return ["fdb", "del", mac, "dev", dev, "master", "vlan", str(vid)]
+
+    def execute(self, kind, queue):
+        tool = "bridge" if kind[0] in ("vlan", "fdb") else "ip"
+        commands = [
+            (getattr(self, operation)(**args), resource)
+            for operation, args, resource in queue
+        ]
+        log.debug(f"Executing {len(commands)} queued {tool} command(s)")
+        metrics.commands.inc(tool=tool)
+        with metrics.command_duration.time(tool=tool):
+            proc = subprocess.run(
+                [tool, "-force", "-batch", "-"],
+                input="".join(shlex.join(args) + "\n" for args, _ in commands),
+                capture_output=True,
+                text=True,
+            )
+        # Any error messages related to a failed command are followed by a line that
+        # identifies it by its line number in the batch
+        failures = []
+        messages = []
+        for line in proc.stderr.splitlines():
+            match = re.match(r"Command failed -:(\d+)", line)
+            if not match:
+                messages.append(line)
+                continue
+            args, resource = commands[int(match.group(1)) - 1]
+            command = shlex.join([tool] + args)
+            error = " ".join(messages) or "unknown error"
+            log.error(f"Command '{command}' for {resource} failed: {error}")
+            failures.append((resource, command, error))
+            messages = []
+        if proc.returncode and not failures:
+            raise subprocess.CalledProcessError(
+                proc.returncode, proc.args, proc.stdout, proc.stderr
+            )
+        return failures
+
+
+def _link_attr_to_cmd(attr, val):
+    if attr == "up":
+        return ["up" if val else "down"]
+    if attr == "inet6_addr_gen_mode":
+        attr = "addrgenmode"
+    if attr == "ifalias":
+        attr = "alias"
+    return [attr, str(val)]
+
+
+def _type_attr_to_cmd(attr, val):
+    if attr == "learning" and val == False:
+        return ["nolearning"]
+    if attr == "learning" and val == True:
+        return ["learning"]
+    if attr == "port":
+        return ["dstport", str(val)]
+    return [attr, str(val)]
+
+
+def _bridge_slave_attr_to_cmd(attr, val):
+    if attr in ["learning", "neigh_suppress"] and val == True:
+        return [attr, "on"]
+    if attr in ["learning", "neigh_suppress"] and val == False:
+        return [attr, "off"]
+    return [attr, str(val)]
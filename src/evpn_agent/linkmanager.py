@@ -16,137 +16,196 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
-from .utils import cmd, jsoncmd
+from . import metrics
+from .dataplane import batch, dump_links, flush, subscribe, sync
+from .utils import claim, claimed
 
 log = logging.getLogger(__name__)
 
-state = None
-known_links = []
+# Links by name, plus the name of each link by index
+state = {}
+ifnames = {}
+known_links = {}
+
+# The links queued for creation since the last commit(), by name. The value is the link
+# type, or None for the peer of a veth pair (which has not been ensured itself yet).
+creating = {}
+
+
+def init():
+    # Ensure the cache is populated, and kept up to date afterwards
+    subscribe(handler=handle_event, update=update)
+    update()
 
 
 def update():
-    global state
-    state = jsoncmd(["ip", "-j", "-d", "link", "show"])
+    global state, ifnames
+    state = {link.ifname: link for link in dump_links()}
+    ifnames = {link.ifindex: name for name, link in state.items()}
 
 
-def finalise():
-    global known_links
-    prune()
-    update()
-    known_links = []
+def handle_event(kind, action, record):
+    if kind != "link":
+        return
+    # Look the link up by index, in case it has been renamed
+    state.pop(ifnames.pop(record.ifindex, None), None)
+    if action == "new":
+        state[record.ifname] = record
+        ifnames[record.ifindex] = record.ifname
+
+
+def forget(owner):
+    known_links.pop(owner, None)
+
+
+def dirty(owner):
+    return any(not get_link(name) for name in known_links.get(owner, []))
 
 
 def list_links():
-    return [link["ifname"] for link in state]
+    return list(state)
 
 
 def get_link(name):
+    return state.get(name)
+
+
+@metrics.timed(metrics.phase_duration, phase="LinkManager.commit")
+def commit():
+    """Executes all queued changes, including the creation of any missing links, and
+    brings the cached link state up to date"""
     try:
-        return [link for link in state if link["ifname"] == name][0]
-    except IndexError:
-        return None
+        flush()
+    finally:
+        creating.clear()
+    sync()
 
 
+@metrics.timed(metrics.ensure_duration, function="LinkManager.ensure_link")
 def ensure_link(
     *, name, type, link=None, link_attrs={}, type_attrs={}, bridge_slave_attrs={}
 ):
     global state
-    known_links.append(name)
-
-    # Create the device if it does not already exist
-    if not get_link(name):
+    claim(known_links, name)
+
+    # Links that do not exist yet are not created right away, but queued along with
+    # all other changes until the next commit(), so that all the links that are missing
+    # after a reboot get created in one go. This works as long as links are ensured
+    # after the links they depend on (e.g., their master).
+    if creating.get(name):
+        log.debug(f"{name} is already queued for creation")
+        return
+    is_up = False
+    if not get_link(name) and name not in creating:
         log.warning(f"Creating link {name}")
-        cmdline = ["ip", "link", "add", "name", name]
-        if type != "veth" and link:
-            cmdline.extend(["link", link])
-        for k, v in link_attrs.items():
-            # addrgenmode can not be set at creation time
-            if k == "inet6_addr_gen_mode":
-                continue
-            cmdline.extend(_link_attr_to_cmd(k, v))
-        cmdline.extend(["type", type])
+        # addrgenmode can not be set at creation time, and the kernel generates an
+        # IPv6 link-local address as soon as a link in eui64 mode comes up (which
+        # setting addrgenmode afterwards does not remove). Likewise, a bridge port
+        # would start forwarding (and learning) before its bridge slave attributes
+        # are set. In those cases the link is created down, and only set up once
+        # everything else has been set.
+        attrs = {k: v for k, v in link_attrs.items() if k != "inet6_addr_gen_mode"}
+        is_up = "inet6_addr_gen_mode" not in link_attrs and not bridge_slave_attrs
+        if is_up:
+            attrs["up"] = True
+        batch(
+            "add_link",
+            name=name,
+            type=type,
+            link=link,
+            attrs=attrs,
+            type_attrs=type_attrs,
+            resource=f"link {name}",
+        )
         if type == "veth" and link:
-            cmdline.extend(["peer", "name", link])
-        for k, v in type_attrs.items():
-            cmdline.extend(_type_attr_to_cmd(k, v))
-        cmd(cmdline)
-        update()
+            creating[link] = None
+        creating[name] = type
+
+        # Only the attributes that could not be set above remain to be synced
+        link_attrs = {k: v for k, v in link_attrs.items() if k == "inet6_addr_gen_mode"}
+        type_attrs = {}
+    elif name in creating:
+        # The peer of a veth pair queued for creation, which has nothing set yet
+        creating[name] = type
 
     log.info(f"Syncing all attributes for {name}")
     link = get_link(name)
-    if not link["linkinfo"]["info_kind"] == type:
-        log.error(
-            f'{name} has the wrong type {link["linkinfo"]["info_kind"]}, should have been {type}'
-        )
-
+    if link and not link.kind == type:
+        log.error(f"{name} has the wrong type {link.kind}, should have been {type}")
+
+    # Work out everything that differs, so that it can be changed with as few
+    # commands as possible: one for the generic link attributes, one for the type
+    # attributes (which the kernel may reject, e.g. a changed VNI, and that should not
+    # prevent the rest from being set), one for the bridge slave attributes (as
+    # iproute2 only takes the attributes of one link type at a time), and finally one
+    # to set the link up
+    changes = []
+    attrs = {}
     for k, v in link_attrs.items():
-        cur = link.get(k)
+        cur = getattr(link, k, None)
         if cur != v:
-            log.warning(f"Updating link attribute {k} on {name}: {cur} → {v}")
-            cmd(["ip", "link", "set", name] + _link_attr_to_cmd(k, v))
+            changes.append(f"{k}: {cur} → {v}")
+            attrs[k] = v
+
+    # Set the link UP if necessary
+    set_up = not is_up and (not link or not link.up)
+    if set_up:
+        changes.append("UP")
 
+    changed_type_attrs = {}
     for k, v in type_attrs.items():
-        cur = link["linkinfo"]["info_data"].get(k)
+        cur = link.info_data.get(k) if link else None
         if cur != v:
-            log.warning(f"Updating type attribute {k} on {name}: {cur} → {v}")
-            cmd(["ip", "link", "set", name, "type", type] + _type_attr_to_cmd(k, v))
+            changes.append(f"{type} {k}: {cur} → {v}")
+            changed_type_attrs[k] = v
 
     # Bridge slave attributes cannot be set at creation time, so always sync those
+    slave_attrs = {}
     for k, v in bridge_slave_attrs.items():
         cur = None
         if link:
-            cur = link["linkinfo"].get("info_slave_data", {}).get(k)
+            cur = link.slave_data.get(k)
         if cur != v:
-            log.warning(f"Updating bridge slave attribute {k} on {name}: {cur} → {v}")
-            cmd(
-                ["ip", "link", "set", name, "type", "bridge_slave"]
-                + _bridge_slave_attr_to_cmd(k, v)
-            )
-
-    # Finally, set the link UP if necessary
-    if not link or "UP" not in link["flags"]:
-        log.warning(f"Setting {name} UP")
-        cmd(["ip", "link", "set", name, "up"])
+            changes.append(f"bridge_slave {k}: {cur} → {v}")
+            slave_attrs[k] = v
+
+    if not changes:
+        log.debug(f"…already up to date")
+        return
+    log.warning(f"Updating link {name}: " + ", ".join(changes))
+    if attrs:
+        batch("set_link", name=name, attrs=attrs, resource=f"link {name}")
+    if changed_type_attrs:
+        batch(
+            "set_link",
+            name=name,
+            type=type,
+            type_attrs=changed_type_attrs,
+            resource=f"link {name}",
+        )
+    if slave_attrs:
+        batch(
+            "set_link",
+            name=name,
+            type="bridge_slave",
+            type_attrs=slave_attrs,
+            resource=f"link {name}",
+        )
+    # The kernel applies IFF_UP before any other attributes set by the same request
+    # (e.g., addrgenmode), so the link is set up by a command of its own, which is
+    # queued after all of the above (commands of the same kind are executed in order)
+    if set_up:
+        batch("set_link", name=name, attrs={"up": True}, resource=f"link {name}")
 
 
+@metrics.timed(metrics.phase_duration, phase="LinkManager.prune")
 def prune():
-    for link in list_links():
-        if link not in known_links:
-            if (
-                link.startswith("irb-")
-                or link.startswith("l2vni-")
-                or link.startswith("l3vni-")
-                or link.startswith("vrf-")
-            ):
-                log.warning(f"Removing orphaned link {link}")
-                cmd(["ip", "link", "del", link])
-
-
-def _link_attr_to_cmd(attr, val):
-    if attr == "inet6_addr_gen_mode":
-        attr = "addrgenmode"
-    if attr == "ifalias":
-        attr = "alias"
-    return [attr, str(val)]
-
-
-def _type_attr_to_cmd(attr, val):
-    if attr == "learning" and val == False:
-        return ["nolearning"]
-    if attr == "learning" and val == True:
-        return ["learning"]
-    if attr == "port":
-        return ["dstport", str(val)]
-    return [attr, str(val)]
-
-
-def _bridge_slave_attr_to_cmd(attr, val):
-    if attr in ["learning", "neigh_suppress"] and val == True:
-        return [attr, "on"]
-    if attr in ["learning", "neigh_suppress"] and val == False:
-        return [attr, "off"]
-    return [attr, str(val)]
-
-
-# Ensure the cache is populated during initial import
-update()
+    for link in state.keys() - claimed(known_links).keys():
+        if (
+            link.startswith("irb-")
+            or link.startswith("l2vni-")
+            or link.startswith("l3vni-")
+            or link.startswith("vrf-")
+        ):
+            log.warning(f"Removing orphaned link {link}")
+            batch("del_link", name=link, resource=f"orphan link {link}")
@@ -0,0 +1,232 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Instrumentation of the agent, in the form of Prometheus metrics. These are exported in
+# the Prometheus text format, either on a local HTTP endpoint (if metrics_port is set),
+# or by writing them to a file after every iteration of the main loop (if
+# metrics_textfile is set), which is suitable for node_exporter's textfile collector.
+# Both may be used at the same time. The metrics are always collected, as doing so is
+# cheap compared to the things being measured.
+
+from contextlib import contextmanager
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import threading
+import time
+
+from .config import conf
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# All the metrics, in order of definition
+registry = []
+
+server = None
+
+
+class Metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format(self, key, suffix="", extra={}):
+        labels = dict(zip(self.labels, key), **extra)
+        if not labels:
+            return self.name + suffix
+        escaped = (
+            v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            for v in labels.values()
+        )
+        return (
+            self.name
+            + suffix
+            + "{"
+            + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped))
+            + "}"
+        )
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self._format(key), value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self._format(key), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            buckets, total, count = self.values.get(key, ([0] * len(BUCKETS), 0, 0))
+            buckets = [n + (value <= le) for n, le in zip(buckets, BUCKETS)]
+            self.values[key] = (buckets, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the context, in seconds"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        for key, (buckets, total, count) in self.values.items():
+            for le, n in zip(BUCKETS, buckets):
+                yield self._format(key, "_bucket", {"le": str(le)}), n
+            yield self._format(key, "_bucket", {"le": "+Inf"}), count
+            yield self._format(key, "_sum"), total
+            yield self._format(key, "_count"), count
+
+
+iteration_duration = Histogram(
+    "evpn_agent_iteration_duration_seconds",
+    "Duration of the iterations of the main loop, by whether they were skipped",
+    ("result",),
+)
+phase_duration = Histogram(
+    "evpn_agent_phase_duration_seconds",
+    "Duration of the phases of the iterations of the main loop",
+    ("phase",),
+)
+ensure_duration = Histogram(
+    "evpn_agent_ensure_duration_seconds",
+    "Duration of the calls to the ensure functions of the managers",
+    ("function",),
+)
+commands = Counter(
+    "evpn_agent_commands_total",
+    "Number of external commands executed, by tool",
+    ("tool",),
+)
+command_duration = Histogram(
+    "evpn_agent_command_duration_seconds",
+    "Duration of the external commands executed, by tool",
+    ("tool",),
+)
+db_queries = Counter(
+    "evpn_agent_db_queries_total",
+    "Number of queries made to the Neutron database, by inventory function",
+    ("function",),
+)
+db_rows = Counter(
+    "evpn_agent_db_rows_total",
+    "Number of rows returned by the Neutron database, by inventory function",
+    ("function",),
+)
+db_query_duration = Histogram(
+    "evpn_agent_db_query_duration_seconds",
+    "Duration of the queries made to the Neutron database, by inventory function",
+    ("function",),
+)
+managed_objects = Gauge(
+    "evpn_agent_managed_objects",
+    "Number of objects currently managed by the agent, by kind",
+    ("kind",),
+)
+
+
+def timed(histogram, **labels):
+    """Returns a decorator that observes the duration of every call to a function"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render():
+    """Returns all metrics in the Prometheus text format"""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        with metric.lock:
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(f"{self.address_string()}: {format % args}")
+
+
+def init():
+    global server
+    if "metrics_port" in conf["agent"]:
+        address = (conf["agent"]["metrics_address"], int(conf["agent"]["metrics_port"]))
+        server = ThreadingHTTPServer(address, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log.info(f"Serving metrics on http://{address[0]}:{address[1]}/metrics")
+
+
+def finalise():
+    if "metrics_textfile" in conf["agent"]:
+        # Write the file atomically, so that it is never read half-written
+        path = conf["agent"]["metrics_textfile"]
+        with open(path + ".tmp", "w") as f:
+            f.write(render())
+        os.replace(path + ".tmp", path)
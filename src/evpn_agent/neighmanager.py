@@ -16,99 +16,95 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+from . import metrics
 from .config import conf
-from .utils import cmd, jsoncmd
+from .dataplane import batch, dump_neighs, subscribe
+from .netlink import rt_proto
+from .utils import claim, claimed
 
 log = logging.getLogger(__name__)
 
+# The link-layer address of each neighbour, per device and destination
 state = dict()
-known_neighs = []
+known_neighs = {}
+
+
+def init():
+    # Ensure the cache is populated, and kept up to date afterwards
+    subscribe(handler=handle_event, update=update)
+    update()
 
 
 def update():
     global state
-    state = jsoncmd(
-        [
-            "ip",
-            "-j",
-            "-d",
-            "neigh",
-            "show",
-            "nud",
-            "permanent",
-            "proto",
-            conf["agent"]["rt_proto"],
-        ]
-    )
+    state = {}
+    for neigh in dump_neighs(proto=conf["agent"]["rt_proto"]):
+        state.setdefault(neigh.dev, {})[neigh.dst] = neigh.lladdr
 
 
-def finalise():
-    global known_neighs
+def handle_event(kind, action, record):
+    if kind == "link" and action == "del":
+        state.pop(record.ifname, None)
+    elif kind == "neigh":
+        neighs = state.setdefault(record.dev, {})
+        if (
+            action == "new"
+            and record.permanent
+            and record.protocol == rt_proto(conf["agent"]["rt_proto"])
+            and record.lladdr
+        ):
+            neighs[record.dst] = record.lladdr
+        else:
+            neighs.pop(record.dst, None)
 
-    prune()
-    update()
 
-    known_neighs = []
+def forget(owner):
+    known_neighs.pop(owner, None)
 
 
-def ensure_neigh(*, dst, dev, lladdr):
-    global known_neighs
+def dirty(owner):
+    return any(not _is_present(*neigh) for neigh in known_neighs.get(owner, {}))
+
 
+@metrics.timed(metrics.ensure_duration, function="NeighManager.ensure_neigh")
+def ensure_neigh(*, dst, dev, lladdr):
     log.info(f"Ensuring neigh entry {dst}→{lladdr} on {dev}")
-    neigh = {
-        "dst": dst,
-        "dev": dev,
-        "lladdr": lladdr,
-        "state": ["PERMANENT"],
-        "protocol": conf["agent"]["rt_proto"],
-    }
-    known_neighs.append(neigh)
+    claim(known_neighs, (dst, dev, lladdr))
 
-    if neigh in state:
+    if _is_present(dst, dev, lladdr):
         log.info("…already present, not needed")
         return
 
-    log.info(state)
     log.warning(f"Adding static neigh entry {dst}→{lladdr} on {dev}")
-    cmd(
-        [
-            "ip",
-            "neigh",
-            "replace",
-            dst,
-            "dev",
-            dev,
-            "lladdr",
-            lladdr,
-            "nud",
-            "permanent",
-            "proto",
-            conf["agent"]["rt_proto"],
-        ]
+    batch(
+        "replace_neigh",
+        dst=dst,
+        dev=dev,
+        lladdr=lladdr,
+        proto=conf["agent"]["rt_proto"],
+        resource=f"neigh entry {dst}→{lladdr} on {dev}",
     )
 
 
+@metrics.timed(metrics.phase_duration, phase="NeighManager.prune")
 def prune():
-    for neigh in state:
-        if not neigh["dev"].startswith("irb-"):
-            continue
-        if neigh not in known_neighs:
-            log.warning(f"Removing orphan neigh entry {neigh}")
-            cmd(
-                [
-                    "ip",
-                    "neigh",
-                    "del",
-                    neigh["dst"],
-                    "dev",
-                    neigh["dev"],
-                    "lladdr",
-                    neigh["lladdr"],
-                    "proto",
-                    conf["agent"]["rt_proto"],
-                ]
-            )
-
-
-# Ensure the cache is populated during initial import
-update()
+    present = {
+        (dst, dev, lladdr)
+        for dev, neighs in state.items()
+        if dev.startswith("irb-")
+        for dst, lladdr in neighs.items()
+    }
+    for dst, dev, lladdr in present - claimed(known_neighs).keys():
+        log.warning(f"Removing orphan neigh entry {dst}→{lladdr} on {dev}")
+        batch(
+            "del_neigh",
+            dst=dst,
+            dev=dev,
+            lladdr=lladdr,
+            proto=conf["agent"]["rt_proto"],
+            resource=f"orphan neigh entry {dst}→{lladdr} on {dev}",
+        )
+
+
+def _is_present(dst, dev, lladdr):
+    return state.get(dev, {}).get(dst) == lladdr
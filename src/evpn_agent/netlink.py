@@ -0,0 +1,684 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A minimal rtnetlink client used to dump the kernel state the managers care about,
+# without forking iproute2 and decoding its JSON output. The dump_foo() functions
+# return the same objects as the corresponding 'ip -d' or 'bridge -d' commands, as
+# compact records holding only the fields actually used by the managers.
+#
+# In order to avoid having to dump everything again whenever the managers' caches need
+# to be refreshed, a monitor socket subscribed to change notifications for the same
+# objects is opened as well (see Monitor, and dataplane.sync()).
+
+import errno
+import functools
+import glob
+import logging
+import socket
+import struct
+from typing import NamedTuple
+
+log = logging.getLogger(__name__)
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP_INTR = 0x10
+NLM_F_DUMP = 0x300
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+
+# Multicast groups carrying notifications about links (including bridge port VLANs),
+# neighbours (including bridge FDB entries), addresses and routes
+RTMGRP_LINK = 0x1
+RTMGRP_NEIGH = 0x4
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+SO_RCVBUFFORCE = 33
+
+NLA_TYPE_MASK = 0x3FFF
+
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_MASTER = 10
+IFLA_LINKINFO = 18
+IFLA_IFALIAS = 20
+IFLA_AF_SPEC = 26
+IFLA_EXT_MASK = 29
+
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+IFLA_INFO_SLAVE_KIND = 4
+IFLA_INFO_SLAVE_DATA = 5
+
+IFLA_INET6_ADDR_GEN_MODE = 8
+
+IFLA_BRIDGE_VLAN_INFO = 2
+
+BRIDGE_VLAN_INFO_RANGE_BEGIN = 1 << 3
+BRIDGE_VLAN_INFO_RANGE_END = 1 << 4
+
+RTEXT_FILTER_BRVLAN = 1 << 1
+RTEXT_FILTER_SKIP_STATS = 1 << 3
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+NDA_DST = 1
+NDA_LLADDR = 2
+NDA_VLAN = 5
+NDA_MASTER = 9
+NDA_PROTOCOL = 12
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+
+NUD_REACHABLE = 0x02
+NUD_STALE = 0x04
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
+
+RTM_F_CLONED = 0x200
+
+IFF_UP = 0x1
+
+# Flags as printed by 'bridge fdb show' (NTF_MASTER is omitted from its JSON output)
+NTF_FLAGS = (
+    (0x02, "self"),
+    (0x80, "router"),
+    (0x10, "extern_learn"),
+    (0x20, "offload"),
+    (0x40, "sticky"),
+)
+
+ADDR_GEN_MODES = ("eui64", "none", "stable_secret", "random")
+
+RT_SCOPES = {0: "global", 200: "site", 253: "link", 254: "host", 255: "nowhere"}
+
+RT_TABLES = {253: "default", 254: "main", 255: "local"}
+
+RT_TYPES = (
+    None,
+    "unicast",
+    "local",
+    "broadcast",
+    "anycast",
+    "multicast",
+    "blackhole",
+    "unreachable",
+    "prohibit",
+    "throw",
+    "nat",
+)
+
+
+def _u8(data):
+    return data[0]
+
+
+def _u16(data):
+    return struct.unpack_from("=H", data)[0]
+
+
+def _u32(data):
+    return struct.unpack_from("=I", data)[0]
+
+
+def _be16(data):
+    return struct.unpack_from("!H", data)[0]
+
+
+def _bool(data):
+    return bool(data[0])
+
+
+def _str(data):
+    return bytes(data).split(b"\0", 1)[0].decode()
+
+
+def _ip(data):
+    family = socket.AF_INET if len(data) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, bytes(data))
+
+
+def _mac(data):
+    return ":".join(f"{b:02x}" for b in data)
+
+
+class Link(NamedTuple):
+    ifindex: int
+    ifname: str
+    up: bool
+    mtu: int
+    master: str
+    address: str
+    ifalias: str
+    inet6_addr_gen_mode: str
+    kind: str
+    # The type and bridge slave specific attributes in INFO_DATA/INFO_SLAVE_DATA
+    info_data: dict
+    slave_data: dict
+
+
+class BridgePort(NamedTuple):
+    ifindex: int
+    ifname: str
+    master: str
+    vlans: frozenset
+
+
+class Address(NamedTuple):
+    ifname: str
+    family: str
+    local: str
+    prefixlen: int
+    scope: str
+
+
+class Neigh(NamedTuple):
+    dst: str
+    dev: str
+    lladdr: str
+    permanent: bool
+    protocol: int
+
+
+class Fdb(NamedTuple):
+    mac: str
+    dev: str
+    vlan: int
+    flags: tuple
+    master: str
+    state: str
+
+
+class Route(NamedTuple):
+    dst: str
+    gateway: str
+    dev: str
+    type: str
+    metric: int
+    table: str
+    protocol: int
+
+
+# The type specific attributes to decode (cf. 'ip -d link show'), per link kind
+INFO_DATA = {
+    "bridge": {
+        7: ("vlan_filtering", _u8),
+        39: ("vlan_default_pvid", _u16),
+    },
+    "vlan": {
+        1: ("id", _u16),
+    },
+    "vrf": {
+        1: ("table", _u32),
+    },
+    "vxlan": {
+        1: ("id", _u32),
+        4: ("local", _ip),
+        7: ("learning", _bool),
+        15: ("port", _be16),
+        17: ("local", _ip),
+    },
+}
+
+INFO_SLAVE_DATA = {
+    "bridge": {
+        8: ("learning", _bool),
+        32: ("neigh_suppress", _bool),
+    },
+}
+
+
+@functools.lru_cache
+def rt_proto(proto):
+    """Returns the numeric value of a route protocol, which may be given as a name
+    found in iproute2's rt_protos database"""
+    if str(proto).isdigit():
+        return int(proto)
+    for path in ["/etc/iproute2/rt_protos"] + glob.glob("/etc/iproute2/rt_protos.d/*"):
+        try:
+            with open(path) as f:
+                for line in f:
+                    fields = line.split("#", 1)[0].split()
+                    if len(fields) >= 2 and fields[1] == proto:
+                        return int(fields[0], 0)
+        except OSError:
+            continue
+    raise ValueError(f"Unknown route protocol {proto}")
+
+
+# Interface names by index, maintained by dump_links() and the monitor
+ifnames = {}
+
+
+class Monitor:
+    """A netlink socket subscribed to change notifications about links, addresses,
+    neighbours and routes"""
+
+    def __init__(self, rcvbuf=8 << 20):
+        self.sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK, NETLINK_ROUTE
+        )
+        # A large receive buffer makes overflows during event storms (e.g., when lots
+        # of links are created or removed in one go) less likely
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, rcvbuf)
+        except PermissionError:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind(
+            (
+                0,
+                RTMGRP_LINK
+                | RTMGRP_NEIGH
+                | RTMGRP_IPV4_IFADDR
+                | RTMGRP_IPV4_ROUTE
+                | RTMGRP_IPV6_IFADDR
+                | RTMGRP_IPV6_ROUTE,
+            )
+        )
+        self.buf = bytearray(1 << 20)
+
+    def read(self):
+        """Returns the (kind, action, object) of every notification received since the
+        previous call, without blocking"""
+        events = []
+        while True:
+            try:
+                size = self.sock.recv_into(self.buf)
+            except BlockingIOError:
+                return events
+            for msgtype, _, msg in _messages(memoryview(self.buf)[:size]):
+                event = _event(msgtype, msg)
+                if event:
+                    events.append(event)
+
+
+def dump_links():
+    """Returns the equivalent of 'ip -d link show', as Link records"""
+    ifnames.clear()
+    links = [
+        _link(msg)
+        for _, msg in _dump(
+            RTM_GETLINK,
+            struct.pack("=BxHiII", socket.AF_UNSPEC, 0, 0, 0, 0),
+            _attr(IFLA_EXT_MASK, struct.pack("=I", RTEXT_FILTER_SKIP_STATS)),
+        )
+    ]
+    ifnames.update((link.ifindex, link.ifname) for link in links)
+    return links
+
+
+def dump_addresses():
+    """Returns the equivalent of 'ip address show', as Address records"""
+    return [
+        address
+        for _, msg in _dump(
+            RTM_GETADDR, struct.pack("=BBBBI", socket.AF_UNSPEC, 0, 0, 0, 0)
+        )
+        if (address := _address(msg))
+    ]
+
+
+def dump_neighs(*, proto):
+    """Returns the equivalent of 'ip neigh show nud permanent proto PROTO', as Neigh
+    records"""
+    proto = rt_proto(proto)
+    return [
+        neigh
+        for _, msg in _dump(
+            RTM_GETNEIGH, struct.pack("=BxxxiHBB", socket.AF_UNSPEC, 0, 0, 0, 0)
+        )
+        if (neigh := _neigh(msg))
+        and neigh.permanent
+        and neigh.protocol == proto
+        and neigh.lladdr is not None
+    ]
+
+
+def dump_routes(*, proto):
+    """Returns the equivalent of 'ip -d route show proto PROTO table all', for both
+    IPv4 and IPv6 in one go, as Route records"""
+    proto = rt_proto(proto)
+    return [
+        route
+        for _, msg in _dump(
+            RTM_GETROUTE,
+            struct.pack("=BBBBBBBBI", socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0, 0, 0),
+        )
+        if (route := _route(msg)) and route.protocol == proto
+    ]
+
+
+def dump_fdb(*, dev, master):
+    """Returns the equivalent of 'bridge -d fdb show dev DEV master MASTER', as Fdb
+    records"""
+    # The kernel only filters bridge FDB dumps by port if the request is given in the
+    # legacy ifinfomsg format, including the master device
+    return [
+        entry
+        for _, msg in _dump(
+            RTM_GETNEIGH,
+            struct.pack("=BxHiII", socket.AF_BRIDGE, 0, _index(dev), 0, 0),
+            _attr(IFLA_MASTER, struct.pack("=I", _index(master))),
+        )
+        if (entry := _fdb(msg)) and entry.dev == dev
+    ]
+
+
+def dump_bridge_ports():
+    """Returns the equivalent of 'bridge -d link show' combined with 'bridge -d vlan
+    show', i.e., the master and VLANs of every bridge port (and bridge), as BridgePort
+    records"""
+    return [
+        _bridge_port(msg)
+        for _, msg in _dump(
+            RTM_GETLINK,
+            struct.pack("=BxHiII", socket.AF_BRIDGE, 0, 0, 0, 0),
+            _attr(IFLA_EXT_MASK, struct.pack("=I", RTEXT_FILTER_BRVLAN)),
+        )
+    ]
+
+
+# Parsers for the individual messages, shared between the dumps and the monitor
+def _event(msgtype, msg):
+    family = msg[0]
+    if msgtype in (RTM_NEWLINK, RTM_DELLINK):
+        action = "new" if msgtype == RTM_NEWLINK else "del"
+        if family == socket.AF_BRIDGE:
+            return ("bridge_port", action, _bridge_port(msg))
+        # Per address family notifications (e.g., AF_INET6) carry no link details
+        if family != socket.AF_UNSPEC:
+            return None
+        link = _link(msg)
+        if action == "new":
+            ifnames[link.ifindex] = link.ifname
+        else:
+            ifnames.pop(link.ifindex, None)
+        return ("link", action, link)
+    if msgtype in (RTM_NEWADDR, RTM_DELADDR):
+        action = "new" if msgtype == RTM_NEWADDR else "del"
+        address = _address(msg)
+        return ("address", action, address) if address else None
+    if msgtype in (RTM_NEWNEIGH, RTM_DELNEIGH):
+        action = "new" if msgtype == RTM_NEWNEIGH else "del"
+        if family == socket.AF_BRIDGE:
+            entry = _fdb(msg)
+            return ("fdb", action, entry) if entry else None
+        neigh = _neigh(msg)
+        return ("neigh", action, neigh) if neigh else None
+    if msgtype in (RTM_NEWROUTE, RTM_DELROUTE):
+        action = "new" if msgtype == RTM_NEWROUTE else "del"
+        route = _route(msg)
+        return ("route", action, route) if route else None
+    return None
+
+
+def _link(msg):
+    _, _, index, flags, _ = struct.unpack_from("=BxHiII", msg)
+    attrs = _attrs(msg, 16)
+    addr_gen_mode = None
+    if IFLA_AF_SPEC in attrs:
+        af_spec = _attrs(attrs[IFLA_AF_SPEC])
+        if socket.AF_INET6 in af_spec:
+            inet6 = _attrs(af_spec[socket.AF_INET6])
+            if IFLA_INET6_ADDR_GEN_MODE in inet6:
+                mode = _u8(inet6[IFLA_INET6_ADDR_GEN_MODE])
+                if mode < len(ADDR_GEN_MODES):
+                    addr_gen_mode = ADDR_GEN_MODES[mode]
+    linkinfo = _attrs(attrs[IFLA_LINKINFO]) if IFLA_LINKINFO in attrs else {}
+    kind = _str(linkinfo[IFLA_INFO_KIND]) if IFLA_INFO_KIND in linkinfo else None
+    slave_kind = None
+    if IFLA_INFO_SLAVE_KIND in linkinfo:
+        slave_kind = _str(linkinfo[IFLA_INFO_SLAVE_KIND])
+    return Link(
+        ifindex=index,
+        ifname=_str(attrs[IFLA_IFNAME]),
+        up=bool(flags & IFF_UP),
+        mtu=_u32(attrs[IFLA_MTU]) if IFLA_MTU in attrs else None,
+        # Like iproute2, refer to the master device by name rather than by index
+        master=_name(_u32(attrs[IFLA_MASTER])) if IFLA_MASTER in attrs else None,
+        address=_mac(attrs[IFLA_ADDRESS]) if IFLA_ADDRESS in attrs else None,
+        ifalias=_str(attrs[IFLA_IFALIAS]) if IFLA_IFALIAS in attrs else None,
+        inet6_addr_gen_mode=addr_gen_mode,
+        kind=kind,
+        info_data=_decode(linkinfo.get(IFLA_INFO_DATA, b""), INFO_DATA.get(kind, {})),
+        slave_data=_decode(
+            linkinfo.get(IFLA_INFO_SLAVE_DATA, b""), INFO_SLAVE_DATA.get(slave_kind, {})
+        ),
+    )
+
+
+def _bridge_port(msg):
+    _, _, index, _, _ = struct.unpack_from("=BxHiII", msg)
+    attrs = _attrs(msg, 16)
+    vlans = set()
+    if IFLA_AF_SPEC in attrs:
+        # Notifications describe consecutive VLANs as ranges, unlike dumps
+        begin = None
+        for type, data in _iter_attrs(attrs[IFLA_AF_SPEC]):
+            if type != IFLA_BRIDGE_VLAN_INFO:
+                continue
+            flags, vid = struct.unpack_from("=HH", data)
+            if flags & BRIDGE_VLAN_INFO_RANGE_BEGIN:
+                begin = vid
+            elif flags & BRIDGE_VLAN_INFO_RANGE_END and begin is not None:
+                vlans.update(range(begin, vid + 1))
+                begin = None
+            else:
+                vlans.add(vid)
+    return BridgePort(
+        ifindex=index,
+        ifname=_str(attrs[IFLA_IFNAME]),
+        master=_name(_u32(attrs[IFLA_MASTER])) if IFLA_MASTER in attrs else None,
+        vlans=frozenset(vlans),
+    )
+
+
+def _address(msg):
+    family, prefixlen, _, scope, index = struct.unpack_from("=BBBBI", msg)
+    if family not in (socket.AF_INET, socket.AF_INET6):
+        return None
+    attrs = _attrs(msg, 8)
+    local = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+    if local is None:
+        return None
+    return Address(
+        ifname=_name(index),
+        family="inet" if family == socket.AF_INET else "inet6",
+        local=_ip(local),
+        prefixlen=prefixlen,
+        scope=RT_SCOPES.get(scope, str(scope)),
+    )
+
+
+def _neigh(msg):
+    family, index, state, _, _ = struct.unpack_from("=BxxxiHBB", msg)
+    if family not in (socket.AF_INET, socket.AF_INET6):
+        return None
+    attrs = _attrs(msg, 12)
+    if NDA_DST not in attrs:
+        return None
+    return Neigh(
+        dst=_ip(attrs[NDA_DST]),
+        dev=_name(index),
+        lladdr=_mac(attrs[NDA_LLADDR]) if NDA_LLADDR in attrs else None,
+        permanent=bool(state & NUD_PERMANENT),
+        protocol=_u8(attrs[NDA_PROTOCOL]) if NDA_PROTOCOL in attrs else None,
+    )
+
+
+def _fdb(msg):
+    _, index, state, flags, _ = struct.unpack_from("=BxxxiHBB", msg)
+    attrs = _attrs(msg, 12)
+    if NDA_LLADDR not in attrs:
+        return None
+    if state & NUD_PERMANENT:
+        state = "permanent"
+    elif state & NUD_NOARP:
+        state = "static"
+    elif state & NUD_STALE:
+        state = "stale"
+    else:
+        state = ""
+    return Fdb(
+        mac=_mac(attrs[NDA_LLADDR]),
+        dev=_name(index),
+        vlan=_u16(attrs[NDA_VLAN]) if NDA_VLAN in attrs else None,
+        flags=tuple(name for (flag, name) in NTF_FLAGS if flags & flag),
+        master=_name(_u32(attrs[NDA_MASTER])) if NDA_MASTER in attrs else None,
+        state=state,
+    )
+
+
+def _route(msg):
+    family, dst_len, _, _, table, protocol, _, type, flags = struct.unpack_from(
+        "=BBBBBBBBI", msg
+    )
+    if family not in (socket.AF_INET, socket.AF_INET6) or flags & RTM_F_CLONED:
+        return None
+    attrs = _attrs(msg, 12)
+    if RTA_TABLE in attrs:
+        table = _u32(attrs[RTA_TABLE])
+    if RTA_DST in attrs:
+        dst = _ip(attrs[RTA_DST])
+    else:
+        dst = "0.0.0.0" if family == socket.AF_INET else "::"
+    # Like iproute2, leave out the prefix length of host routes
+    if dst_len != (32 if family == socket.AF_INET else 128):
+        dst += "/" + str(dst_len)
+    return Route(
+        dst=dst,
+        gateway=_ip(attrs[RTA_GATEWAY]) if RTA_GATEWAY in attrs else None,
+        dev=_name(_u32(attrs[RTA_OIF])) if RTA_OIF in attrs else None,
+        type=RT_TYPES[type] if type < len(RT_TYPES) else str(type),
+        metric=_u32(attrs[RTA_PRIORITY]) if RTA_PRIORITY in attrs else None,
+        table=RT_TABLES.get(table, str(table)),
+        protocol=protocol,
+    )
+
+
+def _decode(data, decoders):
+    decoded = {}
+    for type, value in _iter_attrs(data):
+        if type in decoders:
+            name, decoder = decoders[type]
+            decoded[name] = decoder(value)
+    return decoded
+
+
+def _name(index):
+    if index not in ifnames:
+        ifnames.update(socket.if_nameindex())
+    return ifnames.get(index)
+
+
+def _index(name):
+    # socket.if_nametoindex() does not set errno if there is no such link
+    try:
+        return socket.if_nametoindex(name)
+    except OSError:
+        raise OSError(errno.ENODEV, f"No such device: {name}") from None
+
+
+def _attr(type, data):
+    length = 4 + len(data)
+    return struct.pack("=HH", length, type) + data + b"\0" * (-length % 4)
+
+
+def _iter_attrs(data, offset=0):
+    data = memoryview(data)
+    while offset + 4 <= len(data):
+        length, type = struct.unpack_from("=HH", data, offset)
+        if length < 4:
+            break
+        yield type & NLA_TYPE_MASK, data[offset + 4 : offset + length]
+        offset += (length + 3) & ~3
+
+
+def _attrs(data, offset=0):
+    return dict(_iter_attrs(data, offset))
+
+
+def _messages(data):
+    """Yields the (type, flags, payload) of each netlink message in a datagram"""
+    offset = 0
+    while offset + 16 <= len(data):
+        length, msgtype, flags, _, _ = struct.unpack_from("=IHHII", data, offset)
+        if length < 16:
+            break
+        yield msgtype, flags, data[offset + 16 : offset + length]
+        offset += (length + 3) & ~3
+
+
+def _dump(type, header, attrs=b"", retries=3):
+    """Performs a netlink dump request, returning the (type, payload) of each message
+    received. The dump is restarted if it is interrupted by concurrent changes."""
+    buf = bytearray(1 << 20)
+    for attempt in range(retries + 1):
+        messages = []
+        interrupted = False
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+            sock.bind((0, 0))
+            payload = header + attrs
+            sock.send(
+                struct.pack(
+                    "=IHHII", 16 + len(payload), type, NLM_F_REQUEST | NLM_F_DUMP, 1, 0
+                )
+                + payload
+            )
+            done = False
+            while not done:
+                data = memoryview(buf)[: sock.recv_into(buf)]
+                for msgtype, flags, msg in _messages(data):
+                    if flags & NLM_F_DUMP_INTR:
+                        interrupted = True
+                    if msgtype == NLMSG_DONE:
+                        done = True
+                        break
+                    if msgtype == NLMSG_ERROR:
+                        (error,) = struct.unpack_from("=i", msg)
+                        if error:
+                            raise OSError(-error, f"Netlink dump failed (type {type})")
+                    else:
+                        messages.append((msgtype, bytes(msg)))
+        if not interrupted:
+            return messages
+        log.debug(f"Netlink dump (type {type}) interrupted, retrying ({attempt=})")
+    return messages
@@ -0,0 +1,207 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A minimal OVSDB client (RFC 7047), so that the state of Open vSwitch can be monitored
+# and changed without forking ovs-vsctl. JSON-RPC messages are exchanged as a stream of
+# JSON objects with no delimiters over the Unix socket of the local ovsdb-server.
+#
+# The tables of interest are monitored, which makes the server send the current
+# contents of their rows right away, and then an update notification whenever they
+# change. The client keeps a replica of the monitored rows up to date with those, and
+# the socket can be watched by an event loop in order to learn about changes as soon as
+# they happen (see Ovsdb.fileno() and Ovsdb.poll()).
+
+import codecs
+import json
+import logging
+import socket
+
+log = logging.getLogger(__name__)
+
+DATABASE = "Open_vSwitch"
+
+
+class OvsdbError(Exception):
+    pass
+
+
+class Ovsdb:
+    """A persistent connection to an OVSDB server, monitoring the given columns of the
+    given tables ({table: [column, ...]}). The replica of the rows is kept in tables,
+    as {table: {uuid: row}}. If the server does not respond within timeout seconds,
+    the connection is considered lost (socket.timeout is raised)."""
+
+    def __init__(self, path, monitor, timeout=None):
+        self.path = path
+        self.monitor = monitor
+        self.timeout = timeout
+        self.sock = None
+        self.buf = ""
+        self.decoder = None
+        self.next_id = 0
+        self.tables = {}
+
+    def connect(self):
+        """Connects to the server and repopulates the replica. If this fails, there is
+        no connection, and the replica is left as it was."""
+        self.close()
+        log.debug(f"Connecting to OVSDB server {self.path}")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        rows = self.call(
+            "monitor",
+            [
+                DATABASE,
+                "evpn_agent",
+                {
+                    table: {"columns": columns}
+                    for table, columns in self.monitor.items()
+                },
+            ],
+        )
+        self.tables = {table: {} for table in self.monitor}
+        self._update(rows)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.buf = ""
+
+    def fileno(self):
+        """Returns the socket of the connection, or None if there is none"""
+        return self.sock.fileno() if self.sock else None
+
+    def call(self, method, params):
+        """Sends a request and returns the result of it, handling any notifications
+        received in the meantime"""
+        self.next_id += 1
+        self._send({"method": method, "params": params, "id": self.next_id})
+        while True:
+            msg = self._receive(block=True)
+            if msg.get("id") == self.next_id and "method" not in msg:
+                if msg.get("error"):
+                    raise OvsdbError(f"{method} failed: {msg['error']}")
+                return msg["result"]
+            self._handle(msg)
+
+    def poll(self):
+        """Handles any notifications received since the previous call without
+        blocking, returning whether there were any updates. If the connection has been
+        lost (e.g., because ovsdb-server has been restarted), it is re-established,
+        and the replica repopulated from scratch. If that fails (e.g., because
+        ovsdb-server is not running), it is tried again by the next call."""
+        if self.sock:
+            updated = False
+            try:
+                while msg := self._receive(block=False):
+                    updated |= self._handle(msg)
+                return updated
+            except OSError as e:
+                log.warning(f"Lost connection to OVSDB server ({e}), reconnecting")
+        try:
+            self.connect()
+        except OSError as e:
+            log.error(f"Failed to connect to OVSDB server {self.path} ({e})")
+            return False
+        return True
+
+    def transact(self, *operations):
+        """Executes a transaction, returning the results of the operations"""
+        if not self.sock:
+            self.connect()
+        results = self.call("transact", [DATABASE, *operations])
+        errors = [r for r in results if r and "error" in r]
+        if errors or len(results) < len(operations):
+            raise OvsdbError(f"Transaction failed: {errors or results}")
+        return results
+
+    def _handle(self, msg):
+        if msg.get("method") == "update":
+            self._update(msg["params"][1])
+            return True
+        if msg.get("method") == "echo":
+            # Inactivity probe
+            self._send({"result": msg["params"], "error": None, "id": msg["id"]})
+        return False
+
+    def _update(self, updates):
+        for table, rows in updates.items():
+            for uuid, row in rows.items():
+                if row.get("new") is None:
+                    self.tables[table].pop(uuid, None)
+                else:
+                    self.tables[table][uuid] = row["new"]
+
+    def _send(self, msg):
+        try:
+            self.sock.sendall(json.dumps(msg).encode())
+        except OSError:
+            self.close()
+            raise
+
+    def _receive(self, *, block):
+        """Returns the next message, or None if block is false and there is none"""
+        decoder = json.JSONDecoder()
+        while True:
+            self.buf = self.buf.lstrip()
+            if self.buf:
+                try:
+                    msg, end = decoder.raw_decode(self.buf)
+                    self.buf = self.buf[end:]
+                    return msg
+                except json.JSONDecodeError:
+                    # Incomplete, wait for the rest of it
+                    pass
+            try:
+                if block:
+                    data = self.sock.recv(65536)
+                else:
+                    # A socket with a timeout would wait for data regardless of
+                    # MSG_DONTWAIT, so make it non-blocking for the time being
+                    self.sock.setblocking(False)
+                    try:
+                        data = self.sock.recv(65536)
+                    finally:
+                        self.sock.settimeout(self.timeout)
+            except BlockingIOError:
+                return None
+            except OSError:
+                # Including socket.timeout, as a server which does not respond cannot
+                # be relied upon to send the rest of the response later
+                self.close()
+                raise
+            if not data:
+                self.close()
+                raise ConnectionError("OVSDB server closed the connection")
+            self.buf += self.decoder.decode(data)
+
+
+def uuids(value):
+    """Returns the UUIDs in a column value of type set of UUIDs, which is encoded as
+    ["uuid", <uuid>] if it holds exactly one, and ["set", [["uuid", <uuid>], ...]]
+    otherwise"""
+    if value[0] == "uuid":
+        return [value[1]]
+    return [uuid for _, uuid in value[1]]
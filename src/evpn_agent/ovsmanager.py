@@ -16,16 +16,87 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
-from .utils import cmd
+from . import metrics
+from .ovsdb import Ovsdb, OvsdbError, uuids
 from .config import conf
 
 log = logging.getLogger(__name__)
 
+# The connection to ovsdb-server, set up by init(), which maintains a replica of the
+# names and ports of the OVS bridges, and the names of the OVS ports
+db = None
 
-def ensure_veth():
-    proc = cmd(
-        ["ovs-vsctl", "list-ports", conf["ovs"]["name"]], capture_output=True, text=True
+# The ports on the OVS bridge
+ports = []
+
+
+def init():
+    global db
+    db = Ovsdb(
+        conf["ovs"]["db_socket"],
+        monitor={"Bridge": ["name", "ports"], "Port": ["name"]},
+        timeout=float(conf["ovs"]["db_timeout"]),
     )
-    if not conf["ovs"]["veth"] in proc.stdout.splitlines():
+    db.connect()
+    update()
+
+
+@metrics.timed(metrics.phase_duration, phase="OvsManager.update")
+def update():
+    """Applies any changes to the OVS bridge received since the previous call. This is
+    cheap, so it is done at the start of every iteration of the main loop."""
+    global ports
+    db.poll()
+    ports = []
+    for bridge in db.tables["Bridge"].values():
+        if bridge["name"] == conf["ovs"]["name"]:
+            ports = [
+                db.tables["Port"][uuid]["name"]
+                for uuid in uuids(bridge["ports"])
+                if uuid in db.tables["Port"]
+            ]
+
+
+def fileno():
+    """Returns the socket on which changes to OVS are received, cf. update(), or None
+    if the connection to ovsdb-server has been lost (and is yet to be re-established
+    by update())"""
+    return db.fileno()
+
+
+def dirty():
+    return not conf["ovs"]["veth"] in ports
+
+
+@metrics.timed(metrics.ensure_duration, function="OvsManager.ensure_veth")
+def ensure_veth():
+    if not conf["ovs"]["veth"] in ports:
         log.warning(f'Adding {conf["ovs"]["veth"]} to OVS bridge {conf["ovs"]["name"]}')
-        cmd(["ovs-vsctl", "add-port", conf["ovs"]["name"], conf["ovs"]["veth"]])
+        # The equivalent of 'ovs-vsctl add-port', except that it does not wait for
+        # ovs-vswitchd to reconfigure itself
+        results = db.transact(
+            {
+                "op": "insert",
+                "table": "Interface",
+                "row": {"name": conf["ovs"]["veth"]},
+                "uuid-name": "interface",
+            },
+            {
+                "op": "insert",
+                "table": "Port",
+                "row": {
+                    "name": conf["ovs"]["veth"],
+                    "interfaces": ["named-uuid", "interface"],
+                },
+                "uuid-name": "port",
+            },
+            {
+                "op": "mutate",
+                "table": "Bridge",
+                "where": [["name", "==", conf["ovs"]["name"]]],
+                "mutations": [["ports", "insert", ["named-uuid", "port"]]],
+            },
+        )
+        if not results[2]["count"]:
+            raise OvsdbError(f'OVS bridge {conf["ovs"]["name"]} does not exist')
+        ports.append(conf["ovs"]["veth"])
@@ -0,0 +1,106 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Profiling of iterations of the main loop, for diagnosing slow iterations on a given
+# host without having to redeploy the agent. The first iterations may be profiled by
+# using the --profile command line option, and a running agent may be told to profile
+# the next iterations by sending it SIGUSR1 (see request()). Only full iterations are
+# profiled, not those skipped because nothing has changed.
+#
+# For every profiled iteration, two files are written to profile_dir: a .pstats file
+# with the CPU profile (which may be examined with 'python3 -m pstats'), and an .alloc
+# file listing the source lines that allocated the most memory that was still in use at
+# the end of the iteration. Note that the CPU profile only covers the thread running the
+# iteration, so work done by worker threads (e.g., loading the snapshot from the
+# database, or executing batched commands) shows up as time spent waiting for them.
+
+import cProfile
+from contextlib import contextmanager
+import logging
+import os
+import time
+import tracemalloc
+
+from .config import conf
+
+log = logging.getLogger(__name__)
+
+# The number of frames recorded for each traced allocation
+TRACEBACK_DEPTH = 10
+
+# The number of iterations left to profile, and the number profiled so far
+remaining = 0
+profiled = 0
+
+
+def init():
+    global remaining
+    remaining = int(conf["agent"].get("profile", 0))
+
+
+def request():
+    """Requests profiling of the next profile_iterations iterations of the main loop"""
+    global remaining
+    remaining += int(conf["agent"]["profile_iterations"])
+    log.warning(f"Profiling the next {remaining} full iteration(s) of the main loop")
+
+
+@contextmanager
+def profile():
+    """Profiles the context if profiling has been requested, writing the results to
+    profile_dir"""
+    global remaining, profiled
+    if not remaining:
+        yield
+        return
+    remaining -= 1
+    profiled += 1
+
+    # Only allocations made from this point on are traced
+    tracemalloc.start(TRACEBACK_DEPTH)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        _write(profiler, snapshot, size, peak)
+
+
+def _write(profiler, snapshot, size, peak):
+    os.makedirs(conf["agent"]["profile_dir"], exist_ok=True)
+    path = os.path.join(
+        conf["agent"]["profile_dir"],
+        f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{profiled}",
+    )
+    profiler.dump_stats(path + ".pstats")
+
+    snapshot = snapshot.filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+    with open(path + ".alloc", "w") as f:
+        f.write(f"Allocated during the iteration and still in use: {size} bytes\n")
+        f.write(f"Peak allocated during the iteration: {peak} bytes\n\n")
+        for stat in snapshot.statistics("traceback")[:50]:
+            f.write(f"{stat.size} bytes in {stat.count} block(s)\n")
+            for line in stat.traceback.format():
+                f.write(line + "\n")
+            f.write("\n")
+    log.warning(f"Wrote profile of iteration to {path}.pstats and {path}.alloc")
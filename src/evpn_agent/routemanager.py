@@ -17,13 +17,17 @@
 
 import logging
 from typing import NamedTuple
+from . import metrics
 from .config import conf
-from .utils import cmd, jsoncmd
+from .dataplane import batch, dump_routes, subscribe
+from .netlink import rt_proto
+from .utils import claim, claimed
 
 log = logging.getLogger(__name__)
 
-state = []
-known_routes = []
+# Routes keyed by what identifies them to the kernel, see _key()
+state = {}
+known_routes = {}
 
 
 class Route(NamedTuple):
@@ -36,91 +40,84 @@ class Route(NamedTuple):
     table: str = "main"
 
 
+def init():
+    # Ensure the cache is populated, and kept up to date afterwards
+    subscribe(handler=handle_event, update=update)
+    update()
+
+
 def update():
     global state
 
-    state = []
-    for ipverflag in ("-4", "-6"):
-        for rt in jsoncmd(
-            [
-                "ip",
-                ipverflag,
-                "-j",
-                "-d",
-                "route",
-                "show",
-                "proto",
-                conf["agent"]["rt_proto"],
-                "table",
-                "all",
-            ]
-        ):
-            if rt["dst"] == "default" and ipverflag == "-4":
-                rt["dst"] = "0.0.0.0/0"
-            elif rt["dst"] == "default" and ipverflag == "-6":
-                rt["dst"] = "::/0"
-
-            state.append(
-                Route(
-                    dst=rt["dst"],
-                    gateway=rt.get("gateway"),
-                    dev=rt.get("dev"),
-                    type=rt.get("type"),
-                    metric=rt.get("metric"),
-                    table=str(rt.get("table")),
-                )
-            )
-
-
-def finalise():
-    global known_routes
-
-    prune()
-    update()
+    state = {
+        _key(route): route
+        for route in map(_route, dump_routes(proto=conf["agent"]["rt_proto"]))
+    }
 
-    known_routes = []
 
+def handle_event(kind, action, record):
+    global state
+    if kind == "link":
+        # The kernel silently flushes IPv4 routes via links that are removed or set
+        # administratively down, without sending any notifications about it
+        if action == "del" or not record.up:
+            state = {
+                key: route
+                for key, route in state.items()
+                if route.dev != record.ifname or (action != "del" and ":" in route.dst)
+            }
+    elif kind == "route":
+        route = _route(record)
+        if action == "new" and record.protocol == rt_proto(conf["agent"]["rt_proto"]):
+            state[_key(route)] = route
+        else:
+            state.pop(_key(route), None)
 
-def ensure_route(route: Route):
-    global known_routes
 
+def forget(owner):
+    known_routes.pop(owner, None)
+
+
+def dirty(owner):
+    return any(state.get(_key(route)) != route for route in known_routes.get(owner, {}))
+
+
+@metrics.timed(metrics.ensure_duration, function="RouteManager.ensure_route")
+def ensure_route(route: Route):
     log.info(f"Ensuring {route}")
-    known_routes.append(route)
+    claim(known_routes, route)
 
-    if route in state:
+    if state.get(_key(route)) == route:
         log.info("…already present in RIB, addition needed")
         return
 
     log.warning(f"Adding {route}")
-    cmd(
-        ["ip", "route", "add"]
-        + ([route.type] if route.type else [])
-        + [route.dst]
-        + (["via", route.gateway] if route.gateway else [])
-        + (["dev", route.dev] if route.dev else [])
-        + (["metric", str(route.metric)] if route.metric else [])
-        + (["table", str(route.table)] if route.table else [])
-        + ["proto", conf["agent"]["rt_proto"]]
-    )
+    batch("add_route", route=route, proto=conf["agent"]["rt_proto"], resource=route)
 
 
+@metrics.timed(metrics.phase_duration, phase="RouteManager.prune")
 def prune():
-    for route in state:
-        if route not in known_routes:
-            log.warning(f"Removing orphan {route}")
-            cmd(
-                [
-                    "ip",
-                    "route",
-                    "del",
-                    route.dst,
-                    "table",
-                    route.table,
-                    "proto",
-                    conf["agent"]["rt_proto"],
-                ]
-            )
-
-
-# Ensure the cache is populated during initial import
-update()
+    for route in set(state.values()) - claimed(known_routes).keys():
+        log.warning(f"Removing orphan {route}")
+        batch(
+            "del_route",
+            dst=route.dst,
+            table=route.table,
+            proto=conf["agent"]["rt_proto"],
+            resource=f"orphan {route}",
+        )
+
+
+def _key(route):
+    return (route.dst, route.table, route.metric)
+
+
+def _route(rt):
+    return Route(
+        dst=rt.dst,
+        gateway=rt.gateway,
+        dev=rt.dev,
+        type=rt.type,
+        metric=rt.metric,
+        table=str(rt.table),
+    )
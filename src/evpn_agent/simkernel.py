@@ -0,0 +1,501 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# An in-memory simulation of the parts of the kernel managed by the agent, which
+# starts out with nothing but a loopback interface. Operations are rejected the way
+# the real kernel would where the agent depends on it (e.g., FDB entries on VLANs that
+# are not configured, masters that do not exist, or routes via gateways that are not
+# on-link), with the error messages printed by iproute2, and the side effects the
+# agent has to cope with are simulated as well (e.g., the IPv4 routes that are
+# silently flushed when a link goes down, or the VLANs removed from a port leaving
+# its bridge). Every change is notified to the monitors, like rtnetlink does.
+
+from collections import Counter
+import errno
+import ipaddress
+import socket
+import threading
+
+from . import netlink
+from .dataplane import Backend, Error
+from .netlink import Address, BridgePort, Fdb, Link, Neigh, Route
+
+
+class Monitor:
+    """The monitor of the simulated kernel. Notifications are pushed to it directly,
+    and its socket is signalled whenever there are any."""
+
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.peer.setblocking(False)
+        self.lock = threading.Lock()
+        self.events = []
+
+    def push(self, event):
+        with self.lock:
+            if not self.events:
+                try:
+                    self.peer.send(b"\0")
+                except BlockingIOError:
+                    pass
+            self.events.append(event)
+
+    def read(self):
+        with self.lock:
+            try:
+                while self.sock.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+            events, self.events = self.events, []
+        return events
+
+
+class SimulatedKernel(Backend):
+    """The simulated kernel. Every operation executed is counted (see counts), and the
+    failed ones are recorded (see failures)."""
+
+    # Route table names, cf. /etc/iproute2/rt_tables
+    TABLES = {"255": "local", "254": "main", "253": "default"}
+
+    # The defaults of the type specific attributes of the link types that have any
+    INFO_DATA = {
+        "bridge": {"vlan_filtering": 0, "vlan_default_pvid": 1},
+        "vxlan": {"learning": True, "port": 8472},
+    }
+
+    def __init__(self, *, loopback="192.0.2.1"):
+        self.lock = threading.RLock()
+        self.monitors = []
+        self.counts = Counter()
+        self.failures = []
+        self.next_ifindex = 1
+        self.links = {}
+        self.addresses = {}
+        self.neighs = {}
+        self.routes = {}
+        self.vlans = {}
+        self.fdb = {}
+        # The other half of each veth pair, and the lower device of each VLAN device
+        self.peers = {}
+        self.lowers = {}
+        lo = self._new_link("lo", None, up=True, mtu=65536)
+        self._add_address(lo, "127.0.0.1", 8, scope="host")
+        self._add_address(lo, loopback, 32)
+
+    def monitor(self):
+        monitor = Monitor()
+        self.monitors.append(monitor)
+        return monitor
+
+    def execute(self, kind, queue):
+        with self.lock:
+            self.counts.update(operation for operation, _, _ in queue)
+            failures = super().execute(kind, queue)
+        self.failures.extend(f"{description}: {e}" for _, description, e in failures)
+        return failures
+
+    # Notifications and dumps
+    def _notify(self, kind, action, record):
+        for monitor in self.monitors:
+            monitor.push((kind, action, record))
+
+    def _in_bridge(self, link):
+        return link.master in self.links and self.links[link.master].kind == "bridge"
+
+    def _is_bridge_port(self, link):
+        return link.kind == "bridge" or self._in_bridge(link)
+
+    def _bridge_port(self, link):
+        return BridgePort(
+            ifindex=link.ifindex,
+            ifname=link.ifname,
+            master=link.ifname if link.kind == "bridge" else link.master,
+            vlans=frozenset(self.vlans.get(link.ifname, ())),
+        )
+
+    def dump_links(self):
+        with self.lock:
+            return list(self.links.values())
+
+    def dump_addresses(self):
+        with self.lock:
+            return list(self.addresses.values())
+
+    def dump_neighs(self, *, proto):
+        proto = netlink.rt_proto(proto)
+        with self.lock:
+            return [n for n in self.neighs.values() if n.protocol == proto]
+
+    def dump_routes(self, *, proto):
+        proto = netlink.rt_proto(proto)
+        with self.lock:
+            return [r for r in self.routes.values() if r.protocol == proto]
+
+    def dump_fdb(self, *, dev, master):
+        with self.lock:
+            for name in (dev, master):
+                if name not in self.links:
+                    raise OSError(errno.ENODEV, f"No such device: {name}")
+            return [f for f in self.fdb.values() if f.dev == dev and f.master == master]
+
+    def dump_bridge_ports(self):
+        with self.lock:
+            return [
+                self._bridge_port(link)
+                for link in self.links.values()
+                if self._is_bridge_port(link)
+            ]
+
+    # Links
+    def _get_link(self, name):
+        if name not in self.links:
+            raise Error(f'Cannot find device "{name}"')
+        return self.links[name]
+
+    def _new_link(self, name, kind, **attrs):
+        link = Link(
+            ifindex=self.next_ifindex,
+            ifname=name,
+            up=False,
+            mtu=1500,
+            master=None,
+            address="02:00:00:%02x:%02x:%02x"
+            % tuple((self.next_ifindex >> s) & 0xFF for s in (16, 8, 0)),
+            ifalias=None,
+            inet6_addr_gen_mode="eui64",
+            kind=kind,
+            info_data={},
+            slave_data={},
+        )._replace(**attrs)
+        self.next_ifindex += 1
+        self.links[name] = link
+        self._notify("link", "new", link)
+        return link
+
+    def _set_link(self, link, **attrs):
+        old = link
+        link = link._replace(**attrs)
+        if "master" in attrs and attrs["master"] != old.master:
+            if attrs["master"] is not None:
+                master = self._get_link(attrs["master"])
+                if master.kind not in ("bridge", "vrf"):
+                    raise Error("RTNETLINK answers: Operation not supported")
+            if self._in_bridge(old):
+                # Leaving a bridge flushes the port's VLANs and FDB entries
+                for key in [k for k, f in self.fdb.items() if f.dev == link.ifname]:
+                    self._notify("fdb", "del", self.fdb.pop(key))
+                self.vlans.pop(link.ifname, None)
+                if old.kind != "bridge":
+                    self._notify("bridge_port", "del", self._bridge_port(old))
+            if attrs["master"] and self.links[attrs["master"]].kind == "bridge":
+                link = link._replace(
+                    slave_data={"learning": True, "neigh_suppress": False}
+                )
+                pvid = self.links[attrs["master"]].info_data["vlan_default_pvid"]
+                if pvid:
+                    self.vlans[link.ifname] = {pvid}
+            else:
+                link = link._replace(slave_data={})
+        if old.up and not link.up:
+            self._flush_routes(link.ifname)
+        self.links[link.ifname] = link
+        self._notify("link", "new", link)
+        # The link comes up before any other attributes in the same request are
+        # applied, so it is the address generation mode it had until now that counts
+        if link.up and not old.up and old.inet6_addr_gen_mode == "eui64":
+            self._add_link_local(link)
+        if self._is_bridge_port(link):
+            self._notify("bridge_port", "new", self._bridge_port(link))
+        return link
+
+    def _link_attrs(self, attrs):
+        for attr in attrs:
+            if attr != "up" and attr not in Link._fields:
+                raise Error(
+                    f'Error: either "dev" is duplicate, or "{attr}" is garbage.'
+                )
+        attrs = dict(attrs)
+        if "address" in attrs:
+            attrs["address"] = attrs["address"].lower()
+        if "mtu" in attrs:
+            attrs["mtu"] = int(attrs["mtu"])
+        return attrs
+
+    def add_link(self, *, name, type, link=None, attrs={}, type_attrs={}):
+        peer = link if type == "veth" else None
+        lower = self._get_link(link) if link and type != "veth" else None
+        attrs = self._link_attrs(attrs)
+        for ifname in (name, peer):
+            if ifname in self.links:
+                raise Error("RTNETLINK answers: File exists")
+        if type == "vlan" and lower is None:
+            raise Error('Not enough information: "link" argument is required')
+        if lower is not None and attrs.get("mtu", lower.mtu) > lower.mtu:
+            raise Error("RTNETLINK answers: Numerical result out of range")
+        master = attrs.pop("master", None)
+        if master is not None and master not in self.links:
+            raise Error(f'Error: argument "{master}" is wrong: Device does not exist')
+        info_data = dict(self.INFO_DATA.get(type, {}), **type_attrs)
+        if lower is not None:
+            attrs.setdefault("mtu", lower.mtu)
+        new = self._new_link(name, type, info_data=info_data, **attrs)
+        if new.up:
+            self._add_link_local(new)
+        if type == "bridge" and info_data["vlan_default_pvid"]:
+            self.vlans[name] = {info_data["vlan_default_pvid"]}
+            self._notify("bridge_port", "new", self._bridge_port(new))
+        if master:
+            self._set_link(new, master=master)
+        if lower is not None:
+            self.lowers[name] = lower.ifname
+        if type == "veth":
+            peer = self._new_link(peer or f"veth{new.ifindex}", "veth")
+            self.peers[name] = peer.ifname
+            self.peers[peer.ifname] = name
+
+    def set_link(self, *, name, attrs={}, type=None, type_attrs={}):
+        link = self._get_link(name)
+        attrs = self._link_attrs(attrs)
+        if type == "bridge_slave":
+            if not self._is_bridge_port(link) or link.kind == "bridge":
+                raise Error("RTNETLINK answers: Operation not supported")
+            attrs["slave_data"] = dict(link.slave_data, **type_attrs)
+        elif type is not None and type != link.kind:
+            raise Error("RTNETLINK answers: Operation not supported")
+        elif type_attrs:
+            attrs["info_data"] = dict(link.info_data, **type_attrs)
+        lower = self.links.get(self.lowers.get(name))
+        if lower and attrs.get("mtu", 0) > lower.mtu:
+            raise Error("RTNETLINK answers: Numerical result out of range")
+        self._set_link(link, **attrs)
+
+    def del_link(self, *, name):
+        self._del_link(self._get_link(name))
+
+    def _del_link(self, link):
+        name = link.ifname
+        # VLAN devices go away along with their lower device, as does the other half
+        # of a veth pair, while the ports of a bridge or VRF are released
+        for upper, lower in list(self.lowers.items()):
+            if lower == name and upper in self.links:
+                self._del_link(self.links[upper])
+        for upper in [l for l in self.links.values() if l.master == name]:
+            self._set_link(upper, master=None)
+        for key in [k for k, a in self.addresses.items() if a.ifname == name]:
+            self._notify("address", "del", self.addresses.pop(key))
+        for key in [k for k, n in self.neighs.items() if n.dev == name]:
+            self._notify("neigh", "del", self.neighs.pop(key))
+        for key in [k for k, f in self.fdb.items() if name in (f.dev, f.master)]:
+            self._notify("fdb", "del", self.fdb.pop(key))
+        self._flush_routes(name, ipv6=True)
+        if self._is_bridge_port(link):
+            self._notify("bridge_port", "del", self._bridge_port(link))
+        self.vlans.pop(name, None)
+        del self.links[name]
+        self._notify("link", "del", link)
+        self.lowers.pop(name, None)
+        peer = self.peers.pop(name, None)
+        if peer:
+            self.peers.pop(peer, None)
+            self._del_link(self.links[peer])
+
+    def _flush_routes(self, dev, ipv6=False):
+        # The kernel silently flushes the IPv4 routes via a link that is removed or
+        # set down, while IPv6 routes are only removed (with notifications) along
+        # with the link itself
+        for key in [k for k, r in self.routes.items() if r.dev == dev]:
+            route = self.routes[key]
+            if ":" not in route.dst:
+                del self.routes[key]
+            elif ipv6:
+                self._notify("route", "del", self.routes.pop(key))
+
+    # Addresses
+    def _add_address(self, link, local, prefixlen, scope="global"):
+        address = Address(
+            ifname=link.ifname,
+            family="inet6" if ":" in local else "inet",
+            local=local,
+            prefixlen=prefixlen,
+            scope=scope,
+        )
+        self.addresses[(link.ifname, local, prefixlen)] = address
+        self._notify("address", "new", address)
+
+    def _add_link_local(self, link):
+        # The kernel generates an IPv6 link-local address for a link in eui64 mode
+        # when it comes up, which stays in place if the mode is changed afterwards
+        mac = bytearray.fromhex(link.address.replace(":", ""))
+        mac[0] ^= 0x02
+        iid = bytes(mac[:3]) + b"\xff\xfe" + bytes(mac[3:])
+        local = str(ipaddress.IPv6Address(b"\xfe\x80" + bytes(6) + iid))
+        self._add_address(link, local, 64, scope="link")
+
+    def _address_key(self, dev, address):
+        link = self._get_link(dev)
+        interface = ipaddress.ip_interface(address)
+        return (link.ifname, str(interface.ip), interface.network.prefixlen)
+
+    def add_address(self, *, dev, address):
+        key = self._address_key(dev, address)
+        if key in self.addresses:
+            raise Error("RTNETLINK answers: File exists")
+        self._add_address(self.links[dev], key[1], key[2])
+
+    def del_address(self, *, dev, address):
+        key = self._address_key(dev, address)
+        if key not in self.addresses:
+            raise Error("RTNETLINK answers: Cannot assign requested address")
+        self._notify("address", "del", self.addresses.pop(key))
+
+    # Neighbours
+    def replace_neigh(self, *, dst, dev, lladdr, proto):
+        dev = self._get_link(dev).ifname
+        neigh = Neigh(
+            dst=str(ipaddress.ip_address(dst)),
+            dev=dev,
+            lladdr=lladdr.lower(),
+            permanent=True,
+            protocol=netlink.rt_proto(proto),
+        )
+        self.neighs[(neigh.dst, dev)] = neigh
+        self._notify("neigh", "new", neigh)
+
+    def del_neigh(self, *, dst, dev, lladdr, proto):
+        key = (str(ipaddress.ip_address(dst)), self._get_link(dev).ifname)
+        if key not in self.neighs:
+            raise Error("RTNETLINK answers: No such file or directory")
+        self._notify("neigh", "del", self.neighs.pop(key))
+
+    # Routes
+    def _route_dst(self, dst):
+        try:
+            dst = ipaddress.ip_network(dst)
+        except ValueError:
+            raise Error(f'Error: any valid prefix is expected rather than "{dst}".')
+        if dst.prefixlen == dst.max_prefixlen:
+            return str(dst.network_address)
+        return str(dst)
+
+    def add_route(self, *, route, proto):
+        dst = self._route_dst(route.dst)
+        table = str(route.table or "main")
+        table = self.TABLES.get(table, table)
+        metric = route.metric
+        if metric is None and ":" in dst:
+            metric = 1024
+        key = (dst, table, metric)
+        if key in self.routes:
+            raise Error("RTNETLINK answers: File exists")
+        dev = None
+        if route.dev:
+            dev = self._get_link(route.dev)
+            if not dev.up:
+                raise Error("Error: Nexthop device is not up.")
+        gateway = route.gateway
+        if gateway:
+            gw = ipaddress.ip_address(gateway)
+            if not gw.is_link_local and not any(
+                a.ifname == (dev.ifname if dev else a.ifname)
+                and gw in ipaddress.ip_interface(f"{a.local}/{a.prefixlen}").network
+                for a in self.addresses.values()
+            ):
+                raise Error("Error: Nexthop has invalid gateway.")
+            gateway = str(gw)
+        new = Route(
+            dst=dst,
+            gateway=gateway,
+            dev=dev.ifname if dev else None,
+            type=route.type or "unicast",
+            metric=metric,
+            table=table,
+            protocol=netlink.rt_proto(proto),
+        )
+        self.routes[key] = new
+        self._notify("route", "new", new)
+
+    def del_route(self, *, dst, table, proto):
+        dst = self._route_dst(dst)
+        table = self.TABLES.get(str(table), str(table))
+        proto = netlink.rt_proto(proto)
+        for key, route in self.routes.items():
+            if route.dst == dst and route.table == table and route.protocol == proto:
+                self._notify("route", "del", self.routes.pop(key))
+                return
+        raise Error("RTNETLINK answers: No such process")
+
+    # Bridge VLANs and FDB entries
+    def _vlan_port(self, dev, bridge):
+        link = self._get_link(dev)
+        if link.kind == "bridge" and not bridge:
+            raise Error("RTNETLINK answers: Operation not supported")
+        if not self._is_bridge_port(link):
+            raise Error("RTNETLINK answers: Operation not supported")
+        return link
+
+    def add_vlan(self, *, dev, vid, tagged=True, bridge=False):
+        link = self._vlan_port(dev, bridge)
+        self.vlans.setdefault(link.ifname, set()).add(int(vid))
+        self._notify("bridge_port", "new", self._bridge_port(link))
+
+    def del_vlan(self, *, dev, vid, bridge=False):
+        link = self._vlan_port(dev, bridge)
+        vid = int(vid)
+        if vid not in self.vlans.get(link.ifname, ()):
+            raise Error("RTNETLINK answers: No such file or directory")
+        self.vlans[link.ifname].discard(vid)
+        for key in [
+            k for k, f in self.fdb.items() if f.dev == link.ifname and f.vlan == vid
+        ]:
+            self._notify("fdb", "del", self.fdb.pop(key))
+        self._notify("bridge_port", "new", self._bridge_port(link))
+
+    def _fdb_key(self, mac, dev, vid, message):
+        link = self._get_link(dev)
+        if not self._in_bridge(link):
+            raise Error("RTNETLINK answers: Operation not supported")
+        bridge = self.links[link.master]
+        vid = int(vid)
+        if bridge.info_data.get("vlan_filtering") and vid not in self.vlans.get(
+            link.ifname, ()
+        ):
+            raise Error(
+                f"Error: bridge: RTM_{message} with unconfigured vlan {vid} on "
+                f"{link.ifname}."
+            )
+        return (mac.lower(), vid, bridge.ifname)
+
+    def replace_fdb(self, *, mac, dev, vid):
+        key = self._fdb_key(mac, dev, vid, "NEWNEIGH")
+        entry = Fdb(
+            mac=key[0],
+            dev=dev,
+            vlan=key[1],
+            flags=("sticky",),
+            master=key[2],
+            state="static",
+        )
+        self.fdb[key] = entry
+        self._notify("fdb", "new", entry)
+
+    def del_fdb(self, *, mac, dev, vid):
+        key = self._fdb_key(mac, dev, vid, "DELNEIGH")
+        if key not in self.fdb:
+            raise Error("RTNETLINK answers: No such file or directory")
+        self._notify("fdb", "del", self.fdb.pop(key))
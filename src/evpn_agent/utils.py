@@ -15,21 +15,55 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json
+from contextlib import contextmanager
 import logging
+import os
 import subprocess
 
+from . import metrics
+
 log = logging.getLogger(__name__)
 
+# The owner of any resources ensured at the moment, see owner()
+current_owner = None
+
 
 def cmd(args, *, check=True, **kwargs):
     log.debug(f"Executing: {args}")
-    proc = subprocess.run(args, check=check, **kwargs)
+    tool = os.path.basename(args[0])
+    metrics.commands.inc(tool=tool)
+    with metrics.command_duration.time(tool=tool):
+        proc = subprocess.run(args, check=check, **kwargs)
     return proc
 
 
-def jsoncmd(args):
-    proc = cmd(args, capture_output=True)
-    data = json.loads(proc.stdout)
-    #log.debug(f"Decoded JSON: {data}")
-    return data
+@contextmanager
+def owner(name):
+    """Attributes any resources ensured within the context to the given owner (e.g., a
+    network ID). The managers retain the resources of each owner until told to forget
+    them, so that the owner need not be processed on every iteration of the main loop
+    in order to prevent its resources from being garbage collected. Resources ensured
+    outside of any owner context belong to the None owner, which the main loop forgets
+    at the start of every full iteration."""
+    global current_owner
+    previous_owner = current_owner
+    current_owner = name
+    try:
+        yield
+    finally:
+        current_owner = previous_owner
+
+
+def claim(known, resource):
+    """Records that a (hashable) resource is known on behalf of the current owner. The
+    resources of each owner are kept in a dict used as an ordered set."""
+    known.setdefault(current_owner, {})[resource] = None
+
+
+def claimed(known):
+    """Returns all known resources regardless of owner, as a dict used as an ordered
+    set (i.e., in the order they were first claimed, without duplicates)"""
+    resources = {}
+    for owned in known.values():
+        resources.update(owned)
+    return resources
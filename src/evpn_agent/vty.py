@@ -0,0 +1,158 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A minimal client for the VTY Unix sockets of the FRR daemons, speaking the same
+# protocol as vtysh, so that FRR can be queried and configured without forking vtysh.
+# Each command is sent as a NUL-terminated string, and the daemon responds with the
+# command's output followed by three NUL bytes and the command's return code.
+#
+# vtysh knows which daemons implement each command (through a per-command mask of
+# daemons), and only sends a command to those. This client has no such knowledge, so it
+# sends every command to all the daemons instead, and considers it successful if at
+# least one of them accepted it and none of the others failed for any other reason than
+# not knowing the command. The connections are kept open across calls, and are
+# re-established if the daemons have been restarted in the meantime.
+
+import glob
+import logging
+import os
+import socket
+
+log = logging.getLogger(__name__)
+
+# Command return codes, cf. lib/command.h in FRR
+CMD_SUCCESS = 0
+CMD_ERR_NO_MATCH = 2
+
+TERMINATOR = b"\0\0\0"
+
+
+class Vty:
+    """A set of persistent connections to the VTY sockets found in sockdir. Quacks
+    enough like frrlib.Vtysh to be used by frrlib.Config to load the running config."""
+
+    def __init__(self, sockdir="/var/run/frr"):
+        self.sockdir = sockdir
+        self.socks = {}
+
+    def connect(self):
+        self.close()
+        for path in sorted(glob.glob(os.path.join(self.sockdir, "*.vty"))):
+            daemon = os.path.basename(path)[: -len(".vty")]
+            log.debug(f"Connecting to {daemon} VTY socket {path}")
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+            except OSError as e:
+                # Stale sockets may be left behind by daemons that are not running
+                log.debug(f"Could not connect to {path}: {e}")
+                sock.close()
+                continue
+            self.socks[daemon] = sock
+            status, output = self.command(daemon, "enable")
+            if status != CMD_SUCCESS:
+                raise ConnectionError(f"'enable' failed on {daemon}: {output}")
+        if not self.socks:
+            raise ConnectionError(f"No FRR daemons reachable via {self.sockdir}")
+
+    def close(self):
+        for sock in self.socks.values():
+            sock.close()
+        self.socks = {}
+
+    def command(self, daemon, command):
+        """Executes a command on a single daemon, returning its return code and
+        output"""
+        sock = self.socks[daemon]
+        try:
+            sock.sendall(command.encode() + b"\0")
+            buf = bytearray()
+            while not (len(buf) >= 4 and buf[-4:-1] == TERMINATOR):
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionError(f"{daemon} closed the VTY connection")
+                buf += data
+        except OSError:
+            self.close()
+            raise
+        return buf[-1], buf[:-4].decode()
+
+    def execute(self, command):
+        """Executes a command on all daemons, returning None if it succeeded, or an
+        error message if it did not"""
+        results = {daemon: self.command(daemon, command) for daemon in list(self.socks)}
+        errors = [
+            f"{daemon}: {output.strip()}"
+            for daemon, (status, output) in results.items()
+            if status not in (CMD_SUCCESS, CMD_ERR_NO_MATCH)
+        ]
+        if errors:
+            return "; ".join(errors)
+        if all(status != CMD_SUCCESS for status, _ in results.values()):
+            return "unknown command"
+        return None
+
+    def _reconnecting(self, func):
+        """Calls func, reconnecting and calling it again if the connections turn out to
+        have gone stale (e.g., because FRR has been restarted)"""
+        for attempt in (1, 2):
+            try:
+                if not self.socks:
+                    self.connect()
+                return func()
+            except OSError as e:
+                if attempt == 2:
+                    raise
+                log.warning(f"Lost connection to FRR ({e}), reconnecting")
+
+    def show_running(self, daemon=None):
+        """Returns the running config of one or all daemons"""
+        return self._reconnecting(
+            lambda: "\n".join(
+                self.command(d, "do write terminal")[1]
+                for d in list(self.socks)
+                if daemon in (None, d)
+            )
+        )
+
+    # Used by frrlib.Config.load_from_show_running(). The output of vtysh is marked up
+    # by running it through 'vtysh -m', but FRR has been including explicit exit
+    # markers in the running config by itself since version 8.2.
+    mark_show_run = show_running
+
+    def configure(self, blocks):
+        """Executes a list of blocks of configuration commands, as produced by
+        frrlib.lines_to_config(), each starting from the top level of configuration
+        mode. Returns the index and error message of every block that failed."""
+        failures = []
+        # Stale connections are found out when entering configuration mode, before
+        # anything has been changed, so that it is safe to start over
+        self._reconnecting(lambda: self.execute("configure terminal"))
+        try:
+            for i, block in enumerate(blocks):
+                for command in block:
+                    if error := self.execute(command):
+                        failures.append((i, f"{command}: {error}"))
+                        break
+                # Return to the top level before the next block, as the daemons only
+                # fall back to parent nodes for unknown commands when reading files
+                self.execute("end")
+                self.execute("configure terminal")
+        finally:
+            if self.socks:
+                self.execute("end")
+        return failures
@@ -0,0 +1,98 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+import pytest
+
+from evpn_agent import dataplane
+from evpn_agent.config import conf
+from evpn_agent.routemanager import Route
+from evpn_agent.simkernel import SimulatedKernel
+
+
+class SlowKernel(SimulatedKernel):
+    """Executes removals slowly, so that they would be overtaken by additions executed
+    concurrently"""
+
+    def execute(self, kind, queue):
+        if kind[1]:
+            time.sleep(0.1)
+        return super().execute(kind, queue)
+
+
+def _kernel(monkeypatch):
+    kernel = SlowKernel()
+    monkeypatch.setattr(dataplane, "backend", kernel)
+    monkeypatch.setattr(dataplane, "pending", {})
+    kernel.add_link(name="dummy0", type="dummy", attrs={"up": True})
+    kernel.add_address(dev="dummy0", address="192.0.2.1/24")
+    return kernel
+
+
+def test_replace_route(monkeypatch):
+    kernel = _kernel(monkeypatch)
+    proto = conf["agent"]["rt_proto"]
+    kernel.add_route(
+        route=Route(dst="198.51.100.0/24", gateway="192.0.2.2", dev="dummy0"),
+        proto=proto,
+    )
+
+    # The same key (destination, table and metric) with a new gateway
+    dataplane.batch(
+        "add_route",
+        route=Route(dst="198.51.100.0/24", gateway="192.0.2.3", dev="dummy0"),
+        proto=proto,
+    )
+    dataplane.batch("del_route", dst="198.51.100.0/24", table="main", proto=proto)
+    dataplane.flush()
+    assert [route.gateway for route in kernel.routes.values()] == ["192.0.2.3"]
+    assert kernel.failures == []
+
+
+def test_replace_neigh(monkeypatch):
+    kernel = _kernel(monkeypatch)
+    proto = conf["agent"]["rt_proto"]
+    kernel.replace_neigh(
+        dst="192.0.2.2", dev="dummy0", lladdr="02:00:00:00:00:01", proto=proto
+    )
+
+    dataplane.batch(
+        "replace_neigh",
+        dst="192.0.2.2",
+        dev="dummy0",
+        lladdr="02:00:00:00:00:02",
+        proto=proto,
+    )
+    dataplane.batch(
+        "del_neigh",
+        dst="192.0.2.2",
+        dev="dummy0",
+        lladdr="02:00:00:00:00:01",
+        proto=proto,
+    )
+    dataplane.flush()
+    assert [neigh.lladdr for neigh in kernel.neighs.values()] == ["02:00:00:00:00:02"]
+
+
+def test_incomplete_backend():
+    class Incomplete(dataplane.Backend):
+        def monitor(self):
+            pass
+
+    with pytest.raises(TypeError, match="dump_links"):
+        Incomplete()
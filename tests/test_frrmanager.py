@@ -0,0 +1,76 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import ipaddress
+import types
+
+from evpn_agent import frrmanager
+
+
+def _normalized_ipv6_line(line):
+    # Like frr-reload.py, which compresses any IPv6 addresses and prefixes
+    words = []
+    for word in line.split():
+        try:
+            if "/" in word:
+                word = str(ipaddress.IPv6Network(word, strict=False))
+            else:
+                word = str(ipaddress.IPv6Address(word))
+        except ValueError:
+            pass
+        words.append(word)
+    return " ".join(words)
+
+
+def _normalized_mac_ip_line(line):
+    if line.startswith("evpn mh es-sys-mac"):
+        return line.lower()
+    return _normalized_ipv6_line(line)
+
+
+SNIPPET = """router bgp 64512 vrf vrf-1
+ address-family l2vpn evpn
+  advertise ipv6 unicast
+  evpn mh es-sys-mac   02:AA:BB:CC:DD:EE
+ exit-address-family
+ neighbor 2001:0db8:0000::0001 remote-as external
+exit
+"""
+
+
+def test_normalise_mac(monkeypatch):
+    frrlib = types.SimpleNamespace(
+        get_normalized_ipv6_line=_normalized_ipv6_line,
+        get_normalized_mac_ip_line=_normalized_mac_ip_line,
+    )
+    monkeypatch.setattr(frrmanager, "frrlib", frrlib)
+    assert frrmanager._normalise(SNIPPET) == [
+        "router bgp 64512 vrf vrf-1",
+        "address-family l2vpn evpn",
+        "advertise ipv6 unicast",
+        "evpn mh es-sys-mac 02:aa:bb:cc:dd:ee",
+        "exit-address-family",
+        "neighbor 2001:db8::1 remote-as external",
+        "exit",
+    ]
+
+
+def test_normalise_ipv6_only(monkeypatch):
+    # Older versions of frr-reload.py only normalise IPv6 addresses
+    frrlib = types.SimpleNamespace(get_normalized_ipv6_line=_normalized_ipv6_line)
+    monkeypatch.setattr(frrmanager, "frrlib", frrlib)
+    assert frrmanager._normalise(SNIPPET)[3] == "evpn mh es-sys-mac 02:AA:BB:CC:DD:EE"
@@ -0,0 +1,85 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import subprocess
+
+import pytest
+
+from evpn_agent import iproute2
+from evpn_agent.iproute2 import Iproute2
+
+QUEUE = [
+    ("add_address", {"dev": "dummy0", "address": "192.0.2.1/24"}, "net-1"),
+    ("add_address", {"dev": "dummy0", "address": "192.0.2.2/24"}, "net-2"),
+    ("add_address", {"dev": "dummy9", "address": "192.0.2.3/24"}, "net-3"),
+    ("add_address", {"dev": "dummy0", "address": "192.0.2.4/24"}, "net-4"),
+]
+
+
+def _run(monkeypatch, returncode, stderr):
+    runs = []
+
+    def run(args, *, input, **kwargs):
+        runs.append((args, input))
+        return subprocess.CompletedProcess(args, returncode, "", stderr)
+
+    monkeypatch.setattr(iproute2.subprocess, "run", run)
+    return runs
+
+
+def test_execute_failures(monkeypatch):
+    # The messages of each failed command precede the line identifying it, and the
+    # messages of the last command are followed by nothing else
+    runs = _run(
+        monkeypatch,
+        1,
+        "RTNETLINK answers: No such device\n"
+        'Cannot find device "dummy9"\n'
+        "Command failed -:3\n"
+        "Command failed -:4\n",
+    )
+    failures = Iproute2().execute(("address", False), QUEUE)
+    assert runs == [
+        (
+            ["ip", "-force", "-batch", "-"],
+            "address add dev dummy0 192.0.2.1/24\n"
+            "address add dev dummy0 192.0.2.2/24\n"
+            "address add dev dummy9 192.0.2.3/24\n"
+            "address add dev dummy0 192.0.2.4/24\n",
+        )
+    ]
+    assert failures == [
+        (
+            "net-3",
+            "ip address add dev dummy9 192.0.2.3/24",
+            'RTNETLINK answers: No such device Cannot find device "dummy9"',
+        ),
+        ("net-4", "ip address add dev dummy0 192.0.2.4/24", "unknown error"),
+    ]
+
+
+def test_execute_success(monkeypatch):
+    # Messages not followed by a failure (e.g., warnings) are not failures
+    _run(monkeypatch, 0, "Warning: deprecated option\n")
+    assert Iproute2().execute(("address", False), QUEUE) == []
+
+
+def test_execute_crash(monkeypatch):
+    # A non-zero exit status without any failed commands is unexpected
+    _run(monkeypatch, 255, 'Object "address" is unknown, try "ip help".\n')
+    with pytest.raises(subprocess.CalledProcessError):
+        Iproute2().execute(("address", False), QUEUE)
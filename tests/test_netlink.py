@@ -0,0 +1,261 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import socket
+import struct
+
+import pytest
+
+from evpn_agent import netlink
+from evpn_agent.netlink import BridgePort, Fdb, Link, Neigh, Route, _attr
+
+NLA_F_NESTED = 0x8000
+
+
+@pytest.fixture(autouse=True)
+def ifnames(monkeypatch):
+    monkeypatch.setattr(netlink, "ifnames", {2: "dummy0", 5: "br-evpn", 7: "vx-100"})
+
+
+def _ifinfomsg(index, flags, *attrs):
+    return struct.pack("=BxHiII", socket.AF_UNSPEC, 0, index, flags, 0) + b"".join(
+        attrs
+    )
+
+
+def _ndmsg(family, index, state, flags, *attrs):
+    return struct.pack("=BxxxiHBB", family, index, state, flags, 0) + b"".join(attrs)
+
+
+def _rtmsg(family, dst_len, table, protocol, type, flags, *attrs):
+    header = struct.pack(
+        "=BBBBBBBBI", family, dst_len, 0, 0, table, protocol, 0, type, flags
+    )
+    return header + b"".join(attrs)
+
+
+def _nested(type, *attrs):
+    return _attr(type | NLA_F_NESTED, b"".join(attrs))
+
+
+def test_link_bridge_slave():
+    msg = _ifinfomsg(
+        7,
+        netlink.IFF_UP,
+        _attr(netlink.IFLA_IFNAME, b"vx-100\0"),
+        _attr(netlink.IFLA_MTU, struct.pack("=I", 9000)),
+        _attr(netlink.IFLA_MASTER, struct.pack("=I", 5)),
+        _attr(netlink.IFLA_ADDRESS, bytes.fromhex("020000000064")),
+        _nested(
+            netlink.IFLA_AF_SPEC,
+            _nested(socket.AF_INET6, _attr(netlink.IFLA_INET6_ADDR_GEN_MODE, b"\x01")),
+        ),
+        _nested(
+            netlink.IFLA_LINKINFO,
+            _attr(netlink.IFLA_INFO_KIND, b"vxlan\0"),
+            _nested(
+                netlink.IFLA_INFO_DATA,
+                _attr(1, struct.pack("=I", 100)),
+                _attr(4, socket.inet_aton("192.0.2.1")),
+                _attr(7, b"\x00"),
+                _attr(15, struct.pack("!H", 4789)),
+                # Attributes not of interest are ignored
+                _attr(2, struct.pack("=I", 2)),
+            ),
+            _attr(netlink.IFLA_INFO_SLAVE_KIND, b"bridge\0"),
+            _nested(
+                netlink.IFLA_INFO_SLAVE_DATA,
+                _attr(8, b"\x00"),
+                _attr(32, b"\x01"),
+            ),
+        ),
+    )
+    assert netlink._link(msg) == Link(
+        ifindex=7,
+        ifname="vx-100",
+        up=True,
+        mtu=9000,
+        master="br-evpn",
+        address="02:00:00:00:00:64",
+        ifalias=None,
+        inet6_addr_gen_mode="none",
+        kind="vxlan",
+        info_data={"id": 100, "local": "192.0.2.1", "learning": False, "port": 4789},
+        slave_data={"learning": False, "neigh_suppress": True},
+    )
+
+
+def test_link_plain():
+    msg = _ifinfomsg(2, 0, _attr(netlink.IFLA_IFNAME, b"dummy0\0"))
+    assert netlink._link(msg) == Link(
+        ifindex=2,
+        ifname="dummy0",
+        up=False,
+        mtu=None,
+        master=None,
+        address=None,
+        ifalias=None,
+        inet6_addr_gen_mode=None,
+        kind=None,
+        info_data={},
+        slave_data={},
+    )
+
+
+def _vlan_info(flags, vid):
+    return _attr(netlink.IFLA_BRIDGE_VLAN_INFO, struct.pack("=HH", flags, vid))
+
+
+def test_bridge_port_vlan_ranges():
+    # Notifications describe consecutive VLANs as ranges (PVID and untagged flags
+    # notwithstanding)
+    msg = _ifinfomsg(
+        7,
+        0,
+        _attr(netlink.IFLA_IFNAME, b"vx-100\0"),
+        _attr(netlink.IFLA_MASTER, struct.pack("=I", 5)),
+        _nested(
+            netlink.IFLA_AF_SPEC,
+            # IFLA_BRIDGE_FLAGS
+            _attr(1, struct.pack("=H", 0)),
+            _vlan_info(0x2 | 0x4, 1),
+            _vlan_info(netlink.BRIDGE_VLAN_INFO_RANGE_BEGIN, 100),
+            _vlan_info(netlink.BRIDGE_VLAN_INFO_RANGE_END, 102),
+            _vlan_info(0, 200),
+        ),
+    )
+    assert netlink._bridge_port(msg) == BridgePort(
+        ifindex=7,
+        ifname="vx-100",
+        master="br-evpn",
+        vlans=frozenset({1, 100, 101, 102, 200}),
+    )
+
+
+def test_bridge_port_no_vlans():
+    msg = _ifinfomsg(5, 0, _attr(netlink.IFLA_IFNAME, b"br-evpn\0"))
+    assert netlink._bridge_port(msg) == BridgePort(
+        ifindex=5, ifname="br-evpn", master=None, vlans=frozenset()
+    )
+
+
+def test_neigh():
+    msg = _ndmsg(
+        socket.AF_INET6,
+        2,
+        netlink.NUD_PERMANENT,
+        0,
+        _attr(netlink.NDA_DST, socket.inet_pton(socket.AF_INET6, "2001:db8::2")),
+        _attr(netlink.NDA_LLADDR, bytes.fromhex("020000000001")),
+        _attr(netlink.NDA_PROTOCOL, b"\xff"),
+    )
+    assert netlink._neigh(msg) == Neigh(
+        dst="2001:db8::2",
+        dev="dummy0",
+        lladdr="02:00:00:00:00:01",
+        permanent=True,
+        protocol=255,
+    )
+
+    # Incomplete entries have no link layer address, nor protocol
+    msg = _ndmsg(
+        socket.AF_INET,
+        2,
+        netlink.NUD_REACHABLE,
+        0,
+        _attr(netlink.NDA_DST, socket.inet_aton("192.0.2.2")),
+    )
+    assert netlink._neigh(msg) == Neigh(
+        dst="192.0.2.2", dev="dummy0", lladdr=None, permanent=False, protocol=None
+    )
+    assert netlink._neigh(_ndmsg(socket.AF_BRIDGE, 7, 0, 0)) is None
+
+
+def test_fdb():
+    msg = _ndmsg(
+        socket.AF_BRIDGE,
+        7,
+        netlink.NUD_NOARP,
+        0x40 | 0x2,
+        _attr(netlink.NDA_LLADDR, bytes.fromhex("020000000001")),
+        _attr(netlink.NDA_VLAN, struct.pack("=H", 100)),
+        _attr(netlink.NDA_MASTER, struct.pack("=I", 5)),
+    )
+    assert netlink._fdb(msg) == Fdb(
+        mac="02:00:00:00:00:01",
+        dev="vx-100",
+        vlan=100,
+        flags=("self", "sticky"),
+        master="br-evpn",
+        state="static",
+    )
+    assert netlink._fdb(_ndmsg(socket.AF_BRIDGE, 7, 0, 0)) is None
+
+
+def test_route_ipv4_without_priority():
+    msg = _rtmsg(
+        socket.AF_INET,
+        24,
+        254,
+        255,
+        1,
+        0,
+        _attr(netlink.RTA_DST, socket.inet_aton("198.51.100.0")),
+        _attr(netlink.RTA_GATEWAY, socket.inet_aton("192.0.2.2")),
+        _attr(netlink.RTA_OIF, struct.pack("=I", 2)),
+    )
+    assert netlink._route(msg) == Route(
+        dst="198.51.100.0/24",
+        gateway="192.0.2.2",
+        dev="dummy0",
+        type="unicast",
+        metric=None,
+        table="main",
+        protocol=255,
+    )
+
+
+def test_route_ipv6():
+    # Tables beyond 255 are given by RTA_TABLE, and host routes have no prefix length
+    msg = _rtmsg(
+        socket.AF_INET6,
+        128,
+        252,
+        255,
+        6,
+        0,
+        _attr(netlink.RTA_DST, socket.inet_pton(socket.AF_INET6, "2001:db8::1")),
+        _attr(netlink.RTA_PRIORITY, struct.pack("=I", 1024)),
+        _attr(netlink.RTA_TABLE, struct.pack("=I", 100000001)),
+    )
+    assert netlink._route(msg) == Route(
+        dst="2001:db8::1",
+        gateway=None,
+        dev=None,
+        type="blackhole",
+        metric=1024,
+        table="100000001",
+        protocol=255,
+    )
+
+    # Default routes have no destination, and cloned routes are ignored
+    msg = _rtmsg(socket.AF_INET6, 0, 254, 3, 1, 0)
+    assert netlink._route(msg).dst == "::/0"
+    assert (
+        netlink._route(_rtmsg(socket.AF_INET6, 0, 254, 3, 1, netlink.RTM_F_CLONED))
+        is None
+    )
@@ -0,0 +1,107 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import select
+import socket
+
+import pytest
+
+import fakes
+from evpn_agent.ovsdb import Ovsdb
+
+MONITOR = {"Bridge": ["name", "ports"], "Port": ["name"]}
+
+
+def _bridges(db):
+    return sorted(row["name"] for row in db.tables["Bridge"].values())
+
+
+def _wait(db):
+    select.select([db.fileno()], [], [], 5)
+
+
+def test_server_restart(tmp_path):
+    path = str(tmp_path / "db.sock")
+    server = fakes.OvsdbServer(path, ["br-ex"])
+    db = Ovsdb(path, monitor=MONITOR)
+    db.connect()
+    assert _bridges(db) == ["br-ex"]
+
+    # While the server is down, the connection cannot be re-established, which leaves
+    # no socket to watch, and the replica as it was
+    server.close()
+    _wait(db)
+    assert not db.poll()
+    assert db.sock is None
+    assert db.fileno() is None
+    assert _bridges(db) == ["br-ex"]
+    assert not db.poll()
+
+    # Once it is back, the replica is repopulated from scratch
+    server = fakes.OvsdbServer(path, ["br-int"])
+    assert db.poll()
+    assert db.fileno() is not None
+    assert _bridges(db) == ["br-int"]
+
+    # And updates are received on the new connection
+    db.transact(
+        {"op": "insert", "table": "Port", "row": {"name": "veth0"}, "uuid-name": "p"},
+        {
+            "op": "mutate",
+            "table": "Bridge",
+            "where": [["name", "==", "br-int"]],
+            "mutations": [["ports", "insert", ["named-uuid", "p"]]],
+        },
+    )
+    db.poll()
+    assert [row["name"] for row in db.tables["Port"].values()] == ["veth0"]
+    server.close()
+
+
+def test_server_not_running(tmp_path):
+    path = str(tmp_path / "db.sock")
+    db = Ovsdb(path, monitor=MONITOR)
+    assert not db.poll()
+    assert db.fileno() is None
+
+    server = fakes.OvsdbServer(path, ["br-ex"])
+    assert db.poll()
+    assert _bridges(db) == ["br-ex"]
+    server.close()
+
+
+def test_server_not_responding(tmp_path):
+    # A server which accepts connections, but never responds to anything
+    path = str(tmp_path / "db.sock")
+    silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    silent.bind(path)
+    silent.listen()
+    db = Ovsdb(path, monitor=MONITOR, timeout=0.1)
+    with pytest.raises(socket.timeout):
+        db.connect()
+    assert db.sock is None
+
+    # Which is treated like a lost connection, re-established once the server is back
+    assert not db.poll()
+    assert db.fileno() is None
+    silent.close()
+    os.unlink(path)
+    server = fakes.OvsdbServer(path, ["br-ex"])
+    assert db.poll()
+    assert _bridges(db) == ["br-ex"]
+    server.close()
@@ -0,0 +1,126 @@
+# evpn_agent - OpenStack EVPN Agent
+#
+# Copyright (C) 2024-2025  Tore Anderson <tore@redpill-linpro.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import fakes
+from evpn_agent.vty import Vty
+
+ZEBRA = {"accepts": ("interface ", "ipv6 nd "), "config": "interface lo\nexit\n"}
+BGPD = {
+    "accepts": ("router bgp ", "address-family ", "redistribute ", "neighbor "),
+    "fails": ("neighbor 192.0.2.1 ",),
+    "config": "router bgp 65000\nexit\n",
+}
+
+
+def _daemons(sockdir):
+    return {
+        "zebra": fakes.VtyDaemon(sockdir, "zebra", **ZEBRA),
+        "bgpd": fakes.VtyDaemon(sockdir, "bgpd", **BGPD),
+    }
+
+
+def _restart(daemons, sockdir, name):
+    daemons[name].close()
+    daemons[name] = fakes.VtyDaemon(
+        sockdir, name, **(ZEBRA if name == "zebra" else BGPD)
+    )
+
+
+def test_show_running_reconnects(tmp_path):
+    daemons = _daemons(str(tmp_path))
+    vty = Vty(sockdir=str(tmp_path))
+    assert vty.show_running() == "router bgp 65000\nexit\n\ninterface lo\nexit\n"
+
+    _restart(daemons, str(tmp_path), "bgpd")
+    assert vty.show_running(daemon="bgpd") == "router bgp 65000\nexit\n"
+    assert daemons["bgpd"].commands == [
+        ("view", "enable"),
+        ("enable", "do write terminal"),
+    ]
+
+
+def test_stale_socket(tmp_path):
+    daemons = _daemons(str(tmp_path))
+    daemons["bgpd"].close()
+    vty = Vty(sockdir=str(tmp_path))
+    assert vty.show_running() == "interface lo\nexit\n"
+    assert list(vty.socks) == ["zebra"]
+
+
+def test_configure_failures(tmp_path):
+    daemons = _daemons(str(tmp_path))
+    vty = Vty(sockdir=str(tmp_path))
+    failures = vty.configure(
+        [
+            ["router bgp 65000", "redistribute kernel"],
+            [
+                "router bgp 65000",
+                "neighbor 192.0.2.1 remote-as external",
+                "neighbor 192.0.2.1 timers 1 3",
+            ],
+            ["bogus command"],
+            ["interface irb-1", "ipv6 nd ra-interval 10"],
+        ]
+    )
+    assert failures == [
+        (
+            1,
+            "neighbor 192.0.2.1 remote-as external: "
+            "bgpd: % Failed: neighbor 192.0.2.1 remote-as external",
+        ),
+        (2, "bogus command: unknown command"),
+    ]
+    # The rest of a block is skipped once a command has failed, but not the next block
+    sent = [command for _, command in daemons["bgpd"].commands]
+    assert "neighbor 192.0.2.1 timers 1 3" not in sent
+    assert "ipv6 nd ra-interval 10" in sent
+
+
+def test_configure_blocks(tmp_path):
+    daemons = _daemons(str(tmp_path))
+    vty = Vty(sockdir=str(tmp_path))
+    vty.configure(
+        [
+            ["router bgp 65000", "redistribute kernel"],
+            ["interface irb-1", "ipv6 nd ra-interval 10"],
+        ]
+    )
+    # Every block starts from the top level of configuration mode, and configuration
+    # mode is left at the end
+    assert daemons["zebra"].commands == [
+        ("view", "enable"),
+        ("enable", "configure terminal"),
+        ("config", "router bgp 65000"),
+        ("config", "redistribute kernel"),
+        ("config", "end"),
+        ("enable", "configure terminal"),
+        ("config", "interface irb-1"),
+        ("config", "ipv6 nd ra-interval 10"),
+        ("config", "end"),
+        ("enable", "configure terminal"),
+        ("config", "end"),
+    ]
+
+
+def test_configure_reconnects(tmp_path):
+    daemons = _daemons(str(tmp_path))
+    vty = Vty(sockdir=str(tmp_path))
+    assert vty.configure([["interface irb-1"]]) == []
+
+    _restart(daemons, str(tmp_path), "zebra")
+    assert vty.configure([["interface irb-2"]]) == []
+    assert ("config", "interface irb-2") in daemons["zebra"].commands